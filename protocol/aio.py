@@ -0,0 +1,483 @@
+import os
+import time
+import socket
+import asyncio
+import logging
+
+from io import BytesIO, FileIO
+from functools import partial
+from typing import AsyncIterable, AsyncIterator, Callable, Generator, Hashable, Iterable
+
+from .socket import Socket, SOCKET_BUFFER_SIZE
+from .timers import Timers
+from .pacing import TokenBucket
+from .budget import MemoryBudget
+from .scheduler import Scheduler
+from .connection import Connection, STREAM_FEATURES
+from .transfers.send import SendTransfer
+from .transfers.recv import RecvTransfer
+from .transfers.sources import ChunkSource
+from .types.socket_stats import SocketStats
+from .types.handlers import Handlers
+from .types.conn_side import ConnSide
+
+
+LOG = logging.getLogger("AsyncSocket")
+
+STREAM_BUFFER = 1024 * 1024 # Bytes of an async stream read ahead of the window
+
+class AsyncConnection:
+    """
+    Awaitable sends over a connection of an AsyncSocket. Every send returns when the other side
+    has it all (True) or the transfer failed (False).
+    """
+    def __init__(self, connection: Connection, loop: asyncio.AbstractEventLoop, wakeup: Callable[[], None]) -> None:
+        self.__connection = connection
+        self.__loop = loop
+        self.__wakeup = wakeup
+
+    @property
+    def connection(self) -> Connection:
+        return self.__connection
+
+    @property
+    def other_side(self) -> ConnSide:
+        return self.__connection.other_side
+
+    def __future(self) -> tuple[asyncio.Future, Callable[[bool], None]]:
+        future = self.__loop.create_future()
+        def on_sent(is_correct: bool) -> None:
+            if not future.done():
+                future.set_result(is_correct)
+        return future, on_sent
+
+    async def __wait(self, transfers: list[SendTransfer]) -> bool:
+        futures = []
+        for transfer in transfers:
+            future, transfer.on_sent = self.__future()
+            futures.append(future)
+        return all(await asyncio.gather(*futures))
+
+    async def send_message(self, message: bytes, fragment_size: int | None = None) -> bool:
+        future, on_sent = self.__future()
+        self.__connection.send_message(message, fragment_size, on_sent)
+        return await future
+
+    async def send_stream(self, chunks: Iterable[bytes] | AsyncIterable[bytes], fragment_size: int | None = None) -> bool:
+        """
+        An async iterable is read as the window allows, up to STREAM_BUFFER bytes ahead. A stream
+        with nothing to send for longer than the transfer timeout fails like a silent peer.
+        """
+        if not isinstance(chunks, AsyncIterable):
+            return await self.__wait([self.__connection.send_stream(chunks, fragment_size)])
+        if self.__connection.features & STREAM_FEATURES != STREAM_FEATURES:
+            return await self.send_message(b''.join([chunk async for chunk in chunks]), fragment_size)
+
+        source = ChunkSource()
+        drained = asyncio.Event()
+        source.on_drain = drained.set
+        transfer = self.__connection.send_stream(source, fragment_size)
+        future, on_sent = self.__future()
+        def on_done(is_correct: bool) -> None:
+            on_sent(is_correct)
+            drained.set()
+        transfer.on_sent = on_done
+        try:
+            async for chunk in chunks:
+                if future.done():
+                    break # Failed, no need to read further
+                source.feed(chunk)
+                self.__wakeup()
+                while source.buffered >= STREAM_BUFFER and not future.done():
+                    drained.clear()
+                    await drained.wait()
+        except BaseException:
+            transfer.kill() # The receiver must not take a cut stream for a complete one
+            self.__wakeup()
+            raise
+        source.end()
+        self.__wakeup()
+        return await future
+
+    async def send_file(self, file_io: FileIO, fragment_size: int | None = None) -> bool:
+        return await self.__wait([self.__connection.send_file(file_io, fragment_size)])
+
+    async def send_files(self, paths: Iterable[str | os.PathLike], root: str | os.PathLike | None = None, fragment_size: int | None = None) -> bool:
+        return await self.__wait(self.__connection.send_files(paths, root, fragment_size))
+
+    async def send_directory(self, directory: str | os.PathLike, fragment_size: int | None = None) -> bool:
+        return await self.__wait(self.__connection.send_directory(directory, fragment_size))
+
+    def disconnect(self) -> None:
+        self.__connection.disconnect()
+        self.__wakeup()
+
+    def __repr__(self) -> str:
+        return f"AsyncConnection(other_side={self.other_side})"
+
+
+class _LoopSocket(Socket):
+    """
+    The Socket under an AsyncSocket. It never reads the socket, the transport of the loop owns it
+    and hands over every datagram, so there is no receive iterator. The iterators run in loop
+    callbacks instead of `listen`: right after a datagram only those of the connection it came
+    from, all of them once a timer fired (driven by `loop.call_at`) or anything else changed,
+    again right away while any of them is busy. Attached to a transport by AsyncSocket.bind.
+    """
+    def __init__(self, handlers: Handlers, *args, **kwargs) -> None:
+        self.__dispatch = handlers
+        self.__loop: asyncio.AbstractEventLoop | None = None
+        self.__transport: asyncio.DatagramTransport | None = None
+        self.__pump_handle: asyncio.TimerHandle | None = None
+        self.__pump_at = 0.0 # Loop time
+        self.__full = False # Every iterator has to run, not only those of the dirty flows
+        self.__dirty: set[Hashable] = set() # Flows with something new to do
+        super().__init__(*args, **kwargs)
+
+    @property
+    def is_bound(self) -> bool:
+        return self.__transport is not None
+
+    def _connection_handlers(self) -> Handlers:
+        return self.__dispatch
+
+    def _attach(self, loop: asyncio.AbstractEventLoop, transport: asyncio.DatagramTransport, sock: socket.socket) -> None:
+        self.__loop = loop
+        self.__transport = transport
+        self._socket = sock # Only the transport reads it
+        self._reset()
+        self._clear_connections_timer = self._timers.call_later(self._clear_connections_interval, self.clear_connections)
+
+    def unbind(self) -> None:
+        if self.__transport is None:
+            LOG.warning("Socket already unbound")
+            return
+
+        for conn in list(self._connections.values()):
+            conn.disconnect()
+
+        self.__transport.close() # Sends what is buffered first
+        self.__transport = None
+        self._socket = None
+        if self.__pump_handle is not None:
+            self.__pump_handle.cancel()
+            self.__pump_handle = None
+        self._reset()
+        LOG.info(f"Socket unbound on {self._bound_on}")
+
+    def _reset(self) -> None:
+        super()._reset()
+        self._timers = Timers(self.__schedule) # An earlier deadline moves the pump
+        self.__full = False
+        self.__dirty = set()
+
+    def _datagram_received(self, data: bytes, address: tuple[str, int]) -> None:
+        if self.__transport is None:
+            return # Before the transport was attached or after unbind, lost like on the wire
+
+        now = time.time()
+        if now - self._recv_per_second_last > 1:
+            self._recv_per_second_last = now
+            self._recv_per_second = 0
+        if now - self._send_per_second_last > 1:
+            self._send_per_second_last = now
+            self._send_per_second = 0
+
+        self._recv_per_second += len(data)
+        self._stats.recv_bytes += len(data)
+        self._stats.recv_datagrams += 1
+        self._stats.recv_wakeups += 1
+        self._stats.recv_max_batch = max(self._stats.recv_max_batch, 1)
+
+        ip, port = address[:2]
+        key = ConnSide.pack(ip, port)
+        connection = self._connections.get(key)
+        if not connection:
+            connection = self._create_connection(ConnSide(ip, port))
+        connection._recv(data)
+        self._flow_changed(key)
+
+    def _transmit(self, buffers: list[bytes], address: tuple[str, int]) -> bool:
+        if self.__transport.get_write_buffer_size() > SOCKET_BUFFER_SIZE:
+            return False # The loop could not send for a while, like a full socket buffer
+        self.__transport.sendto(b''.join(buffers), address)
+        return True
+
+    def _add_iterator(self, iterable: Generator, flow: Hashable = None, weight: float = 1.0) -> None:
+        self._scheduler.add(iterable, flow, weight)
+        self._flow_changed(flow)
+
+    def _flow_changed(self, flow: Hashable) -> None:
+        """The iterators of `flow` (a connection) have something new to do"""
+        self.__dirty.add(flow)
+        self.__schedule()
+
+    def _wakeup(self) -> None:
+        self.__full = True
+        self.__schedule()
+
+    def __schedule(self) -> None:
+        if self.__transport is None:
+            return
+        now = self.__loop.time()
+        if self.__full or self.__dirty:
+            at = now
+        else:
+            deadline = self._timers.next_deadline
+            if deadline is None:
+                return
+            at = now + max(0.0, deadline - time.time()) # Timers count in wall clock time, the loop in its own
+
+        if self.__pump_handle is not None:
+            if self.__pump_at <= at:
+                return
+            self.__pump_handle.cancel()
+        self.__pump_at = at
+        self.__pump_handle = self.__loop.call_at(at, self.__pump)
+
+    def __pump(self) -> None:
+        self.__pump_handle = None
+        if self.__transport is None:
+            return
+
+        if self._timers.run_expired() > 0:
+            self.__full = True # Timer callbacks only set flags, the iterators of their connections do the work
+        if self.__full:
+            self.__full = False
+            self.__dirty = set()
+            self.__full = self._scheduler.iterate(self._on_iterator_finished) or self.__full
+        elif self.__dirty:
+            flows, self.__dirty = self.__dirty, set()
+            if self._scheduler.iterate_flows(flows, self._on_iterator_finished):
+                self.__dirty |= flows
+        self.__schedule()
+
+
+class _DatagramProtocol(asyncio.DatagramProtocol):
+    def __init__(self, sock: _LoopSocket) -> None:
+        self.__socket = sock
+
+    def datagram_received(self, data: bytes, address: tuple[str, int]) -> None:
+        self.__socket._datagram_received(data, address)
+
+    def error_received(self, exc: Exception) -> None:
+        LOG.warning(f"Socket error: {exc}")
+
+
+class AsyncSocket:
+    """
+    Socket for an asyncio event loop, it takes the same arguments. Datagrams come from a datagram
+    endpoint of the loop and the protocol runs in loop callbacks (see _LoopSocket), so an idle
+    socket costs nothing. Handlers work as for Socket, incoming data can also be read with
+    `messages()` and `files()`. Not thread safe, use it from the loop only.
+    """
+    def __init__(self, *args, **kwargs) -> None:
+        self.__handlers = Handlers()
+        self.__socket = _LoopSocket(Handlers(
+            on_connect=self.__on_connect,
+            on_message_recv=self.__on_message_recv,
+            on_message_send=lambda conn, message, is_correct: self.__handlers.on_message_send(conn, message, is_correct),
+            on_message_chunk=lambda conn, transfer_id, chunk: self.__handlers.on_message_chunk(conn, transfer_id, chunk),
+            on_file_destination=lambda conn, filename, length: self.__handlers.on_file_destination(conn, filename, length),
+            on_file_recv=self.__on_file_recv,
+            on_file_send=lambda conn, file, filename, is_correct: self.__handlers.on_file_send(conn, file, filename, is_correct),
+            on_disconnect=self.__on_disconnect,
+        ), *args, **kwargs)
+        self.__loop: asyncio.AbstractEventLoop | None = None
+
+        self.__async_connections: dict[tuple[int, int], AsyncConnection] = {}
+        self.__connecting: dict[tuple[int, int], list[asyncio.Future]] = {} # One per waiting connect call
+        self.__closed: asyncio.Future | None = None
+        self.__messages: asyncio.Queue = asyncio.Queue() # (connection, message), while somebody reads them
+        self.__files: asyncio.Queue = asyncio.Queue() # (connection, file, filename)
+        self.__message_readers = 0
+        self.__file_readers = 0
+
+    @property
+    def bound_on(self) -> ConnSide:
+        return self.__socket.bound_on
+
+    @property
+    def is_bound(self) -> bool:
+        return self.__socket.is_bound
+
+    @property
+    def connections(self) -> list[Connection]:
+        return self.__socket.connections
+
+    @property
+    def speed(self) -> tuple[int, int]:
+        return self.__socket.speed
+
+    @property
+    def stats(self) -> SocketStats:
+        return self.__socket.stats
+
+    @property
+    def rate_limit(self) -> TokenBucket:
+        return self.__socket.rate_limit
+
+    @property
+    def recv_memory_budget(self) -> MemoryBudget:
+        return self.__socket.recv_memory_budget
+
+    @property
+    def max_datagram_size(self) -> int:
+        return self.__socket.max_datagram_size
+
+    @property
+    def timers(self) -> Timers:
+        return self.__socket.timers
+
+    @property
+    def scheduler(self) -> Scheduler:
+        return self.__socket.scheduler
+
+    def set_connection_weight(self, side: ConnSide, weight: float) -> None:
+        self.__socket.set_connection_weight(side, weight)
+
+    def set_transfer_weight(self, transfer: SendTransfer | RecvTransfer, weight: float) -> None:
+        self.__socket.set_transfer_weight(transfer, weight)
+
+    def on_connect(self, func: Callable) -> Callable:
+        self.__handlers.on_connect = func
+        return func
+
+    def on_message_recv(self, func: Callable) -> Callable:
+        self.__handlers.on_message_recv = func
+        return func
+
+    def on_message_send(self, func: Callable) -> Callable:
+        self.__handlers.on_message_send = func
+        return func
+
+    def on_message_chunk(self, func: Callable) -> Callable:
+        self.__handlers.on_message_chunk = func
+        return func
+
+    def on_file_destination(self, func: Callable) -> Callable:
+        self.__handlers.on_file_destination = func
+        return func
+
+    def on_file_recv(self, func: Callable) -> Callable:
+        self.__handlers.on_file_recv = func
+        return func
+
+    def on_file_send(self, func: Callable) -> Callable:
+        self.__handlers.on_file_send = func
+        return func
+
+    def on_disconnect(self, func: Callable) -> Callable:
+        self.__handlers.on_disconnect = func
+        return func
+
+    def get_connection_by_side(self, side: ConnSide) -> Connection:
+        return self.__socket.get_connection_by_side(side)
+
+    def disconnect(self, side: ConnSide) -> None:
+        self.__socket.disconnect(side)
+
+    def disconnect_all(self) -> None:
+        self.__socket.disconnect_all()
+
+    def __async_connection(self, connection: Connection) -> AsyncConnection:
+        key = connection.other_side.key
+        if key not in self.__async_connections:
+            wakeup = partial(self.__socket._flow_changed, key)
+            self.__async_connections[key] = AsyncConnection(connection, self.__loop, wakeup)
+        return self.__async_connections[key]
+
+    def __on_connect(self, connection: Connection) -> None:
+        self.__handlers.on_connect(connection)
+        for future in self.__connecting.pop(connection.other_side.key, []):
+            if not future.done(): # Cancelled by a timeout
+                future.set_result(connection)
+
+    def __on_message_recv(self, connection: Connection, message: bytes, is_correct: bool) -> None:
+        self.__handlers.on_message_recv(connection, message, is_correct)
+        if is_correct and self.__message_readers:
+            self.__messages.put_nowait((self.__async_connection(connection), message))
+
+    def __on_file_recv(self, connection: Connection, file: BytesIO, filename: str, is_correct: bool) -> None:
+        self.__handlers.on_file_recv(connection, file, filename, is_correct)
+        if is_correct and self.__file_readers:
+            self.__files.put_nowait((self.__async_connection(connection), file, filename))
+
+    def __on_disconnect(self, connection: Connection) -> None:
+        self.__handlers.on_disconnect(connection)
+        key = connection.other_side.key
+        self.__async_connections.pop(key, None)
+        for future in self.__connecting.pop(key, []):
+            if not future.done():
+                future.set_exception(ConnectionError(f"Can not connect to {connection.other_side}"))
+
+    async def bind(self) -> None:
+        if self.__socket.is_bound:
+            LOG.warning("Socket already bound")
+            return
+
+        self.__loop = asyncio.get_running_loop()
+        sock = self.__socket._create_socket()
+        transport, _ = await self.__loop.create_datagram_endpoint(lambda: _DatagramProtocol(self.__socket), sock=sock)
+        self.__socket._attach(self.__loop, transport, sock)
+        self.__closed = self.__loop.create_future()
+
+        LOG.info(f"Socket bound on {self.bound_on}")
+
+    def unbind(self) -> None:
+        if not self.__socket.is_bound:
+            LOG.warning("Socket already unbound")
+            return
+
+        self.__socket.unbind()
+        self.__async_connections = {}
+        for futures in self.__connecting.values():
+            for future in futures:
+                if not future.done():
+                    future.set_exception(ConnectionError("Socket was unbound"))
+        self.__connecting = {}
+        for _ in range(self.__message_readers):
+            self.__messages.put_nowait(None)
+        for _ in range(self.__file_readers):
+            self.__files.put_nowait(None)
+        self.__closed.set_result(None)
+
+    async def listen(self) -> None:
+        """Wait until the socket is unbound, the loop does the work meanwhile"""
+        if self.__closed is not None:
+            await asyncio.shield(self.__closed)
+
+    async def connect(self, side: ConnSide, timeout: float | None = None) -> AsyncConnection:
+        """Returns when the handshake is done, raises ConnectionError if it can not be"""
+        connection = self.__socket.connect(side)
+        if not connection.conversation_status.is_connected:
+            future = self.__loop.create_future()
+            self.__connecting.setdefault(side.key, []).append(future)
+            await asyncio.wait_for(future, timeout)
+        return self.__async_connection(connection)
+
+    async def messages(self) -> AsyncIterator[tuple[AsyncConnection, bytes]]:
+        """Correct incoming messages, from the first iteration until the socket is unbound"""
+        self.__message_readers += 1
+        try:
+            while (item := await self.__messages.get()) is not None:
+                yield item
+        finally:
+            self.__message_readers -= 1
+
+    async def files(self) -> AsyncIterator[tuple[AsyncConnection, BytesIO, str]]:
+        """Correct incoming files with their names, from the first iteration until the socket is unbound"""
+        self.__file_readers += 1
+        try:
+            while (item := await self.__files.get()) is not None:
+                yield item
+        finally:
+            self.__file_readers -= 1
+
+    async def __aenter__(self) -> "AsyncSocket":
+        await self.bind()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback) -> None:
+        if self.is_bound:
+            self.unbind()
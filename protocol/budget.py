@@ -0,0 +1,59 @@
+class MemoryBudget:
+    """
+    Bytes of received parts waiting in memory until they are written, shared by all receiving
+    transfers of a socket. A transfer charges the parts it keeps and releases them once they are
+    written, and advertises its share of what is left, so a hundred transfers can not each hold
+    the whole budget.
+    """
+    def __init__(self, limit: int | None) -> None:
+        if limit is not None and limit <= 0:
+            raise ValueError("Memory budget must be positive or None")
+        self.__limit = limit
+        self.__used = 0
+        self.__users = 0
+
+    @property
+    def limit(self) -> int | None:
+        """Bytes, None for no limit"""
+        return self.__limit
+
+    @property
+    def used(self) -> int:
+        return self.__used
+
+    @property
+    def free(self) -> int | None:
+        if self.__limit is None:
+            return None
+        return max(0, self.__limit - self.__used)
+
+    @property
+    def users(self) -> int:
+        return self.__users
+
+    @property
+    def share(self) -> int | None:
+        """What is left split between the transfers using the budget"""
+        if self.__limit is None:
+            return None
+        return self.free // max(1, self.__users)
+
+    def join(self) -> None:
+        self.__users += 1
+
+    def leave(self, held: int) -> None:
+        """A transfer finished, with `held` bytes it did not release"""
+        self.__users = max(0, self.__users - 1)
+        self.release(held)
+
+    def fits(self, size: int) -> bool:
+        return self.__limit is None or self.__used + size <= self.__limit
+
+    def charge(self, size: int) -> None:
+        self.__used += size
+
+    def release(self, size: int) -> None:
+        self.__used = max(0, self.__used - size)
+
+    def __repr__(self) -> str:
+        return f"MemoryBudget(limit={self.__limit}, used={self.__used}, users={self.__users})"
@@ -0,0 +1,137 @@
+import zlib
+import struct
+
+from abc import ABC, abstractmethod
+
+from .types.header import HEADER_SIZE, CHECKSUM_OFFSET
+
+try:
+    from crc32c import crc32c as _crc32c # Optional C implementation of CRC32C
+except ImportError:
+    _crc32c = None
+
+
+_HEADER_CHECKSUM = struct.Struct('>H')
+_TRAILER = struct.Struct('>I')
+
+class Checksum(ABC):
+    """
+    Integrity check of a whole datagram. It is computed once, when the packet is dumped,
+    and verified on the raw datagram before it is parsed.
+    `size` is the number of bytes the checksum appends after the payload.
+    """
+    id: int = NotImplemented
+    name: str = NotImplemented
+    size: int = 0
+
+    @abstractmethod
+    def seal(self, datagram: bytearray) -> int:
+        """Write the checksum into the dumped datagram, returns its value"""
+
+    @abstractmethod
+    def seal_vector(self, header: bytearray, payload: list[bytes | memoryview]) -> tuple[int, bytes]:
+        """Same as seal for a datagram sent as header + payload pieces + trailer. Returns the value and the trailer"""
+
+    @abstractmethod
+    def verify(self, datagram: bytes | memoryview) -> bool:
+        ...
+
+    def __repr__(self) -> str:
+        return f"{type(self).__name__}()"
+
+
+class LegacyChecksum(Checksum):
+    """16-bit sum of big-endian words of the payload, stored in the header (the original algorithm)"""
+    id = 0
+    name = "sum16"
+
+    @staticmethod
+    def calculate(data: bytes | memoryview) -> int:
+        # Sum of 2-byte words == high bytes * 256 + low bytes; a trailing odd byte is a high byte
+        data = memoryview(data).cast('B')
+        return ((sum(data[0::2]) << 8) + sum(data[1::2])) & 0xFFFF
+
+    def seal(self, datagram: bytearray) -> int:
+        checksum = self.calculate(memoryview(datagram)[HEADER_SIZE:])
+        _HEADER_CHECKSUM.pack_into(datagram, CHECKSUM_OFFSET, checksum)
+        return checksum
+
+    def seal_vector(self, header: bytearray, payload: list[bytes | memoryview]) -> tuple[int, bytes]:
+        high = low = offset = 0
+        for piece in payload: # A piece starting at an odd offset starts with a low byte
+            piece = memoryview(piece).cast('B')
+            even, odd = sum(piece[0::2]), sum(piece[1::2])
+            if offset % 2:
+                even, odd = odd, even
+            high += even
+            low += odd
+            offset += len(piece)
+        checksum = ((high << 8) + low) & 0xFFFF
+        _HEADER_CHECKSUM.pack_into(header, CHECKSUM_OFFSET, checksum)
+        return checksum, b''
+
+    def verify(self, datagram: bytes | memoryview) -> bool:
+        if len(datagram) < HEADER_SIZE:
+            return False
+        checksum, = _HEADER_CHECKSUM.unpack_from(datagram, CHECKSUM_OFFSET)
+        return checksum == self.calculate(memoryview(datagram)[HEADER_SIZE:])
+
+
+class Crc32Checksum(Checksum):
+    """CRC32 of header and payload, appended as a 4-byte trailer. The header field stays 0"""
+    id = 1
+    name = "crc32"
+    size = _TRAILER.size
+
+    @staticmethod
+    def calculate(data: bytes | memoryview, value: int = 0) -> int:
+        return zlib.crc32(data, value)
+
+    def seal(self, datagram: bytearray) -> int:
+        view = memoryview(datagram)
+        checksum = self.calculate(view[:-self.size])
+        _TRAILER.pack_into(datagram, len(datagram) - self.size, checksum)
+        return checksum
+
+    def seal_vector(self, header: bytearray, payload: list[bytes | memoryview]) -> tuple[int, bytes]:
+        checksum = self.calculate(header)
+        for piece in payload:
+            checksum = self.calculate(piece, checksum)
+        return checksum, _TRAILER.pack(checksum)
+
+    def verify(self, datagram: bytes | memoryview) -> bool:
+        if len(datagram) < HEADER_SIZE + self.size:
+            return False
+        view = memoryview(datagram)
+        checksum, = _TRAILER.unpack_from(view, len(view) - self.size)
+        return checksum == self.calculate(view[:-self.size])
+
+
+class Crc32cChecksum(Crc32Checksum):
+    """Same as Crc32Checksum with the Castagnoli polynomial. Only available if the crc32c package is installed"""
+    id = 2
+    name = "crc32c"
+
+    @staticmethod
+    def calculate(data: bytes | memoryview, value: int = 0) -> int:
+        return _crc32c(data, value)
+
+
+LEGACY_CHECKSUM = LegacyChecksum()
+
+CHECKSUMS: dict[int, Checksum] = {
+    checksum.id: checksum
+    for checksum in (LEGACY_CHECKSUM, Crc32Checksum(), Crc32cChecksum() if _crc32c is not None else None)
+    if checksum is not None
+}
+
+# Offered during the handshake, the most preferred first
+PREFERRED_CHECKSUMS: list[int] = [id_ for id_ in (Crc32cChecksum.id, Crc32Checksum.id, LegacyChecksum.id) if id_ in CHECKSUMS]
+
+
+def choose_checksum(offered: list[int]) -> Checksum:
+    """Pick the first checksum of the other side's offer that we support. Old peers offer nothing"""
+    for id_ in offered:
+        if id_ in CHECKSUMS:
+            return CHECKSUMS[id_]
+    return LEGACY_CHECKSUM
@@ -0,0 +1,138 @@
+from abc import ABC, abstractmethod
+from time import perf_counter
+from typing import Callable
+
+
+class Cipher(ABC):
+    """
+    Encryption engine used by Packet.encrypt/decrypt. Data is encrypted with the public key
+    of the other side and decrypted with our private key.
+    Authenticated engines append `tag_size` bytes to the encrypted data and raise CipherError
+    from decrypt when the tag does not match, so their packets are protected even without a
+    strong checksum.
+    Byte-wise engines (`byte_wise`) can decrypt a prefix of the data on its own, which lets
+    the receiver read the insertion point of a part without decrypting the whole part.
+    Every connection gets its own engine (see choose_cipher), which counts the bytes it processed
+    and times one call in `SAMPLE_EVERY` of them, see `throughput`.
+    """
+    id: int = NotImplemented
+    name: str = NotImplemented
+    tag_size: int = 0
+    byte_wise: bool = False
+
+    SAMPLE_EVERY = 64 # Timing every packet costs about as much as XOR-ing it
+
+    def __init__(self) -> None:
+        self._bytes = 0
+        self._calls = 0
+        self._sampled_bytes = 0
+        self._time = 0.0
+
+    @property
+    def bytes_processed(self) -> int:
+        return self._bytes
+
+    @property
+    def throughput(self) -> float:
+        """Bytes per second spent inside this engine, estimated from the timed calls"""
+        return self._sampled_bytes / self._time if self._time else 0.0
+
+    def encrypt(self, data: bytes | memoryview, public_key: int) -> bytes:
+        return self.__count(self._encrypt, data, public_key)
+
+    def decrypt(self, data: bytes | memoryview, private_key: int) -> bytes:
+        return self.__count(self._decrypt, data, private_key)
+
+    def __count(self, function: Callable[[bytes | memoryview, int], bytes], data: bytes | memoryview, key: int) -> bytes:
+        self._bytes += len(data)
+        self._calls += 1
+        if self._calls % self.SAMPLE_EVERY:
+            return function(data, key)
+        start = perf_counter()
+        result = function(data, key)
+        self._time += perf_counter() - start
+        self._sampled_bytes += len(data)
+        return result
+
+    def encrypt_vector(self, pieces: list[bytes | memoryview], public_key: int) -> list[bytes | memoryview]:
+        """Encrypt data given in pieces. Byte-wise engines encrypt every piece on its own, nothing is joined"""
+        if not self.byte_wise:
+            return [self.encrypt(b''.join(pieces), public_key)]
+        return [self.encrypt(piece, public_key) for piece in pieces]
+
+    def decrypt_prefix(self, data: bytes | memoryview, private_key: int, size: int) -> bytes | None:
+        """First `size` decrypted bytes, None if the engine can only decrypt the whole data"""
+        if not self.byte_wise:
+            return None
+        return self._decrypt(data[:size], private_key)
+
+    @abstractmethod
+    def _encrypt(self, data: bytes | memoryview, public_key: int) -> bytes:
+        ...
+
+    @abstractmethod
+    def _decrypt(self, data: bytes | memoryview, private_key: int) -> bytes:
+        ...
+
+    def __repr__(self) -> str:
+        return f"{type(self).__name__}(throughput={self.throughput:.0f}B/s)"
+
+
+class CipherError(ValueError):
+    ...
+
+
+class NullCipher(Cipher):
+    """No encryption at all, for trusted links where CPU matters more"""
+    id = 0
+    name = "null"
+    byte_wise = True
+
+    def _encrypt(self, data: bytes | memoryview, public_key: int) -> bytes | memoryview:
+        return data # Views of the source go to the socket untouched
+
+    def _decrypt(self, data: bytes | memoryview, private_key: int) -> bytes:
+        return bytes(data) # Copied out of the receive buffer
+
+
+class XorCipher(Cipher):
+    """The original XOR cipher, done with bytes.translate and a table per key instead of byte by byte"""
+    id = 1
+    name = "xor"
+    byte_wise = True
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.__tables: dict[int, bytes] = {}
+
+    def __table(self, key: int) -> bytes:
+        table = self.__tables.get(key)
+        if table is None:
+            table = self.__tables[key] = bytes(i ^ key for i in range(256))
+        return table
+
+    def _encrypt(self, data: bytes | memoryview, public_key: int) -> bytes:
+        if not isinstance(data, bytes):
+            data = bytes(data)
+        return data.translate(self.__table(public_key))
+
+    def _decrypt(self, data: bytes | memoryview, private_key: int) -> bytes:
+        if not isinstance(data, bytes):
+            data = bytes(data)
+        return data.translate(self.__table(private_key * 2))
+
+
+XOR_CIPHER = XorCipher() # Before the handshake picks one
+
+CIPHERS: dict[int, type[Cipher]] = {cipher.id: cipher for cipher in (NullCipher, XorCipher)}
+
+
+def choose_cipher(offered: list[int], supported: list[int]) -> Cipher:
+    """
+    New engine of the first cipher of the other side's offer that we support too, so its counters
+    belong to one connection. Old peers only know XOR
+    """
+    for id_ in offered:
+        if id_ in supported and id_ in CIPHERS:
+            return CIPHERS[id_]()
+    return XorCipher()
@@ -0,0 +1,85 @@
+import zlib
+import math
+
+from abc import ABC, abstractmethod
+from collections import Counter
+
+
+class CodecError(ValueError):
+    ...
+
+
+class Codec(ABC):
+    """
+    Compression of parts. Once a codec is negotiated every part starts with a byte telling how
+    it is encoded: `RAW` or the id of the codec. A part is compressed on its own, so it can still
+    be written at its insertion point whatever arrived before it, and it is sent raw when
+    compressing does not make it smaller.
+    """
+    id: int = NotImplemented
+    name: str = NotImplemented
+
+    @abstractmethod
+    def compress(self, data: bytes | memoryview) -> bytes:
+        ...
+
+    @abstractmethod
+    def decompress(self, data: bytes | memoryview, max_length: int) -> bytes:
+        """Raises CodecError for invalid data or data that would grow over `max_length`"""
+
+    def __repr__(self) -> str:
+        return f"{type(self).__name__}()"
+
+
+class ZlibCodec(Codec):
+    """Raw deflate (no zlib header and trailer, the checksum covers the part), fast level by default"""
+    id = 1
+    name = "zlib"
+
+    def __init__(self, level: int = 1) -> None:
+        self.__level = level
+
+    def compress(self, data: bytes | memoryview) -> bytes:
+        return zlib.compress(data, self.__level, wbits=-15)
+
+    def decompress(self, data: bytes | memoryview, max_length: int) -> bytes:
+        decompressor = zlib.decompressobj(wbits=-15)
+        try:
+            result = decompressor.decompress(data, max_length)
+        except zlib.error as e:
+            raise CodecError(str(e)) from e
+        if not decompressor.eof or decompressor.unconsumed_tail:
+            raise CodecError("Part is truncated or too long")
+        return result
+
+
+RAW = 0 # Marker of a part sent as it is
+CODEC_MARKER_SIZE = 1
+
+CODECS: dict[int, Codec] = {codec.id: codec for codec in (ZlibCodec(),)}
+
+# Offered during the handshake, the most preferred first
+PREFERRED_CODECS: list[int] = [ZlibCodec.id]
+
+
+def choose_codec(offered: list[int], supported: list[int]) -> Codec | None:
+    """Pick the first codec of the other side's offer that we support too. Old peers offer none"""
+    for id_ in offered:
+        if id_ in supported and id_ in CODECS:
+            return CODECS[id_]
+    return None
+
+
+PROBE_SIZE = 4096 # Bytes of every sample
+INCOMPRESSIBLE_ENTROPY = 7.5 # Bits per byte, compressed and encrypted data is close to 8
+
+def entropy(data: bytes | memoryview) -> float:
+    """Shannon entropy of the byte values, in bits per byte"""
+    if not len(data):
+        return 0.0
+    total = len(data)
+    return -sum(count / total * math.log2(count / total) for count in Counter(bytes(data)).values())
+
+def is_compressible(*samples: bytes | memoryview) -> bool:
+    """Cheap guess from a few samples, so already compressed data is not compressed again"""
+    return any(entropy(sample[:PROBE_SIZE]) < INCOMPRESSIBLE_ENTROPY for sample in samples if len(sample))
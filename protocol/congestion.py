@@ -0,0 +1,141 @@
+import logging
+
+from abc import ABC, abstractmethod
+from time import time
+from .rtt import RttEstimator
+
+
+LOG = logging.getLogger("Congestion")
+
+class CongestionController(ABC):
+    """
+    Congestion window of one connection, in parts. Shared by all its transfers: a transfer
+    may send a new part only while `can_send`, reports every new part with `on_sent`,
+    acknowledged parts with `on_ack`, retransmission timeouts with `on_loss` and the parts
+    it will never wait for again (finished or killed transfer) with `on_release`.
+    Retransmits do not change the number of parts in flight.
+    """
+    name: str = NotImplemented
+
+    def __init__(self,
+                 rtt: RttEstimator,
+                 initial_window: float = 10,
+                 min_window: float = 2,
+                 max_window: float = 10000) -> None:
+        self._rtt = rtt
+        self._cwnd = float(initial_window)
+        self._min_window = float(min_window)
+        self._max_window = float(max_window)
+        self._in_flight = 0
+        self._recovery_until = 0.0
+        self.losses = 0
+
+    @property
+    def window(self) -> int:
+        return int(self._cwnd)
+
+    @property
+    def in_flight(self) -> int:
+        return self._in_flight
+
+    @property
+    def can_send(self) -> bool:
+        return self._in_flight < int(self._cwnd)
+
+    def on_sent(self, count: int = 1) -> None:
+        self._in_flight += count
+
+    def on_release(self, count: int) -> None:
+        self._in_flight = max(0, self._in_flight - count)
+
+    def on_ack(self, acked: int, rtt_sample: float | None = None) -> None:
+        if acked <= 0:
+            return
+        self.on_release(acked)
+        self._on_ack(acked, rtt_sample)
+        self._cwnd = min(self._max_window, max(self._min_window, self._cwnd))
+
+    def on_loss(self, now: float | None = None) -> None:
+        """Timeouts of one window count as a single loss event, once per round trip"""
+        if now is None:
+            now = time()
+        if now < self._recovery_until:
+            return
+        self._recovery_until = now + (self._rtt.srtt or self._rtt.rto)
+        self.losses += 1
+        self._on_loss()
+        self._cwnd = min(self._max_window, max(self._min_window, self._cwnd))
+        LOG.debug(f"Loss, {self}")
+
+    @abstractmethod
+    def _on_ack(self, acked: int, rtt_sample: float | None) -> None:
+        ...
+
+    @abstractmethod
+    def _on_loss(self) -> None:
+        ...
+
+    def __repr__(self) -> str:
+        return f"{type(self).__name__}(window={self._cwnd:.1f}, in_flight={self._in_flight}, losses={self.losses})"
+
+
+class NewRenoController(CongestionController):
+    """AIMD: slow start up to ssthresh, then one part per round trip, halve on loss"""
+    name = "newreno"
+
+    def __init__(self, rtt: RttEstimator, *args, **kwargs) -> None:
+        super().__init__(rtt, *args, **kwargs)
+        self._ssthresh = self._max_window
+
+    def _on_ack(self, acked: int, rtt_sample: float | None) -> None:
+        if self._cwnd < self._ssthresh:
+            self._cwnd += acked
+        else:
+            self._cwnd += acked / self._cwnd
+
+    def _on_loss(self) -> None:
+        self._ssthresh = max(self._min_window, self._cwnd / 2)
+        self._cwnd = self._ssthresh
+
+
+class DelayBasedController(CongestionController):
+    """
+    Vegas-like: compares the throughput expected at the lowest RTT seen with the one actually
+    measured, and keeps between `alpha` and `beta` parts queued in the path. Backs off before
+    the queues overflow, halves on loss like AIMD.
+    """
+    name = "delay"
+
+    def __init__(self, rtt: RttEstimator, *args, alpha: float = 4, beta: float = 16, **kwargs) -> None:
+        super().__init__(rtt, *args, **kwargs)
+        self._alpha = alpha
+        self._beta = beta
+        self._base_rtt: float | None = None
+        self._slow_start = True
+
+    def _on_ack(self, acked: int, rtt_sample: float | None) -> None:
+        if rtt_sample is None or rtt_sample <= 0:
+            return
+        if self._base_rtt is None or rtt_sample < self._base_rtt:
+            self._base_rtt = rtt_sample
+
+        queued = self._cwnd * (1 - self._base_rtt / rtt_sample) # Parts waiting in queues along the path
+        if self._slow_start:
+            if queued > self._alpha:
+                self._slow_start = False
+            else:
+                self._cwnd += acked
+                return
+        if queued < self._alpha:
+            self._cwnd += acked / self._cwnd
+        elif queued > self._beta:
+            self._cwnd -= acked / self._cwnd
+
+    def _on_loss(self) -> None:
+        self._slow_start = False
+        self._cwnd /= 2
+
+
+CONGESTION_CONTROLLERS: dict[str, type[CongestionController]] = {
+    controller.name: controller for controller in (NewRenoController, DelayBasedController)
+}
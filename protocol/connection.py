@@ -1,36 +1,70 @@
+import os
 import logging
+from collections import deque
 from random import randint
 import time
 
 from io import SEEK_END, SEEK_SET, BytesIO, FileIO
 from tempfile import NamedTemporaryFile
-from typing import Callable, Type, TypeVar
+from typing import Callable, Iterable, Type, TypeVar
 
 from .types.flags import Flags
 from .types.header import Header, HEADER_SIZE
 from .types.keychain import Keychain
 from .types.handlers import Handlers
 from .types.conn_side import ConnSide
+from .rtt import RttEstimator
+from .congestion import CongestionController, NewRenoController
+from .pacing import Pacer, TokenBucket
+from .budget import MemoryBudget
+from .timers import Timer, Timers
+from .checksum import Checksum, LEGACY_CHECKSUM, PREFERRED_CHECKSUMS, choose_checksum
+from .cipher import Cipher, CipherError, XOR_CIPHER, choose_cipher
+from .compression import Codec, CODEC_MARKER_SIZE, choose_codec
+from .types.options import Options, Feature, LEGACY_DATAGRAM_SIZE
 from .types.packets.base import Packet
 from .types.packets.syn import SynPacket
 from .transfers.recv import RecvTransfer
-from .transfers.send import SendTransfer
+from .transfers.send import SendTransfer, max_part_size
+from .transfers.sinks import BundleSink, ChunkSink, FileSink
+from .transfers.sources import BundleSource, ChunkSource
 from .types.packets.syn_ack import SynAckPacket
-from .types.packets.send_part import SendPartPacket
+from .types.packets.send_part import SendPartPacket, WideSendPartPacket
 from .types.iteration_status import IterationStatus
-from .types.packets.syn_send_msg import SynSendMsgPacket
+from .types.packets.syn_send_msg import SynSendMsgPacket, WideSynSendMsgPacket, InlineMsgPacket, STREAM_MESSAGE_LEN
+from .types.packets.syn_send_bundle import SynSendBundlePacket
 from .types.conversation_status import ConversationStatus
-from .types.packets.syn_send_file import SynSendFilePacket
+from .types.packets.syn_send_file import SynSendFilePacket, WideSynSendFilePacket, ResumableSynSendFilePacket
+from .utils import content_id
 
 
 LOG = logging.getLogger("Connection")
 _T = TypeVar("_T")
 
+_HANDSHAKE_FLAGS = (Flags.SYN, Flags.SYN | Flags.ACK) # Always use the legacy checksum
+SUPPORTED_FEATURES = Feature.SACK | Feature.WINDOW | Feature.WIDE_OFFSETS | Feature.STREAM | Feature.RESUME | Feature.BUNDLE | Feature.INLINE
+STREAM_FEATURES = Feature.STREAM | Feature.WIDE_OFFSETS # A stream's length is only known at its end
+RESUME_FEATURES = Feature.RESUME | Feature.SACK | Feature.WIDE_OFFSETS # Kept parts are announced in SACKs
+BUNDLE_FEATURES = Feature.BUNDLE | Feature.WIDE_OFFSETS
+_BUNDLE = Flags.FILE | Flags.MSG # Data type of a bundle
+_INLINE = Flags.SYN | Flags.SEND | Flags.MSG | Flags.FIN # Flags of a message in its SYN
+INLINE_MAX_TRIES = 8 # Sends of an inline message before it is reported as failed
+INLINE_SEEN_IDS = 1024 # Received inline message ids kept to drop repeats
+LEGACY_MAX_LENGTH = 2**32 - 1 # Without WIDE_OFFSETS lengths and insertion points are 4 bytes
+DEFAULT_RECV_MEMORY_BUDGET = 32 * 1024 * 1024 # bytes of not yet written parts, of all receiving transfers of a socket
+
 class Connection:
     def __init__(self, other_side: ConnSide, 
                  keychain: Keychain,
-                 send_proxy: Callable[[ConnSide, bytes], None],
+                 send_proxy: Callable[[ConnSide, list[bytes]], None],
                  handlers: Handlers,
+                 timers: Timers,
+                 congestion: Callable[[RttEstimator], CongestionController] = NewRenoController,
+                 recv_memory_budget: MemoryBudget | None = None,
+                 rate_limit: TokenBucket | None = None,
+                 max_datagram_size: int = LEGACY_DATAGRAM_SIZE,
+                 codecs: Iterable[int] = (),
+                 recv_max_window_bytes: int | None = None,
                  ) -> None:
         
         self.__other_side: ConnSide = other_side
@@ -38,14 +72,38 @@ class Connection:
         self.__keychain: Keychain = keychain
         self.__handlers: Handlers = handlers
         self.__send_proxy = send_proxy
+        self.__timers = timers
+        self.__checksum: Checksum = LEGACY_CHECKSUM
+        self.__features: Feature = Feature(0)
+        self.__codecs: list[int] = list(codecs) # What we offer, preferred first
+        self.__codec: Codec | None = None # Negotiated, None for no compression
+        self.__recv_datagram_size = max_datagram_size # What our socket receives, offered in the handshake
+        self.__max_datagram_size = LEGACY_DATAGRAM_SIZE # Negotiated, for both directions
+        self.__rtt = RttEstimator()
+        self.__congestion: CongestionController = congestion(self.__rtt)
+        if recv_memory_budget is None:
+            recv_memory_budget = MemoryBudget(DEFAULT_RECV_MEMORY_BUDGET)
+        self.recv_memory_budget = recv_memory_budget # Shared by the receiving transfers, usually with the whole socket
+        self.recv_max_window_bytes = recv_max_window_bytes # Cap of every receiving transfer on its own, None for no cap
+        self.__rate_limit = TokenBucket()
+        self.__pacer = Pacer(self.__rate_limit, *([rate_limit] if rate_limit is not None else []))
         self.conversation_status: ConversationStatus = ConversationStatus()
         
         self.__sequence_number = 0
-        self.__wait_for_acknowledgment: list[Packet] = []
+        self.__wait_for_acknowledgment: dict[int, Packet] = {}
+        self.__unacked_keep_alive = 0
         self.__last_time = time.time()
         self.__keep_alive = 10
+        self.__keep_alive_due = False
+        self.__keep_alive_timer: Timer = self.__timers.call_at(self.__last_time + self.__keep_alive, self.__on_keep_alive_timer)
 
         self.__transfers: dict[int, tuple[RecvTransfer | SendTransfer, BytesIO]] = {}
+        self.__owned_sources: set[int] = set() # Transfers reading files we opened, closed when they finish
+        self.__inline: dict[int, tuple[bytes, int, float, Timer, Callable[[bool], None] | None]] = {} # message id -> message, sends, last send, timer, on_sent
+        self.__inline_due: list[int] = []
+        self.__inline_seen: deque[int] = deque()
+        self.__inline_seen_set: set[int] = set()
+        self.__next_inline_id = randint(1, 2**16 - 1) # Ids are sequential, so a recent one comes back only after 65535 messages
 
         self._add_iterator = NotImplemented
 
@@ -55,6 +113,76 @@ class Connection:
     def other_side(self) -> ConnSide:
         return self.__other_side
     
+    @property
+    def checksum(self) -> Checksum:
+        return self.__checksum
+    
+    @property
+    def cipher(self) -> Cipher:
+        return self.__keychain.cipher
+    
+    @property
+    def codec(self) -> Codec | None:
+        """Compression of parts, None if the sides have no codec in common"""
+        return self.__codec
+    
+    @property
+    def rtt(self) -> RttEstimator:
+        """Round trip time and retransmission timeout, shared by all transfers of the connection"""
+        return self.__rtt
+    
+    @property
+    def congestion(self) -> CongestionController:
+        """Congestion window, shared by all transfers of the connection"""
+        return self.__congestion
+    
+    @property
+    def rate_limit(self) -> TokenBucket:
+        """Bandwidth cap of this connection, set `rate_limit.rate` in bytes per second"""
+        return self.__rate_limit
+    
+    @property
+    def pacer(self) -> Pacer:
+        return self.__pacer
+    
+    @property
+    def max_datagram_size(self) -> int:
+        return self.__max_datagram_size
+    
+    @property
+    def max_part_size(self) -> int:
+        """Largest part of a transfer, given the negotiated datagram size, checksum and cipher"""
+        codec_marker = CODEC_MARKER_SIZE if self.__codec is not None else 0
+        return max_part_size(self.__max_datagram_size, self.__checksum.size + self.__keychain.cipher.tag_size + codec_marker,
+                             self.__part_factory.INSERTION_POINT.size)
+    
+    @property
+    def __wide(self) -> bool:
+        return bool(self.__features & Feature.WIDE_OFFSETS)
+    
+    @property
+    def __resumable(self) -> bool:
+        return self.__features & RESUME_FEATURES == RESUME_FEATURES
+    
+    @property
+    def __part_factory(self) -> Type[SendPartPacket]:
+        return WideSendPartPacket if self.__wide else SendPartPacket
+    
+    @property
+    def __syn_send_file_factory(self) -> Type[SynSendFilePacket]:
+        if self.__resumable:
+            return ResumableSynSendFilePacket
+        return WideSynSendFilePacket if self.__wide else SynSendFilePacket
+    
+    def __check_length(self, length: int) -> None:
+        if length > LEGACY_MAX_LENGTH and not self.__wide:
+            LOG.error(f"{self.other_side} does not support data over 4 GiB")
+            raise ValueError(f"Data is too long for the other side ({length} bytes, max. {LEGACY_MAX_LENGTH})")
+    
+    @property
+    def features(self) -> Feature:
+        return self.__features
+    
     @property
     def transfers_count(self) -> int:
         return len(self.__transfers)
@@ -75,15 +203,25 @@ class Connection:
         packet.data = data
         return packet
 
+    def _recv_batch(self, datagrams: list[memoryview]) -> None:
+        """Process datagrams received in one wakeup. They live in the socket's reusable buffers, so nothing may keep a reference to them"""
+        for data in datagrams:
+            self._recv(data)
+
     def _recv(self, data: bytes) -> None:
         self.__sequence_number += 1
         self.__last_time = time.time()
 
-        packet = Packet().load(data)
+        if len(data) < HEADER_SIZE:
+            LOG.warning(f"Packet is too short")
+            return
+
+        checksum = LEGACY_CHECKSUM if data[8] in _HANDSHAKE_FLAGS else self.__checksum
+        packet = Packet.from_datagram(data, checksum)
 
         LOG.debug(f"Recived {len(data)} bytes from {self.other_side} with {packet.header.flags.__repr__()} flags")
 
-        if not packet.is_packet_valid:
+        if not checksum.verify(data):
             self._send(self._build_packet(Flags.UNACK, packet.header.seq_number))
             LOG.warning(f"Packet is not valid")
             return
@@ -96,12 +234,13 @@ class Connection:
             return
         
         packet._private_key = self.__keychain.private_key
+        packet._cipher = self.__keychain.cipher
 
         if packet.header.transfer_id in self.__transfers:
             transfer, buffer = self.__transfers[packet.header.transfer_id]
-            transfer._recv(packet.downcast(SendPartPacket))
+            transfer._recv(packet.downcast(self.__part_factory))
             return
-        self.__packet_queue.append(packet)
+        self.__packet_queue.append(packet.detach())
 
     
     def _send(self, packet: Packet) -> None:
@@ -109,10 +248,20 @@ class Connection:
             self._size_of_accepted_headers += HEADER_SIZE
 
         LOG.debug(f"Sending {packet.header.flags.__repr__()} flags to {self.other_side}")
-        self.__send_proxy(self.other_side, packet.dump())
+        checksum = LEGACY_CHECKSUM if packet.header.flags in _HANDSHAKE_FLAGS else self.__checksum
+        buffers = packet.dump_vector(checksum)
+        self.__send_proxy(self.other_side, buffers)
+
+        is_data = packet.header.flags == (Flags.SEND | Flags.PART)
+        if is_data:
+            self.__pacer.update(self.__congestion.window, self.__rtt.srtt)
+        self.__pacer.consume(sum(map(len, buffers)), data=is_data)
         if packet.header.transfer_id != 0:
             return
-        self.__wait_for_acknowledgment.append(packet)
+        if packet.header.flags not in (Flags.ACK, Flags.FIN | Flags.ACK): # Nobody acknowledges acknowledgments
+            self.__wait_for_acknowledgment[packet.header.seq_number] = packet
+            if packet.header.flags == (Flags.ACK | Flags.UNACK):
+                self.__unacked_keep_alive += 1
         self.conversation_status.new_packet(packet)
     
     def connect(self) -> None:
@@ -121,6 +270,19 @@ class Connection:
         packet = self._build_packet(Flags.SYN, packet_factory=SynPacket)
         packet.public_key = self.__keychain.public_key
 
+        options = Options()
+        options.checksums = PREFERRED_CHECKSUMS
+        options.ciphers = self.__keychain.ciphers
+        options.features = SUPPORTED_FEATURES
+        options.max_datagram = self.__recv_datagram_size
+        options.codecs = self.__codecs
+        packet.options = options
+
+        self.__checksum = LEGACY_CHECKSUM # Until the other side answers
+        self.__codec = None
+        self.__keychain.cipher = XOR_CIPHER
+        self.__features = Feature(0)
+        self.__max_datagram_size = LEGACY_DATAGRAM_SIZE
         self._send(packet)
     
     def disconnect(self) -> None:
@@ -132,28 +294,113 @@ class Connection:
         packet = self._build_packet(Flags.FIN)
         self._send(packet)
     
-    def send_message(self, message: bytes, fragment_size: int | None = None) -> SendTransfer:
+    def send_message(self, message: bytes, fragment_size: int | None = None, on_sent: Callable[[bool], None] | None = None) -> SendTransfer | None:
+        """
+        A message that fits in one part goes inline in its SYN when the other side supports it,
+        there is no transfer then and None is returned. `on_message_send` reports both, as does
+        `on_sent(is_correct)` (the transfer's `on_sent` otherwise).
+        """
         if not self.conversation_status.is_connected:
             LOG.error(f"Connection is not established")
             raise Exception("Connection is not established")
 
+        if self.__features & Feature.INLINE and len(message) <= min(fragment_size or self.max_part_size, self.max_part_size):
+            self.__send_inline(bytes(message), on_sent)
+            return None
+        return self.__send_message_transfer(message, fragment_size, on_sent)
+    
+    def __send_message_transfer(self, message: bytes, fragment_size: int | None = None, on_sent: Callable[[bool], None] | None = None) -> SendTransfer:
+        self.__check_length(len(message))
         bio = BytesIO(message)
 
-        transfer = SendTransfer(self.__keychain.copy(), bio, Flags.MSG, fragment_size)
-        transfer._send = self._send
-        transfer._build_packet = self._build_packet
+        transfer = SendTransfer(self.__keychain.copy(), bio, Flags.MSG, fragment_size, self.max_part_size)
+        transfer.on_sent = on_sent
 
         packet = self._build_packet(
             Flags.SYN | Flags.SEND | Flags.MSG,
-            packet_factory=SynSendMsgPacket
+            packet_factory=WideSynSendMsgPacket if self.__wide else SynSendMsgPacket
         )
         packet._public_key = self.__keychain.other_public_key
+        packet._cipher = self.__keychain.cipher
         packet.message_len = len(message)
         packet.header.transfer_id = transfer.transfer_id
         self._send(packet.encrypt())
 
-        self.__transfers[transfer.transfer_id] = (transfer, bio)
-        self._add_iterator(transfer._iterate)
+        self._register_transfer(transfer, bio)
+
+        return transfer
+    
+    def __send_inline(self, message: bytes, on_sent: Callable[[bool], None] | None = None) -> None:
+        message_id = self.__next_inline_id
+        while message_id in self.__inline or message_id in self.__transfers:
+            message_id = message_id % (2**16 - 1) + 1
+        self.__next_inline_id = message_id % (2**16 - 1) + 1
+        self.__inline[message_id] = message, 0, 0.0, None, on_sent
+        self.__resend_inline(message_id)
+    
+    def __resend_inline(self, message_id: int) -> None:
+        message, sends, _, _, on_sent = self.__inline[message_id]
+        if sends >= INLINE_MAX_TRIES:
+            LOG.warning(f"Inline message {message_id} to {self.other_side} was not acknowledged")
+            self.__fail_inline(message_id)
+            return
+        if sends:
+            self.__rtt.backoff()
+
+        packet = self._build_packet(_INLINE, packet_factory=InlineMsgPacket)
+        packet._public_key = self.__keychain.other_public_key
+        packet._cipher = self.__keychain.cipher
+        packet.message = message
+        packet.header.transfer_id = message_id
+        self._send(packet.encrypt())
+
+        now = time.time()
+        timer = self.__timers.call_at(now + self.__rtt.rto, lambda: self.__inline_due.append(message_id))
+        self.__inline[message_id] = message, sends + 1, now, timer, on_sent
+    
+    def __complete_inline(self, message_id: int) -> None:
+        message, sends, sent_at, timer, on_sent = self.__inline.pop(message_id)
+        self.__timers.cancel(timer)
+        if sends == 1: # Karn's rule
+            self.__rtt.sample(time.time() - sent_at)
+        self.__handlers.on_message_send(self, message, True)
+        if on_sent is not None:
+            on_sent(True)
+    
+    def __fail_inline(self, message_id: int) -> None:
+        message, _, _, timer, on_sent = self.__inline.pop(message_id)
+        self.__timers.cancel(timer)
+        self.__handlers.on_message_send(self, message, False)
+        if on_sent is not None:
+            on_sent(False)
+    
+    def send_stream(self, chunks: Iterable[bytes] | ChunkSource, fragment_size: int | None = None) -> SendTransfer:
+        """
+        Send a message of unknown length, read from `chunks` (or a fed ChunkSource) as the window
+        allows. The receiver gets it piece by piece in `on_message_chunk`. Peers without streams get
+        one message, a fed source can not wait for its end for them.
+        """
+        if not self.conversation_status.is_connected:
+            LOG.error(f"Connection is not established")
+            raise Exception("Connection is not established")
+        
+        if self.__features & STREAM_FEATURES != STREAM_FEATURES:
+            if isinstance(chunks, ChunkSource):
+                raise ValueError(f"{self.other_side} can not receive streams")
+            LOG.info(f"{self.other_side} can not receive streams, sending the whole message")
+            return self.__send_message_transfer(b''.join(chunks), fragment_size) # Never inline, callers get a transfer
+
+        source = chunks if isinstance(chunks, ChunkSource) else ChunkSource(chunks)
+        transfer = SendTransfer(self.__keychain.copy(), source, Flags.MSG, fragment_size, self.max_part_size)
+
+        packet = self._build_packet(Flags.SYN | Flags.SEND | Flags.MSG, packet_factory=WideSynSendMsgPacket)
+        packet._public_key = self.__keychain.other_public_key
+        packet._cipher = self.__keychain.cipher
+        packet.message_len = STREAM_MESSAGE_LEN
+        packet.header.transfer_id = transfer.transfer_id
+        self._send(packet.encrypt())
+
+        self._register_transfer(transfer, source)
 
         return transfer
     
@@ -165,63 +412,163 @@ class Connection:
         file_io.seek(0, SEEK_END)
         file_size = file_io.tell()
         file_io.seek(0)
+        self.__check_length(file_size)
 
-        transfer = SendTransfer(self.__keychain.copy(), file_io, Flags.FILE, fragment_size)
-        transfer._send = self._send
-        transfer._build_packet = self._build_packet
+        transfer = SendTransfer(self.__keychain.copy(), file_io, Flags.FILE, fragment_size, self.max_part_size)
 
         packet = self._build_packet(
             Flags.SYN | Flags.SEND | Flags.FILE,
-            packet_factory=SynSendFilePacket
+            packet_factory=self.__syn_send_file_factory
         )
         packet._public_key = self.__keychain.other_public_key
+        packet._cipher = self.__keychain.cipher
         packet.filename = file_io.name
         packet.data_len = file_size
+        if self.__resumable:
+            packet.content_id = content_id(file_io)
 
         packet.header.transfer_id = transfer.transfer_id
         self._send(packet.encrypt())
 
-        self.__transfers[transfer.transfer_id] = (transfer, file_io)
-        self._add_iterator(transfer._iterate)
+        self._register_transfer(transfer, file_io)
 
         return transfer
     
-    def _keep_alive(self) -> bool:
-        unuck_keep_alive = [packet for packet in self.__wait_for_acknowledgment if packet.header.flags == (Flags.ACK | Flags.UNACK)]
+    def send_files(self, paths: Iterable[str | os.PathLike], root: str | os.PathLike | None = None, fragment_size: int | None = None) -> list[SendTransfer]:
+        """
+        Send many files as one transfer (a bundle): one setup, one window, one iterator.
+        Files are named by their path relative to `root`, or by their basename without it.
+        Peers without bundles get a transfer per file.
+        """
+        if not self.conversation_status.is_connected:
+            LOG.error(f"Connection is not established")
+            raise Exception("Connection is not established")
+        
+        paths = list(paths)
+        if self.__features & BUNDLE_FEATURES != BUNDLE_FEATURES:
+            LOG.info(f"{self.other_side} can not receive bundles, sending {len(paths)} files one by one")
+            transfers = []
+            for path in paths:
+                file_io = open(path, 'rb')
+                try:
+                    transfers.append(self.send_file(file_io, fragment_size))
+                except BaseException:
+                    file_io.close()
+                    raise
+                self.__owned_sources.add(transfers[-1].transfer_id)
+            return transfers
+        
+        names = [os.path.relpath(path, root) if root is not None else os.path.basename(path) for path in paths]
+        source = BundleSource(paths, [name.replace(os.sep, '/') for name in names])
+        length = source.seek(0, SEEK_END)
+        source.seek(0)
+
+        transfer = SendTransfer(self.__keychain.copy(), source, _BUNDLE, fragment_size, self.max_part_size)
+
+        packet = self._build_packet(Flags.SYN | Flags.SEND | _BUNDLE, packet_factory=SynSendBundlePacket)
+        packet._public_key = self.__keychain.other_public_key
+        packet._cipher = self.__keychain.cipher
+        packet.message_len = length
+        packet.header.transfer_id = transfer.transfer_id
+        self._send(packet.encrypt())
+
+        self._register_transfer(transfer, source)
 
-        if len(unuck_keep_alive) > 3:
+        return [transfer]
+    
+    def send_directory(self, directory: str | os.PathLike, fragment_size: int | None = None) -> list[SendTransfer]:
+        """All files under `directory` in one bundle, named by their path relative to it"""
+        paths = [os.path.join(dirpath, filename) for dirpath, _, filenames in os.walk(directory) for filename in sorted(filenames)]
+        return self.send_files(paths, directory, fragment_size)
+    
+    def __on_keep_alive_timer(self) -> None:
+        deadline = self.__last_time + self.__keep_alive
+        if deadline > time.time():
+            # Something was received meanwhile, no need to wake up the iterator
+            self.__keep_alive_timer = self.__timers.call_at(deadline, self.__on_keep_alive_timer)
+            return
+        self.__keep_alive_due = True
+    
+    def _keep_alive(self) -> bool:
+        if self.__unacked_keep_alive > 3:
             LOG.error(f"[_keep_alive] Connection is not established or is broken")
             self.disconnect()
             self.conversation_status.is_incorrect_disconnected = True
             return False
 
-        if not self.conversation_status.is_connected and time.time() - self.__last_time > self.__keep_alive:
-            self.connect()
-            self.__last_time = time.time()
+        if not self.__keep_alive_due:
             return True
-
-        if time.time() - self.__last_time > self.__keep_alive:
+        
+        self.__keep_alive_due = False
+        if not self.conversation_status.is_connected:
+            self.connect()
+        else:
             self._send(self._build_packet(Flags.ACK | Flags.UNACK))
-            self.__last_time = time.time()
+        self.__last_time = time.time()
+        self.__keep_alive_timer = self.__timers.call_at(self.__last_time + self.__keep_alive, self.__on_keep_alive_timer)
         return True
     
+    def _register_transfer(self, transfer: RecvTransfer | SendTransfer, io_: BytesIO) -> None:
+        transfer._send = self._send
+        transfer._build_packet = self._build_packet
+        transfer._timers = self.__timers
+        transfer._rtt = self.__rtt
+        transfer._congestion = self.__congestion
+        transfer._pacer = self.__pacer
+        transfer._features = self.__features
+        transfer._codec = self.__codec
+        self.__transfers[transfer.transfer_id] = transfer, io_
+        self._add_iterator(transfer._iterate)
+
     def _send_ack(self, packet: Packet) -> None:
         self._send(self._build_packet(Flags.ACK, packet.header.seq_number))
     
     def _recv_ack(self, packet: Packet) -> None:
-        self.__wait_for_acknowledgment = [p for p in self.__wait_for_acknowledgment if p.header.seq_number != packet.header.ack_number]
+        if packet.header.transfer_id in self.__inline:
+            self.__complete_inline(packet.header.transfer_id)
+            return
+        acked = self.__wait_for_acknowledgment.pop(packet.header.ack_number, None)
+        if acked is not None and acked.header.flags == (Flags.ACK | Flags.UNACK):
+            self.__unacked_keep_alive -= 1
     
     def _process_syn(self, packet: SynPacket) -> None:
         self.__keychain.other_public_key = packet.public_key
 
+        offer = packet.options
+        checksum = choose_checksum(offer.checksums)
+        self.__keychain.cipher = choose_cipher(offer.ciphers, self.__keychain.ciphers)
+        features = offer.features & SUPPORTED_FEATURES
+        max_datagram_size = min(offer.max_datagram, self.__recv_datagram_size)
+        codec = choose_codec(offer.codecs, self.__codecs)
+
         new_packet = self._build_packet(Flags.SYN | Flags.ACK, packet.header.seq_number, packet_factory=SynAckPacket)
         new_packet.public_key = self.__keychain.public_key
+        if len(offer): # Old peers send no options and expect none back
+            options = Options()
+            options.checksums = [checksum.id]
+            options.ciphers = [self.__keychain.cipher.id]
+            options.features = features
+            options.max_datagram = max_datagram_size
+            options.codecs = [codec.id] if codec is not None else []
+            new_packet.options = options
         
         self._send(new_packet)
+        self.__checksum = checksum
+        self.__features = features
+        self.__max_datagram_size = max_datagram_size
+        self.__codec = codec
+        LOG.debug(f"Using {checksum.name} checksum, {self.__keychain.cipher.name} cipher, {codec} codec and features {features!r} with {self.other_side}")
         self.__handlers.on_connect(self) # TODO: Remake
     
     def _process_syn_ack(self, packet: SynAckPacket) -> None:
         self.__keychain.other_public_key = packet.public_key
+        options = packet.options
+        self.__checksum = choose_checksum(options.checksums)
+        self.__keychain.cipher = choose_cipher(options.ciphers, self.__keychain.ciphers)
+        self.__features = options.features & SUPPORTED_FEATURES
+        self.__max_datagram_size = min(options.max_datagram, self.__recv_datagram_size)
+        self.__codec = choose_codec(options.codecs, self.__codecs)
+        LOG.debug(f"Using {self.__checksum.name} checksum, {self.__keychain.cipher.name} cipher, {self.__codec} codec and features {self.__features!r} with {self.other_side}")
 
         self._send_ack(packet)
         self.__handlers.on_connect(self) # TODO: Remake
@@ -238,52 +585,138 @@ class Connection:
         self._send_ack(packet)
 
     def _process_syn_send(self, packet: Packet) -> None:
-        if packet.header.flags & Flags.MSG == Flags.MSG:
-            self._process_syn_send_msg(packet.downcast(SynSendMsgPacket))
+        if packet.header.flags == _INLINE:
+            self._process_inline_msg(packet.downcast(InlineMsgPacket))
+        elif packet.header.flags & _BUNDLE == _BUNDLE:
+            self._process_syn_send_bundle(packet.downcast(SynSendBundlePacket))
+        elif packet.header.flags & Flags.MSG == Flags.MSG:
+            self._process_syn_send_msg(packet.downcast(WideSynSendMsgPacket if self.__wide else SynSendMsgPacket))
         elif packet.header.flags & Flags.FILE == Flags.FILE:
-            self._process_syn_send_file(packet.downcast(SynSendFilePacket))
+            self._process_syn_send_file(packet.downcast(self.__syn_send_file_factory))
     
-    def _process_syn_send_msg(self, packet: SynSendMsgPacket) -> None:
+    def __decrypt(self, packet: Packet) -> bool:
+        """False if an authenticated cipher rejects the packet, it is dropped like one with a bad checksum"""
         packet._private_key = self.__keychain.private_key
-        packet.decrypt()
+        packet._cipher = self.__keychain.cipher
+        try:
+            packet.decrypt()
+        except CipherError:
+            LOG.warning(f"Packet from {self.other_side} can not be decrypted")
+            return False
+        return True
+    
+    def _process_syn_send_msg(self, packet: SynSendMsgPacket) -> None:
+        if not self.__decrypt(packet):
+            return
 
-        bio = BytesIO(b'')
+        if packet.is_stream_end:
+            return # Repeated end of a stream that is already complete
+
+        transfer_id = packet.header.transfer_id
+        length = packet.message_len
+        if self.__features & STREAM_FEATURES == STREAM_FEATURES and packet.is_stream:
+            bio = ChunkSink(lambda chunk: self.__handlers.on_message_chunk(self, transfer_id, chunk))
+            length = None
+        else:
+            bio = BytesIO(b'')
         transfer = RecvTransfer(
-            packet.message_len,
-            packet.header.transfer_id,
+            length,
+            transfer_id,
             self.__keychain,
             bio,
-            Flags.MSG
+            Flags.MSG,
+            memory_budget=self.recv_memory_budget,
+            max_window_bytes=self.recv_max_window_bytes
         )
-        transfer._send = self._send
-        transfer._build_packet = self._build_packet
-        self.__transfers[packet.header.transfer_id] = transfer, bio
-        self._add_iterator(transfer._iterate)
+        self._register_transfer(transfer, bio)
+    
+    def _process_inline_msg(self, packet: InlineMsgPacket) -> None:
+        if not self.__features & Feature.INLINE:
+            return
+        if not self.__decrypt(packet):
+            return # Not acknowledged, the other side sends it again
+        ack = self._build_packet(Flags.ACK, packet.header.seq_number)
+        ack.header.transfer_id = packet.header.transfer_id
+        self._send(ack)
+
+        if packet.header.transfer_id in self.__inline_seen_set:
+            return # Our ACK was lost, the message was delivered already
+        self.__inline_seen.append(packet.header.transfer_id)
+        self.__inline_seen_set.add(packet.header.transfer_id)
+        if len(self.__inline_seen) > INLINE_SEEN_IDS:
+            self.__inline_seen_set.discard(self.__inline_seen.popleft())
+        self.__handlers.on_message_recv(self, packet.message, True)
     
     def _process_syn_send_file(self, packet: SynSendFilePacket) -> None:
-        packet._private_key = self.__keychain.private_key
-        packet.decrypt()
+        if not self.__decrypt(packet):
+            return
 
-        bio = NamedTemporaryFile('w+b', delete=True)
+        bio = self.__open_destination(packet.filename, packet.data_len, packet.content_id if self.__resumable else None)
         transfer = RecvTransfer(
             packet.data_len,
             packet.header.transfer_id,
             self.__keychain,
             bio,
             Flags.FILE,
-            packet.filename
+            packet.filename,
+            memory_budget=self.recv_memory_budget,
+            max_window_bytes=self.recv_max_window_bytes,
+            received=bio.received if isinstance(bio, FileSink) else ()
         )
-        transfer._send = self._send
-        transfer._build_packet = self._build_packet
-        self.__transfers[packet.header.transfer_id] = transfer, bio
-        self._add_iterator(transfer._iterate)
+        self._register_transfer(transfer, bio)
+
 
+    def _process_syn_send_bundle(self, packet: SynSendBundlePacket) -> None:
+        if self.__features & BUNDLE_FEATURES != BUNDLE_FEATURES:
+            return
+        if not self.__decrypt(packet):
+            return
+
+        bundle = BundleSink(self.__open_destination, self.__on_bundle_file)
+        transfer = RecvTransfer(
+            packet.message_len,
+            packet.header.transfer_id,
+            self.__keychain,
+            bundle,
+            _BUNDLE,
+            memory_budget=self.recv_memory_budget,
+            max_window_bytes=self.recv_max_window_bytes
+        )
+        self._register_transfer(transfer, bundle)
+    
+    def __open_destination(self, filename: str, length: int, content_id: bytes | None = None) -> FileSink | BytesIO:
+        destination = self.__handlers.on_file_destination(self, filename, length)
+        if destination is None:
+            return NamedTemporaryFile('w+b', delete=True)
+        if isinstance(destination, FileSink):
+            return destination
+        return FileSink(destination, length, content_id=content_id)
+    
+    def __on_bundle_file(self, filename: str, file: FileSink | BytesIO | None, is_correct: bool) -> None:
+        if isinstance(file, FileSink) and is_correct:
+            file.commit()
+        elif isinstance(file, FileSink):
+            file.abort()
+        self.__handlers.on_file_recv(self, file, filename, is_correct)
 
     def _iterate(self) -> IterationStatus:
         if self.conversation_status.is_disconnected and len(self.__transfers) == 0 or not self._keep_alive():
             for transfer_id, (transfer, io_) in list(self.__transfers.items()):
                 transfer.kill()
+                if isinstance(transfer, RecvTransfer) and isinstance(io_, FileSink):
+                    io_.suspend() # Removed unless it can be resumed
+                if isinstance(io_, BundleSink):
+                    io_.close()
+                if isinstance(transfer, SendTransfer) and transfer.on_sent is not None:
+                    transfer.on_sent(False)
+                if transfer_id in self.__owned_sources:
+                    self.__owned_sources.discard(transfer_id)
+                    io_.close()
             
+            for message_id in list(self.__inline):
+                self.__fail_inline(message_id)
+            
+            self.__timers.cancel(self.__keep_alive_timer)
             self.__handlers.on_disconnect(self)
             return IterationStatus.FINISHED
         
@@ -293,21 +726,42 @@ class Connection:
             
             if isinstance(transfer, RecvTransfer):
                 if transfer.data_type == Flags.MSG:
-                    self.__handlers.on_message_recv(self, io_.getvalue(), transfer.is_correct)
+                    message = b'' if isinstance(io_, ChunkSink) else io_.getvalue() # A stream went to on_message_chunk
+                    self.__handlers.on_message_recv(self, message, transfer.is_correct)
                 if transfer.data_type == Flags.FILE:
+                    if isinstance(io_, FileSink) and transfer.is_correct:
+                        io_.commit()
+                    elif isinstance(io_, FileSink):
+                        io_.suspend()
                     self.__handlers.on_file_recv(self, io_, transfer.filename, transfer.is_correct)
+                if transfer.data_type == _BUNDLE:
+                    io_.close() # Every complete file was reported already
                 del self.__transfers[transfer_id]
             if isinstance(transfer, SendTransfer) and transfer.done:
                 if transfer.data_type == Flags.MSG:
-                    self.__handlers.on_message_send(self, io_.getvalue(), transfer.is_correct)
+                    message = b'' if isinstance(io_, ChunkSource) else io_.getvalue()
+                    self.__handlers.on_message_send(self, message, transfer.is_correct)
                 if transfer.data_type == Flags.FILE:
                     self.__handlers.on_file_send(self, io_, transfer.filename, transfer.is_correct)
+                if transfer.data_type == _BUNDLE:
+                    for filename, _ in io_.manifest.files:
+                        self.__handlers.on_file_send(self, io_, filename, transfer.is_correct)
+                    io_.close()
+                if transfer.on_sent is not None:
+                    transfer.on_sent(transfer.is_correct)
+                if transfer_id in self.__owned_sources:
+                    self.__owned_sources.discard(transfer_id)
+                    io_.close()
                 del self.__transfers[transfer_id]
 
 
         while len(self.__packet_queue) > 0:
 
             packet = self.__packet_queue.pop(0)
+            if packet.header.transfer_id in self.__transfers: # Came in the same batch as the SYN of its transfer
+                transfer, _ = self.__transfers[packet.header.transfer_id]
+                transfer._recv(packet.downcast(self.__part_factory))
+                continue
             self.conversation_status.new_packet(packet)
             
             if packet.header.flags == Flags.SYN:
@@ -333,5 +787,10 @@ class Connection:
             
             if packet.header.flags & Flags.ACK:
                 self._recv_ack(packet)
+        
+        due, self.__inline_due = self.__inline_due, []
+        for message_id in due:
+            if message_id in self.__inline: # Not acknowledged meanwhile
+                self.__resend_inline(message_id)
     
         return IterationStatus.SLEEP
\ No newline at end of file
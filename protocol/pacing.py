@@ -0,0 +1,91 @@
+from time import time
+
+
+class TokenBucket:
+    """
+    Byte rate limit. Tokens refill at `rate` bytes per second up to `burst`. Sending more than
+    there is (packets that can not wait, like ACKs) leaves a debt the next sends wait for.
+    """
+    def __init__(self, rate: float | None = None, burst: int = 16 * 1024) -> None:
+        self.__rate = rate
+        self.__burst = burst
+        self.__tokens = float(burst)
+        self.__last = time()
+
+    @property
+    def rate(self) -> float | None:
+        """Bytes per second, None for no limit"""
+        return self.__rate
+
+    @rate.setter
+    def rate(self, rate: float | None) -> None:
+        if rate is not None and rate <= 0:
+            raise ValueError("Rate must be positive or None")
+        self.__refill(time())
+        self.__rate = rate
+
+    @property
+    def burst(self) -> int:
+        return self.__burst
+
+    def __refill(self, now: float) -> None:
+        if self.__rate is not None:
+            self.__tokens = min(self.__burst, self.__tokens + (now - self.__last) * self.__rate)
+        self.__last = now
+
+    def delay(self, size: int, now: float | None = None) -> float:
+        """Seconds until `size` bytes can be sent"""
+        if self.__rate is None:
+            return 0.0
+        self.__refill(now or time())
+        missing = min(size, self.__burst) - self.__tokens
+        return missing / self.__rate if missing > 0 else 0.0
+
+    def consume(self, size: int, now: float | None = None) -> None:
+        if self.__rate is None:
+            return
+        self.__refill(now or time())
+        self.__tokens -= size
+
+    def __repr__(self) -> str:
+        return f"TokenBucket(rate={self.__rate}, burst={self.__burst})"
+
+
+class Pacer:
+    """
+    Send gate of one connection: a pacing bucket following the congestion window
+    (`gain * window * average datagram / srtt`) and any number of caps, e.g. a per-connection
+    and a per-socket limit. Data is sent only when all of them allow it.
+    """
+    def __init__(self, *caps: TokenBucket, gain: float = 1.25) -> None:
+        self.__pacing = TokenBucket()
+        self.__buckets = (self.__pacing, *caps)
+        self.__gain = gain
+        self.__avg_size = 0.0
+
+    @property
+    def pacing_rate(self) -> float | None:
+        return self.__pacing.rate
+
+    def update(self, window: int, srtt: float | None) -> None:
+        """`window` in datagrams. Without a round trip measurement there is no pacing"""
+        if srtt is None or srtt <= 0 or not self.__avg_size:
+            self.__pacing.rate = None
+            return
+        self.__pacing.rate = self.__gain * max(1, window) * self.__avg_size / srtt
+
+    def delay(self, size: int, now: float | None = None) -> float:
+        now = now or time()
+        return max(bucket.delay(size, now) for bucket in self.__buckets)
+
+    def consume(self, size: int, now: float | None = None, data: bool = True) -> None:
+        """Only `data` datagrams count for the average size the pacing rate is based on"""
+        now = now or time()
+        if data:
+            self.__avg_size = size if not self.__avg_size else self.__avg_size * 0.875 + size * 0.125
+        for bucket in self.__buckets:
+            bucket.consume(size, now)
+
+    def __repr__(self) -> str:
+        rate = f"{self.pacing_rate:.0f}B/s" if self.pacing_rate else None
+        return f"Pacer(pacing_rate={rate}, caps={list(self.__buckets[1:])})"
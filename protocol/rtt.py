@@ -0,0 +1,76 @@
+from time import time
+
+
+class RttEstimator:
+    """
+    Smoothed round trip time and retransmission timeout of one connection (RFC 6298).
+    Samples must come only from packets that were sent once (Karn's rule), a retransmitted
+    packet can not tell which of its copies was acknowledged.
+    """
+    ALPHA = 1 / 8
+    BETA = 1 / 4
+    K = 4
+
+    def __init__(self,
+                 initial_rto: float = 1.0,
+                 min_rto: float = 0.05,
+                 max_rto: float = 4.0,
+                 granularity: float = 0.001) -> None:
+        self.__srtt: float | None = None
+        self.__rttvar: float | None = None
+        self.__initial_rto = initial_rto
+        self.__min_rto = min_rto
+        self.__max_rto = max_rto
+        self.__granularity = granularity
+        self.__backoff = 1
+        self.__last_backoff = 0.0
+        self.__samples = 0
+
+    @property
+    def srtt(self) -> float | None:
+        return self.__srtt
+
+    @property
+    def rttvar(self) -> float | None:
+        return self.__rttvar
+
+    @property
+    def samples(self) -> int:
+        return self.__samples
+
+    @property
+    def rto(self) -> float:
+        if self.__srtt is None:
+            rto = self.__initial_rto
+        else:
+            rto = self.__srtt + max(self.__granularity, self.K * self.__rttvar)
+        return min(self.__max_rto, max(self.__min_rto, rto) * self.__backoff)
+
+    def sample(self, rtt: float) -> None:
+        if rtt < 0:
+            return
+        if self.__srtt is None:
+            self.__srtt = rtt
+            self.__rttvar = rtt / 2
+        else:
+            self.__rttvar = (1 - self.BETA) * self.__rttvar + self.BETA * abs(self.__srtt - rtt)
+            self.__srtt = (1 - self.ALPHA) * self.__srtt + self.ALPHA * rtt
+        self.__backoff = 1
+        self.__samples += 1
+
+    def backoff(self, now: float | None = None) -> None:
+        """
+        Double the timeout after a retransmission timeout. Every packet of a window has its
+        own timer, so timeouts within one RTO of the last backoff count as the same loss.
+        """
+        if now is None:
+            now = time()
+        if now - self.__last_backoff < self.rto:
+            return
+        self.__last_backoff = now
+        if self.rto < self.__max_rto:
+            self.__backoff *= 2
+
+    def __repr__(self) -> str:
+        srtt = f"{self.__srtt * 1000:.1f}ms" if self.__srtt is not None else None
+        return f"RttEstimator(srtt={srtt}, rto={self.rto * 1000:.1f}ms, samples={self.__samples})"
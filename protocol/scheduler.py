@@ -0,0 +1,214 @@
+import logging
+
+from abc import ABC, abstractmethod
+from time import perf_counter
+from typing import Callable, Hashable, Iterable
+
+from .types.iterator_stats import IteratorStats
+from .types.iteration_status import IterationStatus
+
+
+LOG = logging.getLogger("Scheduler")
+
+class Scheduler(ABC):
+    """
+    Decides how much time every iterator gets in one pass of Socket.iterate_loop.
+    Iterators are grouped into flows (one flow per connection), the receive iterator
+    of the socket is kept apart so it can always get its share.
+    """
+    def __init__(self) -> None:
+        self._receiver: Callable[[], IterationStatus] = None
+        self._flows: dict[Hashable, dict[Callable, float]] = {}
+        self._flow_weights: dict[Hashable, float] = {}
+        self._flow_of: dict[Callable, Hashable] = {}
+        self._stats: dict[Callable, IteratorStats] = {}
+
+    @property
+    def stats(self) -> list[IteratorStats]:
+        return list(self._stats.values())
+    
+    def __len__(self) -> int:
+        return len(self._flow_of) + (self._receiver is not None)
+
+    def set_receiver(self, iterator: Callable[[], IterationStatus]) -> None:
+        self._receiver = iterator
+        self._stats[iterator] = IteratorStats(self._name_of(iterator))
+
+    def add(self, iterator: Callable[[], IterationStatus], flow: Hashable = None, weight: float = 1.0) -> None:
+        if weight <= 0:
+            raise ValueError("Weight must be positive")
+        self._flows.setdefault(flow, {})[iterator] = weight
+        self._flow_weights.setdefault(flow, 1.0)
+        self._flow_of[iterator] = flow
+        self._stats[iterator] = IteratorStats(self._name_of(iterator), flow, weight)
+
+    def remove(self, iterator: Callable[[], IterationStatus]) -> None:
+        self._stats.pop(iterator, None)
+        if iterator is self._receiver:
+            self._receiver = None
+            return
+        
+        if iterator not in self._flow_of:
+            return
+        flow = self._flow_of.pop(iterator)
+        iterators = self._flows.get(flow, {})
+        iterators.pop(iterator, None)
+        if not iterators:
+            self._flows.pop(flow, None)
+            self._flow_weights.pop(flow, None)
+    
+    def clear(self) -> None:
+        self._receiver = None
+        self._flows = {}
+        self._flow_weights = {}
+        self._flow_of = {}
+        self._stats = {}
+
+    def set_weight(self, iterator: Callable[[], IterationStatus], weight: float) -> None:
+        if weight <= 0:
+            raise ValueError("Weight must be positive")
+        flow = self._flow_of.get(iterator)
+        if iterator in self._flows.get(flow, {}):
+            self._flows[flow][iterator] = weight
+            self._stats[iterator].weight = weight
+
+    def set_flow_weight(self, flow: Hashable, weight: float) -> None:
+        if weight <= 0:
+            raise ValueError("Weight must be positive")
+        if flow in self._flows:
+            self._flow_weights[flow] = weight
+
+    def _run(self, iterator: Callable[[], IterationStatus], budget: float, max_calls: int,
+             on_finished: Callable[[Callable], None]) -> tuple[IterationStatus, float]:
+        """Call the iterator while it is BUSY, until it spent the budget (seconds) or made max_calls"""
+        stats = self._stats.get(iterator)
+        if stats is None:
+            return IterationStatus.SLEEP, 0.0 # Removed meanwhile
+        
+        spent = 0.0
+        calls = 0
+        status = IterationStatus.SLEEP
+        start = perf_counter()
+        while calls < max_calls:
+            status = iterator()
+            calls += 1
+            if status != IterationStatus.BUSY:
+                break
+            stats.busy_calls += 1
+            spent = perf_counter() - start
+            if spent >= budget:
+                break
+        spent = perf_counter() - start
+        
+        stats.calls += calls
+        stats.slices += 1
+        stats.time += spent
+
+        if status == IterationStatus.FINISHED:
+            on_finished(iterator)
+        return status, spent
+
+    @abstractmethod
+    def iterate(self, on_finished: Callable[[Callable], None]) -> bool:
+        """Make one pass over all iterators. Returns True if any of them still has work to do"""
+
+    def iterate_flows(self, flows: Iterable[Hashable], on_finished: Callable[[Callable], None],
+                      budget: float = 0.001) -> bool:
+        """
+        Run only the iterators of some flows, e.g. the connections that just received a datagram,
+        each while it is BUSY for up to `budget` seconds. Returns True if any of them still has work to do
+        """
+        busy = False
+        for flow in flows:
+            for iterator in list(self._flows.get(flow, ())):
+                status, _ = self._run(iterator, budget, float('inf'), on_finished)
+                busy |= status != IterationStatus.SLEEP
+        return busy
+
+    @staticmethod
+    def _name_of(iterator: Callable) -> str:
+        owner = getattr(iterator, '__self__', None)
+        if owner is None:
+            return getattr(iterator, '__qualname__', repr(iterator))
+        return f"{type(owner).__name__}@{id(owner):x}"
+
+
+class FixedBudgetScheduler(Scheduler):
+    """Every iterator gets up to `budget` BUSY calls per pass, in the order they were added"""
+    def __init__(self, budget: int = 40) -> None:
+        super().__init__()
+        self.__budget = budget
+    
+    def iterate(self, on_finished: Callable[[Callable], None]) -> bool:
+        busy = False
+        iterators = [self._receiver] if self._receiver is not None else []
+        for flow_iterators in list(self._flows.values()):
+            iterators.extend(list(flow_iterators))
+        
+        for iterator in iterators:
+            status, _ = self._run(iterator, float('inf'), self.__budget, on_finished)
+            busy |= status != IterationStatus.SLEEP
+        return busy
+
+
+class DeficitRoundRobinScheduler(Scheduler):
+    """
+    Deficit round robin over time slices.
+    Each pass every flow (connection) earns `quantum * flow weight` seconds, split between
+    its iterators by their weights, so a connection gets the same share however many
+    transfers it has. Iterators with nothing to do lose their deficit.
+    The receive iterator runs at the start of the pass and again whenever `recv_interval`
+    seconds were spent on other iterators.
+    """
+    def __init__(self, quantum: float = 0.001, recv_interval: float = 0.002,
+                 recv_max_calls: int = 16, max_calls: int = 1000) -> None:
+        super().__init__()
+        self.__quantum = quantum
+        self.__recv_interval = recv_interval
+        self.__recv_max_calls = recv_max_calls
+        self.__max_calls = max_calls
+        self.__deficits: dict[Callable, float] = {}
+
+    def remove(self, iterator: Callable[[], IterationStatus]) -> None:
+        super().remove(iterator)
+        self.__deficits.pop(iterator, None)
+    
+    def clear(self) -> None:
+        super().clear()
+        self.__deficits = {}
+
+    def __drain_receiver(self, on_finished: Callable[[Callable], None]) -> bool:
+        if self._receiver is None:
+            return False
+        status, _ = self._run(self._receiver, float('inf'), self.__recv_max_calls, on_finished)
+        return status != IterationStatus.SLEEP
+
+    def iterate(self, on_finished: Callable[[Callable], None]) -> bool:
+        busy = self.__drain_receiver(on_finished)
+        since_recv = 0.0
+
+        for flow, iterators in list(self._flows.items()):
+            flow_share = self.__quantum * self._flow_weights.get(flow, 1.0)
+            iterators = list(iterators.items())
+            total_weight = sum(weight for _, weight in iterators)
+
+            for iterator, weight in iterators:
+                deficit = self.__deficits.get(iterator, 0.0) + flow_share * weight / total_weight
+                if deficit <= 0:
+                    self.__deficits[iterator] = deficit # Still paying for an earlier overrun
+                    busy = True
+                    continue
+                
+                status, spent = self._run(iterator, deficit, self.__max_calls, on_finished)
+                since_recv += spent
+                if status == IterationStatus.BUSY:
+                    self.__deficits[iterator] = deficit - spent
+                    busy = True
+                else:
+                    self.__deficits.pop(iterator, None)
+                    busy |= status == IterationStatus.FINISHED
+                
+                if since_recv >= self.__recv_interval:
+                    busy |= self.__drain_receiver(on_finished)
+                    since_recv = 0.0
+        return busy
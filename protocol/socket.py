@@ -3,28 +3,83 @@ import socket
 import logging
 import time
 
+from functools import partial
+from collections import deque
 from selectors import DefaultSelector, EVENT_READ, EVENT_WRITE
-from typing import Generator, Callable
+from typing import Generator, Callable, Hashable
 
 from protocol.types.keychain import Keychain
+from .cipher import Cipher
+from .compression import Codec, PREFERRED_CODECS
+from .rtt import RttEstimator
+from .timers import Timers
+from .congestion import CongestionController, NewRenoController
+from .pacing import TokenBucket
+from .budget import MemoryBudget
+from .scheduler import Scheduler, DeficitRoundRobinScheduler
 from .types.iteration_status import IterationStatus
 from .types.conn_side import ConnSide
 from .utils import genereate_keys
-from .connection import Connection
+from .connection import Connection, DEFAULT_RECV_MEMORY_BUDGET
+from .transfers.send import SendTransfer
+from .transfers.recv import RecvTransfer
 from .types.handlers import Handlers
+from .types.socket_stats import SocketStats
+from .types.options import LEGACY_DATAGRAM_SIZE, MAX_DATAGRAM_SIZE as MAX_UDP_DATAGRAM_SIZE
 
 LOG = logging.getLogger("Socket")
 
+MAX_DATAGRAM_SIZE = LEGACY_DATAGRAM_SIZE
+SOCKET_BUFFER_SIZE = 4 * 1024 * 1024 # Kernel buffers for large datagrams, a few windows of them
+_HAS_SENDMSG = hasattr(socket.socket, 'sendmsg') # Not on Windows
+
 class Socket:
-    def __init__(self, ip: str, port: int) -> None:
+    def __init__(self, ip: str, port: int, recv_batch_size: int = 64, scheduler: Scheduler | None = None,
+                 ciphers: list[Cipher] | None = None,
+                 congestion: Callable[[RttEstimator], CongestionController] = NewRenoController,
+                 recv_memory_budget: int | None = DEFAULT_RECV_MEMORY_BUDGET,
+                 max_rate: float | None = None,
+                 max_datagram_size: int | None = None,
+                 codecs: list[Codec] | None = None,
+                 recv_max_window_bytes: int | None = None) -> None:
+        if recv_batch_size <= 0:
+            raise ValueError("Receive batch size must be positive")
+        if recv_max_window_bytes is not None and recv_max_window_bytes <= 0:
+            raise ValueError("Receive window cap must be positive or None")
+
         self._bound_on: ConnSide = ConnSide(ip, port)
         self._keychain: Keychain = Keychain(*genereate_keys())
+        if ciphers:
+            self._keychain.ciphers = [cipher.id for cipher in ciphers]
         self._socket: socket = None
         self._socket_selector: DefaultSelector = None
 
-        self._iterators_queue: list[Callable] = []
-        self._connections: list[Connection] = []
+        self._scheduler: Scheduler = scheduler or DeficitRoundRobinScheduler()
+        self._congestion = congestion # Factory, every connection gets its own controller
+        self._recv_memory_budget: MemoryBudget = MemoryBudget(recv_memory_budget) # Shared by all receiving transfers, bytes
+        self._recv_max_window_bytes = recv_max_window_bytes # Cap of every receiving transfer on its own, bytes
+        self._rate_limit: TokenBucket = TokenBucket(max_rate) # Shared by all connections, bytes per second
+        self._timers: Timers = Timers(self._wakeup)
+        self._connections: dict[tuple[int, int], Connection] = {}
         self._handlers: Handlers = Handlers()
+        self._calls: deque[tuple[Callable, tuple]] = deque() # Handed over by other threads, run by the loop
+
+        self._wakeup_recv: socket.socket = None
+        self._wakeup_send: socket.socket = None
+
+        self._recv_batch_size = recv_batch_size
+        if max_datagram_size is None: # Loopback never fragments, other links keep the safe size
+            max_datagram_size = MAX_UDP_DATAGRAM_SIZE if ip.startswith("127.") else LEGACY_DATAGRAM_SIZE
+        if not LEGACY_DATAGRAM_SIZE <= max_datagram_size <= MAX_UDP_DATAGRAM_SIZE:
+            raise ValueError(f"Max datagram size must be between {LEGACY_DATAGRAM_SIZE} and {MAX_UDP_DATAGRAM_SIZE}")
+        self._max_datagram_size = max_datagram_size # Offered to peers, negotiated per connection
+        self._codecs: list[int] = PREFERRED_CODECS if codecs is None else [codec.id for codec in codecs] # Empty for no compression
+        self._recv_buffers: list[memoryview] = [memoryview(bytearray(max_datagram_size)) for _ in range(recv_batch_size)]
+        self._stats: SocketStats = SocketStats(recv_batch_size=recv_batch_size)
+
+        self._clear_connections_interval = 10
+        self._clear_connections_timer = None
+        self._max_wait = 1
 
         self.emulate_problems = False
 
@@ -43,12 +98,45 @@ class Socket:
     
     @property
     def connections(self) -> list[Connection]:
-        return self._connections
+        return list(self._connections.values())
     
     @property
     def speed(self) -> tuple[int, int]:
         return self._send_per_second, self._recv_per_second
     
+    @property
+    def stats(self) -> SocketStats:
+        return self._stats
+    
+    @property
+    def rate_limit(self) -> TokenBucket:
+        """Bandwidth cap of the whole socket, set `rate_limit.rate` in bytes per second (None for no limit)"""
+        return self._rate_limit
+    
+    @property
+    def recv_memory_budget(self) -> MemoryBudget:
+        """Received parts waiting to be written, of all connections. `None` limit for no limit"""
+        return self._recv_memory_budget
+    
+    @property
+    def max_datagram_size(self) -> int:
+        """Largest datagram this socket receives, each connection uses the smaller of both sides"""
+        return self._max_datagram_size
+    
+    @property
+    def timers(self) -> Timers:
+        return self._timers
+    
+    @property
+    def scheduler(self) -> Scheduler:
+        return self._scheduler
+    
+    def set_connection_weight(self, side: ConnSide, weight: float) -> None:
+        self._scheduler.set_flow_weight(side.key, weight)
+    
+    def set_transfer_weight(self, transfer: SendTransfer | RecvTransfer, weight: float) -> None:
+        self._scheduler.set_weight(transfer._iterate, weight)
+    
     def on_connect(self, func: Callable) -> Callable:
         self._handlers.on_connect = func
         return func
@@ -61,6 +149,14 @@ class Socket:
         self._handlers.on_message_send = func
         return func
     
+    def on_message_chunk(self, func: Callable) -> Callable:
+        self._handlers.on_message_chunk = func
+        return func
+    
+    def on_file_destination(self, func: Callable) -> Callable:
+        self._handlers.on_file_destination = func
+        return func
+    
     def on_file_recv(self, func: Callable) -> Callable:
         self._handlers.on_file_recv = func
         return func
@@ -73,152 +169,276 @@ class Socket:
         self._handlers.on_disconnect = func
         return func
 
+    def _connection_handlers(self) -> Handlers:
+        """What connections call, the handlers set with the decorators above"""
+        return self._handlers
+
     def get_connection_by_side(self, side: ConnSide) -> Connection:
-        for conn in self._connections:
-            if conn.other_side == side:
-                return conn
-        return None
+        return self._connections.get(side.key)
     
     def _iterate(self):
         if self._socket is None:
             LOG.warning("Socket not bound")
             return IterationStatus.FINISHED
         
-        if time.time() - self._recv_per_second_last > 1:
-            self._recv_per_second_last = time.time()
+        now = time.time()
+        if now - self._recv_per_second_last > 1:
+            self._recv_per_second_last = now
             self._recv_per_second = 0
         
-        if time.time() - self._send_per_second_last > 1:
-            self._send_per_second_last = time.time()
+        if now - self._send_per_second_last > 1:
+            self._send_per_second_last = now
             self._send_per_second = 0
         
-        for key, _ in self._socket_selector.select(timeout=0):
+        # Drain up to recv_batch_size datagrams into the preallocated buffers,
+        # grouped by sender so every connection gets its whole batch at once
+        batches: dict[tuple[str, int], list[memoryview]] = {}
+        received = 0
+        while received < self._recv_batch_size:
+            buffer = self._recv_buffers[received]
             try:
-                data, (ip, port) = key.fileobj.recvfrom(1024)
+                nbytes, address = self._socket.recvfrom_into(buffer)
+            except BlockingIOError:
+                break
             except ConnectionResetError:
                 LOG.warning("Connection reset")
                 continue
             
-            self._recv_per_second += len(data)
+            received += 1
+            self._recv_per_second += nbytes
+            self._stats.recv_bytes += nbytes
+            batches.setdefault(address, []).append(buffer[:nbytes])
+        
+        if not received:
+            return IterationStatus.SLEEP
+        
+        self._stats.recv_wakeups += 1
+        self._stats.recv_datagrams += received
+        self._stats.recv_max_batch = max(self._stats.recv_max_batch, received)
 
-            side = ConnSide(ip, port)
-            LOG.debug(f"Received {len(data)} bytes from {side}")
+        for (ip, port), datagrams in batches.items():
+            LOG.debug(f"Received {len(datagrams)} datagrams from {ip}:{port}")
 
-            connection = self.get_connection_by_side(side)
+            connection = self._connections.get(ConnSide.pack(ip, port))
 
             if not connection:
-                connection = Connection(side, 
-                                        self._keychain.copy(),
-                                        self._send_to,
-                                        self._handlers)
-                connection._add_iterator = self._add_iterator
-                self._add_iterator(connection._iterate)
-                self._connections.append(connection)
+                connection = self._create_connection(ConnSide(ip, port))
+        
+            connection._recv_batch(datagrams)
         
-            connection._recv(data)
-            return IterationStatus.BUSY
+        if received == self._recv_batch_size:
+            return IterationStatus.BUSY # There may be more datagrams waiting
         return IterationStatus.SLEEP
     
-    def _send_to(self, side: ConnSide, data: bytes) -> None:
-        self._send_per_second += len(data)
+    def _send_to(self, side: ConnSide, buffers: list[bytes]) -> None:
+        """Send one datagram given as a list of buffers (header, data, trailer), gathered by the kernel"""
+        length = sum(map(len, buffers))
+        self._send_per_second += length
+        self._stats.send_datagrams += 1
+        self._stats.send_bytes += length
 
         if self.emulate_problems and randint(0, 1000) < 10:
+            data = b''.join(buffers)
             change_index = randint(0, len(data) - 1)
-            data = data[:change_index] + bytes([randint(0, 255)]) + data[change_index + 1:]
-        self._socket.sendto(data, (side.ip, side.port))
-        LOG.debug(f"Sent {len(data)} bytes to {side}")
+            buffers = [data[:change_index] + bytes([randint(0, 255)]) + data[change_index + 1:]]
+        if not self._transmit(buffers, (side.ip, side.port)):
+            LOG.debug(f"Send buffer is full, dropped {length} bytes to {side}") # Lost like on the wire, ARQ resends it
+            return
+        LOG.debug(f"Sent {length} bytes to {side}")
     
-    def _add_iterator(self, iterable: Generator) -> None:
-        self._iterators_queue.append(iterable)
+    def _transmit(self, buffers: list[bytes], address: tuple[str, int]) -> bool:
+        """Hand one datagram to the OS, False if it had to be dropped"""
+        try:
+            if _HAS_SENDMSG:
+                self._socket.sendmsg(buffers, (), 0, address)
+            else:
+                self._socket.sendto(b''.join(buffers), address)
+        except (BlockingIOError, InterruptedError):
+            return False
+        return True
+    
+    def _add_iterator(self, iterable: Generator, flow: Hashable = None, weight: float = 1.0) -> None:
+        self._scheduler.add(iterable, flow, weight)
+        self._wakeup()
+    
+    def _remove_iterator(self, iterable: Generator) -> None:
+        self._scheduler.remove(iterable)
+    
+    def _on_iterator_finished(self, iterable: Generator) -> None:
+        self._remove_iterator(iterable)
+        self.clear_connections()
+    
+    def _wakeup(self) -> None:
+        if self._wakeup_send is None:
+            return
+        try:
+            self._wakeup_send.send(b'\x00')
+        except (BlockingIOError, OSError):
+            pass # Already woken up or closed
+    
+    def call_soon_threadsafe(self, callback: Callable, *args) -> None:
+        """
+        The way in from other threads: nothing else of the socket, its connections and transfers
+        is thread safe. `callback(*args)` runs in the thread of `listen` right after it wakes up.
+        """
+        self._calls.append((callback, args))
+        self._wakeup()
+    
+    def _run_calls(self) -> int:
+        """Run the calls queued by other threads. Returns the number of calls run"""
+        ran = 0
+        while self._calls:
+            callback, args = self._calls.popleft()
+            ran += 1
+            try:
+                callback(*args)
+            except Exception:
+                LOG.exception("Call from another thread failed")
+        return ran
+    
+    def _wait(self, timeout: float) -> None:
+        selector = self._socket_selector
+        if selector is None:
+            return
+        
+        try:
+            events = selector.select(timeout=max(0, min(timeout, self._max_wait)))
+        except (OSError, ValueError):
+            return # Socket was unbound from another thread
+        
+        for key, _ in events:
+            if key.fileobj is self._wakeup_recv:
+                try:
+                    while self._wakeup_recv.recv(1024):
+                        pass
+                except (BlockingIOError, OSError):
+                    pass
     
     def bind(self) -> None:
         if self._socket is not None:
             LOG.warning("Socket already bound")
             return
         
-        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self._socket.bind((self._bound_on.ip, self._bound_on.port))
-        self._socket.setblocking(False)
+        self._socket = self._create_socket()
+
+        self._wakeup_recv, self._wakeup_send = socket.socketpair()
+        self._wakeup_recv.setblocking(False)
+        self._wakeup_send.setblocking(False)
 
         self._socket_selector = DefaultSelector()
         self._socket_selector.register(self._socket, EVENT_READ)
+        self._socket_selector.register(self._wakeup_recv, EVENT_READ)
 
-        self._iterators_queue = []
-        self._connections = []
-
-        self._add_iterator(self._iterate)
+        self._reset()
+        self._scheduler.set_receiver(self._iterate)
+        self._clear_connections_timer = self._timers.call_later(self._clear_connections_interval, self.clear_connections)
 
         LOG.info(f"Socket bound on {self._bound_on}")
     
-    def connect(self, side: ConnSide) -> Connection:
-        for connection in self._connections:
-            if connection.other_side == side:
-                return connection
-        
+    def _create_socket(self) -> socket.socket:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind((self._bound_on.ip, self._bound_on.port))
+        sock.setblocking(False)
+        if self._max_datagram_size > LEGACY_DATAGRAM_SIZE:
+            for option in (socket.SO_RCVBUF, socket.SO_SNDBUF):
+                try:
+                    sock.setsockopt(socket.SOL_SOCKET, option, SOCKET_BUFFER_SIZE)
+                except OSError:
+                    LOG.warning("Can not enlarge socket buffers for large datagrams")
+        return sock
+    
+    def _reset(self) -> None:
+        """Forget all connections and their iterators and timers"""
+        self._scheduler.clear()
+        self._timers = Timers(self._wakeup)
+        self._connections = {}
+    
+    def _create_connection(self, side: ConnSide) -> Connection:
         connection = Connection(side, 
                                 self._keychain.copy(),
                                 self._send_to,
-                                self._handlers)
-        connection._add_iterator = self._add_iterator
-        self._connections.append(connection)
-        self._add_iterator(connection._iterate)
+                                self._connection_handlers(),
+                                self._timers,
+                                self._congestion,
+                                self._recv_memory_budget,
+                                self._rate_limit,
+                                self._max_datagram_size,
+                                self._codecs,
+                                self._recv_max_window_bytes)
+        connection._add_iterator = partial(self._add_iterator, flow=side.key)
+        self._connections[side.key] = connection
+        connection._add_iterator(connection._iterate)
+        return connection
+    
+    def connect(self, side: ConnSide) -> Connection:
+        connection = self._connections.get(side.key)
+        if connection:
+            return connection
+        
+        connection = self._create_connection(side)
         connection.connect()
         
         return connection
 
     def clear_connections(self) -> None:
-        for conn in self._connections:
+        if self._socket is not None:
+            self._timers.cancel(self._clear_connections_timer)
+            self._clear_connections_timer = self._timers.call_later(self._clear_connections_interval, self.clear_connections)
+        
+        for key, conn in list(self._connections.items()):
             if conn.conversation_status.is_disconnected:
                 LOG.debug(f"Accepted headers size (with {conn.other_side}): {conn._size_of_accepted_headers} bytes")
-                self._connections.remove(conn)
+                del self._connections[key]
 
     def disconnect(self, side: ConnSide) -> None:
-        for conn in self._connections:
-            if conn.other_side == side:
-                conn.disconnect()
-                self.clear_connections()
-                break
+        conn = self._connections.get(side.key)
+        if conn:
+            conn.disconnect()
+            if conn.conversation_status.is_disconnected:
+                del self._connections[side.key]
+            self._wakeup()
     
     def disconnect_all(self) -> None:
-        for conn in self._connections:
+        for conn in list(self._connections.values()):
             conn.disconnect()
+        self._wakeup()
     
-    def iterate_loop(self) -> None:
+    def iterate_loop(self) -> bool:
+        """Iterate every iterator once. Returns True if any of them still has work to do"""
         if self._socket is None:
             LOG.warning("Socket not bound")
-            return
+            return False
 
-        for iterator in self._iterators_queue:
-            for i in range(40):
-                status = iterator()
-                if status == IterationStatus.FINISHED:
-                    if iterator in self._iterators_queue:
-                        self._iterators_queue.remove(iterator)
-                    self.clear_connections()
-                    break
-                elif status == IterationStatus.SLEEP:
-                    break
-                elif status == IterationStatus.BUSY:
-                    continue
+        busy = self._run_calls() > 0
+        busy = self._timers.run_expired() > 0 or busy # Expired timers usually leave work for the iterators
+        return self._scheduler.iterate(self._on_iterator_finished) or busy
 
     def listen(self) -> None:
         while self.is_bound:
-            if int(time.time()) % 10 == 0:
-                self.clear_connections()
-            self.iterate_loop()
+            if self.iterate_loop():
+                continue # Something happened, maybe there is more work right away
+            
+            # Nothing to do: sleep until the socket is readable or the nearest timer
+            next_deadline = self._timers.next_deadline
+            self._wait(self._max_wait if next_deadline is None else next_deadline - time.time())
     
     def unbind(self) -> None:
         if self._socket is None:
             LOG.warning("Socket already unbound")
             return
         
-        for conn in self._connections:
+        for conn in list(self._connections.values()):
             conn.disconnect()
         
         self._socket.close()
         self._socket = None
-        self._iterators_queue = []
-        self._connections = []
+        self._wakeup()
+        self._wakeup_recv.close()
+        self._wakeup_send.close()
+        self._wakeup_recv = self._wakeup_send = None
+        self._socket_selector.close()
+        self._socket_selector = None
+        self._reset()
         LOG.info(f"Socket unbound on {self._bound_on}")
     
     def __enter__(self) -> "Socket":
@@ -0,0 +1,88 @@
+import heapq
+import logging
+
+from time import time
+from itertools import count
+from typing import Callable
+
+
+LOG = logging.getLogger("Timers")
+
+class Timer:
+    __slots__ = ('deadline', 'callback', 'cancelled')
+
+    def __init__(self, deadline: float, callback: Callable[[], None]) -> None:
+        self.deadline = deadline
+        self.callback = callback
+        self.cancelled = False
+
+    def cancel(self) -> None:
+        self.cancelled = True
+        self.callback = None
+
+
+class Timers:
+    """
+    Deadlines of the whole socket in one heap.
+    Cancelled timers stay in the heap until they reach the top (or until compaction),
+    so both scheduling and cancelling are cheap and a tick only touches expired timers.
+    """
+    def __init__(self, on_earlier_deadline: Callable[[], None] = lambda: None) -> None:
+        self.__heap: list[tuple[float, int, Timer]] = []
+        self.__counter = count()
+        self.__cancelled = 0
+        self.__on_earlier_deadline = on_earlier_deadline
+
+    def __len__(self) -> int:
+        return len(self.__heap) - self.__cancelled
+
+    def call_at(self, deadline: float, callback: Callable[[], None]) -> Timer:
+        timer = Timer(deadline, callback)
+        earlier = not self.__heap or deadline < self.__heap[0][0]
+        heapq.heappush(self.__heap, (deadline, next(self.__counter), timer))
+        if earlier:
+            self.__on_earlier_deadline()
+        return timer
+
+    def call_later(self, delay: float, callback: Callable[[], None]) -> Timer:
+        return self.call_at(time() + delay, callback)
+
+    def cancel(self, timer: Timer | None) -> None:
+        if timer is None or timer.cancelled:
+            return
+        timer.cancel()
+        self.__cancelled += 1
+
+        if self.__cancelled > 64 and self.__cancelled > len(self.__heap) // 2:
+            self.__heap = [entry for entry in self.__heap if not entry[2].cancelled]
+            heapq.heapify(self.__heap)
+            self.__cancelled = 0
+
+    @property
+    def next_deadline(self) -> float | None:
+        while self.__heap and self.__heap[0][2].cancelled:
+            heapq.heappop(self.__heap)
+            self.__cancelled -= 1
+        return self.__heap[0][0] if self.__heap else None
+
+    def run_expired(self, now: float | None = None) -> int:
+        """Run callbacks of all expired timers. Returns the number of callbacks run"""
+        if now is None:
+            now = time()
+
+        fired = 0
+        heap = self.__heap
+        while heap and heap[0][0] <= now:
+            _, _, timer = heapq.heappop(heap)
+            if timer.cancelled:
+                self.__cancelled -= 1
+                continue
+
+            callback = timer.callback
+            timer.cancel() # Fired timers can not be cancelled again
+            fired += 1
+            try:
+                callback()
+            except Exception:
+                LOG.exception("Timer callback failed")
+        return fired
@@ -2,11 +2,20 @@ import logging
 
 from io import BytesIO
 from time import time
+from collections import deque
+from ..timers import Timer
+from ..budget import MemoryBudget
+from ..cipher import CipherError
+from ..compression import Codec, CodecError, RAW, CODEC_MARKER_SIZE
 from ..types.flags import Flags
-from typing import Type, TypeVar
+from typing import Iterable, Type, TypeVar
 from ..types.keychain import Keychain
+from ..types.options import Feature, MAX_DATAGRAM_SIZE
 from ..types.packets.base import Packet
+from ..types.packets.sack import SackPacket
+from ..types.range_set import RangeSet
 from ..types.packets.send_part import SendPartPacket
+from ..types.packets.syn_send_msg import WideSynSendMsgPacket
 from ..types.iteration_status import IterationStatus
 
 
@@ -22,76 +31,132 @@ _T = TypeVar("_T")
 
 class RecvTransfer:
     def __init__(self, 
-                 length: int, 
+                 length: int | None, 
                  transfer_id: int, 
                  keychain: Keychain,
                  recv_stram: BytesIO,
                  data_type: Flags,
-                 filename: bytes = None) -> None:
+                 filename: bytes = None,
+                 memory_budget: MemoryBudget | None = None,
+                 max_window_bytes: int | None = None,
+                 received: Iterable[tuple[int, int]] = ()) -> None:
         self.__last_recv_time = time()
         self.__last_process_time = time()
 
         self.__timeout = 30
-        self.__ack_timeout = 10
         self.__process_window_tick = 0.01
 
         self.__max_ack_size = 100
+        self.__max_sack_size = 1000
+        self.__max_sack_ranges = 96 # Worst case 10 bytes per range, must fit in one datagram
 
-        self.__length = length
+        self.__length = length # None for a stream until the sender announces its end
         self.__window: list[SendPartPacket] = []
-        self.__processed_packets: list[int] = []
+        self.__window_bytes = 0 # Payload waiting in the window
+        self.memory_budget = memory_budget # Shared with the other receiving transfers, None for no limit
+        if memory_budget is not None:
+            memory_budget.join()
+        self.max_window_bytes = max_window_bytes # Cap of this transfer alone, None for only the shared budget
+        self.__dropped = 0
+        self.__duplicates: list[int] = [] # Insertion points of already written parts, to acknowledge again
+        self.__received = RangeSet() # Written bytes
+        for start, end in received: # Kept from an interrupted transfer of the same content
+            self.__received.add(start, end)
+        self.__resume_due = self.__received.total > 0 # Tell the sender what it can skip
         self.__transfer_id = transfer_id
         self.__recv_stram = recv_stram
-        self.__recived_data_length = 0
+        self.__write_at = getattr(recv_stram, 'write_at', None) # Positional writes (FileSink), no seek
         self.__keychain = keychain
         self._build_packet = NotImplemented
         self._send = NotImplemented
+        self._timers = NotImplemented
+        self._rtt = NotImplemented
+        self._features = Feature(0)
+        self._codec: Codec | None = None # Negotiated, parts carry a codec marker when set
         self.__data_type = data_type
         self.__filename = filename
 
         self.__got_fin = False
         self.__killed = False
+        self.__timed_out = False
+        self.__timeout_timer: Timer = None
+        self.__process_due = False
+        self.__process_timer: Timer = None
 
-        self._acks: dict[SendPartPacket, int] = {}
+        self._acks: dict[int, Packet] = {}
+        self.__ack_timers: dict[int, Timer] = {}
+        self.__ack_sent_at: dict[int, float] = {} # ACKs sent once, the only ones to measure RTT with
+        self.__expired_acks: deque[int] = deque()
 
         LOG.info(f"Transfer ID: {self.__transfer_id}")
     
     def _recv(self, packet: SendPartPacket) -> None:
         if self.done:
-            LOG.yellow(f"Transfer already done [{self.__recived_data_length == self.__length=}, {self.__got_fin=}, {self.__killed=}]")
+            LOG.yellow(f"Transfer already done [{self.is_correct=}, {self.__got_fin=}, {self.__killed=}]")
             return
         
         self.__last_recv_time = time()
         
         if packet.header.flags & Flags.ACK:
             LOG.green(f"Got ACK packet [{packet.header.ack_number}] {len(self._acks)}")
-            self._acks = {p: t for p, t in self._acks.items() if p.header.seq_number != packet.header.ack_number}
+            if self._acks.pop(packet.header.ack_number, None) is not None:
+                self._timers.cancel(self.__ack_timers.pop(packet.header.ack_number, None))
+                sent_at = self.__ack_sent_at.pop(packet.header.ack_number, None)
+                if sent_at is not None:
+                    self._rtt.sample(self.__last_recv_time - sent_at)
             return
         
         if packet.header.flags & Flags.FIN:
             LOG.info("Got FIN packet")
             self.__got_fin = True
+            self.kill()
+            return
+        
+        if packet.header.flags & Flags.SYN: # The stream ended, now its length is known
+            try:
+                end = packet.downcast(WideSynSendMsgPacket).decrypt()
+            except CipherError:
+                LOG.warning("End of stream can not be decrypted")
+                return
+            if self.__length is None and end.is_stream_end:
+                self.__length = end.message_len
+                LOG.info(f"Stream ends after {self.__length} bytes")
             return
         
         if packet.header.flags & Flags.PART == Flags.PART:
-            if packet.header.timeout < time():
+            if packet.header.timeout < self.__last_recv_time:
                 LOG.red(f"Packet [{packet.insertion_point}] timeout")
                 return
-            self.__window.append(packet.decrypt())
+            insertion_point = packet.peek_insertion_point()
+            if insertion_point is not None and insertion_point in self.__received:
+                self.__duplicates.append(insertion_point) # Its ACK was lost, no need to decrypt it again
+            elif self.__window_bytes and not self.__fits(len(packet.data)): # One part per transfer is always accepted
+                self.__dropped += 1 # The sender ignored the window (or does not know it), it will resend
+                LOG.yellow(f"Receive window is full, dropping packet [{insertion_point}]")
+                return
+            else:
+                try:
+                    packet.decrypt() # Also copies the data out of the receive buffer
+                except CipherError:
+                    LOG.warning(f"Packet [{insertion_point}] can not be decrypted") # Not acknowledged, it is resent
+                    return
+                self.__window.append(packet)
+                self.__window_bytes += len(packet.data)
+                if self.memory_budget is not None:
+                    self.memory_budget.charge(len(packet.data))
+            self.__schedule_process_window()
 
     @property
     def is_correct(self) -> bool:
-        return self.__recived_data_length == self.__length
+        return self.__length is not None and self.__received.total == self.__length
+    
+    @property
+    def transfer_id(self) -> int:
+        return self.__transfer_id
     
     @property
     def done(self) -> bool:
-        if self.is_correct:
-            return True
-        
-        if (self.__last_recv_time + self.__timeout < time()) or self.__got_fin or self.__killed: 
-            self.kill()
-
-        return self.__killed
+        return self.is_correct or self.__killed
 
     @property
     def data_type(self) -> Flags:
@@ -101,68 +166,213 @@ class RecvTransfer:
     def filename(self) -> bytes | None:
         return self.__filename
     
+    @property
+    def length(self) -> int | None:
+        """Bytes to receive, None for a stream that has not ended yet"""
+        return self.__length
+    
     @property
     def progress(self) -> float:
-        return (self.__recived_data_length / (self.__length or 1)) * 100
+        if self.__length is None:
+            return 0.0
+        return (self.__received.total / (self.__length or 1)) * 100
+    
+    @property
+    def received(self) -> RangeSet:
+        """Byte ranges already written to the stream"""
+        return self.__received
+    
+    def __fits(self, size: int) -> bool:
+        if self.max_window_bytes is not None and self.__window_bytes + size > self.max_window_bytes:
+            return False
+        return self.memory_budget is None or self.memory_budget.fits(size)
+    
+    @property
+    def receive_window(self) -> int | None:
+        """Our share of the free bytes of the memory budget or what is left of our own cap, the smaller one, advertised to the sender"""
+        pending = getattr(self.__recv_stram, 'pending', 0) # Parts a ChunkSink holds back until they are in order
+        windows = []
+        if self.memory_budget is not None:
+            windows.append(self.memory_budget.share)
+        if self.max_window_bytes is not None:
+            windows.append(self.max_window_bytes - self.__window_bytes)
+        if not windows:
+            return None
+        return max(0, min(windows) - pending)
+    
+    @property
+    def dropped(self) -> int:
+        """Packets dropped because the memory budget or the cap of the transfer was used up"""
+        return self.__dropped
+    
+    @property
+    def missing(self) -> list[tuple[int, int]]:
+        """Byte ranges still to be received, a stream's end is not known until it is announced"""
+        if self.__length is None:
+            return self.__received.gaps(max((end for _, end in self.__received), default=0))
+        return self.__received.gaps(self.__length)
     
     def kill(self) -> None:
         self.__killed = True
     
+    def __on_timeout_timer(self) -> None:
+        deadline = self.__last_recv_time + self.__timeout
+        if deadline > time():
+            self.__timeout_timer = self._timers.call_at(deadline, self.__on_timeout_timer)
+            return
+        self.__timed_out = True
+        self.kill()
+    
+    def __on_process_timer(self) -> None:
+        self.__process_timer = None
+        self.__process_due = True
+    
+    def __on_ack_timer(self, seq_number: int) -> None:
+        self.__ack_timers.pop(seq_number, None)
+        self.__ack_sent_at.pop(seq_number, None)
+        self.__expired_acks.append(seq_number)
+        self._rtt.backoff()
+    
+    def __schedule_process_window(self) -> None:
+        if self.__process_due or self.__process_timer is not None:
+            return
+        deadline = self.__last_process_time + self.__process_window_tick
+        if deadline <= self.__last_recv_time:
+            self.__process_due = True
+        else:
+            self.__process_timer = self._timers.call_at(deadline, self.__on_process_timer)
+    
+    def __track_ack(self, ack_packet: Packet, resent: bool = False) -> None:
+        seq_number = ack_packet.header.seq_number
+        now = time()
+        self._acks[seq_number] = ack_packet
+        if not resent:
+            self.__ack_sent_at[seq_number] = now
+        self.__ack_timers[seq_number] = self._timers.call_at(now + self._rtt.rto, lambda: self.__on_ack_timer(seq_number))
+    
+    def _cancel_timers(self) -> None:
+        self._timers.cancel(self.__timeout_timer)
+        self._timers.cancel(self.__process_timer)
+        for timer in self.__ack_timers.values():
+            self._timers.cancel(timer)
+        self.__ack_timers.clear()
+        self.__ack_sent_at.clear()
+        self.__expired_acks.clear()
+        if self.memory_budget is not None:
+            self.memory_budget.leave(self.__window_bytes)
+            self.memory_budget = None
+        self.__window.clear()
+        self.__window_bytes = 0
+    
     def _process_window(self) -> IterationStatus:
-        if not len(self.__window) or self.__last_process_time + self.__process_window_tick >= time():
+        if not self.__process_due:
             return IterationStatus.SLEEP
-        insertion_points: list[int] = []
+        self.__process_due = False
+        sack = bool(self._features & Feature.SACK)
+        max_ack_size = self.__max_sack_size if sack else self.__max_ack_size
+        insertion_points = self.__duplicates[:max_ack_size]
+        del self.__duplicates[:max_ack_size]
 
         LOG.gray(f"Processing window [{len(self.__window)} packets]")
-        while len(insertion_points) < self.__max_ack_size and len(self.__window):
+        while len(insertion_points) < max_ack_size and len(self.__window):
             packet = self.__window.pop()
-            insertion_points.append(packet.insertion_point)
+            self.__window_bytes -= len(packet.data)
+            if self.memory_budget is not None:
+                self.memory_budget.release(len(packet.data))
+            start = packet.insertion_point
+            data = packet.data_part
+            if self._codec is not None:
+                try:
+                    data = self.__decode(data)
+                except CodecError as e:
+                    LOG.red(f"Packet [{start}] can not be decoded ({e})")
+                    continue # Not acknowledged, the sender will resend it
+            insertion_points.append(start)
 
-            if packet.insertion_point in self.__processed_packets:
-                LOG.yellow(f"Got already processed packet [{packet.insertion_point}][{len(self.__processed_packets)}]")
+            if not self.__received.add(start, start + len(data)):
+                LOG.yellow(f"Got already processed packet [{start}][{len(self.__received)} ranges]")
                 continue
-            self.__recv_stram.seek(packet.insertion_point)
-            self.__recv_stram.write(packet.data_part)
-            self.__recived_data_length += len(packet.data_part)
-            self.__processed_packets.append(packet.insertion_point)
+            if self.__write_at is not None:
+                self.__write_at(start, data)
+            else:
+                self.__recv_stram.seek(start)
+                self.__recv_stram.write(data)
     
         if not insertion_points:
             return IterationStatus.SLEEP
         
-        ack_packet: Packet = self._build_packet(Flags.ACK)
-        ack_packet.header.transfer_id = self.__transfer_id
-        
-        ack_packet.data = b''
-        for i in insertion_points:
-            ack_packet.data += i.to_bytes(8, 'big')
-        
+        if sack:
+            watermark = self.__received.watermark
+            self.__send_sacks(sorted({r for r in map(self.__received.range_of, insertion_points) if r[1] > watermark}))
+        else:
+            ack_packet: Packet = self._build_packet(Flags.ACK)
+            ack_packet.data = b''.join(start.to_bytes(8, 'big') for start in insertion_points)
+            self.__send_ack(ack_packet)
+
+        LOG.green(f"Sent ACK [{len(insertion_points)} packets]")
 
-        LOG.green(f"Sending ACK packet [{ack_packet.header.seq_number}][{len(insertion_points)} packets]")
+        self.__last_process_time = time()
+        if self.__window or self.__duplicates:
+            self.__process_timer = self._timers.call_at(self.__last_process_time + self.__process_window_tick, self.__on_process_timer)
+        return IterationStatus.BUSY
 
+    def __decode(self, data: memoryview) -> bytes | memoryview:
+        if not data:
+            raise CodecError("Part has no codec marker")
+        marker, payload = data[0], data[CODEC_MARKER_SIZE:]
+        if marker == RAW:
+            return payload
+        if marker != self._codec.id:
+            raise CodecError(f"Unknown codec {marker}")
+        return self._codec.decompress(payload, MAX_DATAGRAM_SIZE) # A part never grows over a datagram
+    
+    def __send_sacks(self, ranges: list[tuple[int, int]]) -> None:
+        """Ranges above the watermark, as many SACKs as they need"""
+        watermark = self.__received.watermark
+        window = None
+        if self._features & Feature.WINDOW:
+            window = self.receive_window
+            if window is None:
+                window = 2**32 - 1 # No limit, the largest insertion point
+        for i in range(0, max(len(ranges), 1), self.__max_sack_ranges):
+            ack_packet: SackPacket = self._build_packet(Flags.ACK, packet_factory=SackPacket)
+            ack_packet.set_sack(watermark, ranges[i:i + self.__max_sack_ranges], window)
+            self.__send_ack(ack_packet)
+    
+    def _announce_received(self) -> IterationStatus:
+        """All ranges kept from an interrupted transfer, before anything else"""
+        if not self.__resume_due:
+            return IterationStatus.SLEEP
+        self.__resume_due = False
+        if self._features & Feature.SACK:
+            self.__send_sacks(self.__received.ranges(self.__received.watermark))
+            LOG.green(f"Announced {self.__received.total} bytes kept in {len(self.__received)} ranges")
+        return IterationStatus.BUSY
+    
+    def __send_ack(self, ack_packet: Packet) -> None:
+        ack_packet.header.transfer_id = self.__transfer_id
         ack_packet._public_key = self.__keychain.other_public_key
+        ack_packet._cipher = self.__keychain.cipher
         ack_packet.encrypt()
 
-        self._acks[ack_packet] = time()
         self._send(ack_packet)
-
-        self.__last_process_time = time()
-        return IterationStatus.BUSY
+        self.__track_ack(ack_packet)
 
     def _resend_old_acks(self) -> IterationStatus:
-        if not len(self._acks):
-            return IterationStatus.SLEEP
+        while self.__expired_acks and self.__expired_acks[0] not in self._acks:
+            self.__expired_acks.popleft() # Acknowledged after its timer expired
         
-        oldest_ack, time_ = min(self._acks.items(), key=lambda x: x[1])
-        if time_ + self.__ack_timeout >= time():
+        if not self.__expired_acks:
             return IterationStatus.SLEEP
+        
+        oldest_ack = self._acks.pop(self.__expired_acks.popleft())
 
         new_packet: Packet = self._build_packet(Flags.ACK)
         new_packet.data = oldest_ack.data
         new_packet.header.transfer_id = self.__transfer_id
 
         self._send(new_packet)
-        self._acks[new_packet] = time()
-        del self._acks[oldest_ack]
+        self.__track_ack(new_packet, resent=True)
 
         LOG.red(f"Resending ACK packet [{oldest_ack.header.seq_number}]")
 
@@ -170,15 +380,22 @@ class RecvTransfer:
         
 
     def _iterate(self) -> IterationStatus:
+        if self.__timeout_timer is None:
+            self.__timeout_timer = self._timers.call_at(self.__last_recv_time + self.__timeout, self.__on_timeout_timer)
+        
+        if self._announce_received() == IterationStatus.BUSY: # Even if it had it all, the sender has to know
+            return IterationStatus.BUSY
+        
         if self.done:
             fin_send_packet: Packet = self._build_packet(Flags.SEND | Flags.FIN)
             fin_send_packet.header.transfer_id = self.__transfer_id
             
             LOG.info(f"Sending FIN packet [{fin_send_packet.header.seq_number}]")
-            if self.__last_recv_time + self.__timeout < time():
+            if self.__timed_out:
                 LOG.info("Transfer timed out")
 
             self._send(fin_send_packet)
+            self._cancel_timers()
 
             return IterationStatus.FINISHED
         
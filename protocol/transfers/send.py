@@ -1,14 +1,24 @@
 import io
+import mmap
 import random
 import logging
 
 from io import BytesIO
+from bisect import bisect_left
 from time import time
-from typing import Type, TypeVar, Generator
+from collections import deque
+from typing import Callable, Type, TypeVar, Generator
+from ..timers import Timer
+from ..cipher import CipherError
+from ..compression import Codec, RAW, PROBE_SIZE, is_compressible
 from ..types.flags import Flags
+from ..types.options import Feature
 from ..types.packets.base import Packet
+from ..types.packets.sack import SackPacket
+from ..types.range_set import RangeSet
 from ..types.header import Header, HEADER_SIZE
-from ..types.packets.send_part import SendPartPacket
+from ..types.packets.send_part import SendPartPacket, WideSendPartPacket, INSERTION_POINT
+from ..types.packets.syn_send_msg import WideSynSendMsgPacket
 from ..types.iteration_status import IterationStatus
 from ..types.keychain import Keychain
 
@@ -23,43 +33,79 @@ LOG.cyan = lambda x: LOG.info(f"\033[96m{x}\033[0m" + " "*20)
 _T = TypeVar("_T")
 
 PART_SIZE = 1024-HEADER_SIZE-10 # 1024 - header - 10 bytes for part number
+RAW_STREAK = 16 # Parts sent raw without trying after one that compression did not shrink
+_RAW_MARKER = bytes((RAW,))
+
+def max_part_size(datagram_size: int, overhead: int = 0, insertion_point_size: int = INSERTION_POINT.size) -> int:
+    """Largest part fitting in a datagram, `overhead` is the checksum trailer and the cipher tag"""
+    return datagram_size - HEADER_SIZE - insertion_point_size - overhead
 
 class SendTransfer:
     def __init__(self,
                  keychain: Keychain,
                  send_stram: BytesIO,
                  data_type: Flags,
-                 part_size: int | None = PART_SIZE
+                 part_size: int | None = None,
+                 max_part: int = PART_SIZE - 30
                  ) -> None:
         self.__last_recv_time = time()
         
         self.__timeout = 40
-        self.__packet_timeout = 4
-        self.__window: dict[SendPartPacket, int] = {}
-        self.__window_size = 200
+        self.__packet_timeout = 4 # Lifetime of a packet, the receiver drops older ones. Retransmits use the RTO
+        self.__window: dict[int, int] = {} # insertion point -> part length, in sending order
+        self.__positions: list[int] = [] # Sorted insertion points of the window, may still hold acknowledged ones
+        self.__retransmit_timers: dict[int, Timer] = {}
+        self.__expired: deque[int] = deque() # Insertion points in the order their timers fired
+        self.__sent_at: dict[int, float] = {} # Parts sent only once, the only ones to measure RTT with
+        self.__newest_acked_sent_at: float | None = None
+        self.__receive_window: int | None = None # Free bytes advertised by the receiver, None if unknown
         self.__transfer_id = random.randint(0, 2**16)
         self.__keychain = keychain
         self.__data_type = data_type
     
         if part_size is None:
-            part_size = PART_SIZE - 30
+            part_size = max_part
 
-        if part_size > PART_SIZE - 30 or part_size <= 0 and part_size is not None:
-            raise ValueError(f"Part size must be between 1 and {PART_SIZE-30}")
+        if part_size > max_part or part_size <= 0:
+            raise ValueError(f"Part size must be between 1 and {max_part}")
         
         self.__part_size = part_size
 
         self.__send_stram = send_stram
-        self.__send_stram.seek(0, io.SEEK_END)
-        self.__data_len = self.__send_stram.tell()
-        self.__send_stram.seek(0)
+        self.__data_len: int | None = None # Unknown for a stream until it ends
+        if self.__send_stram.seekable():
+            self.__send_stram.seek(0, io.SEEK_END)
+            self.__data_len = self.__send_stram.tell()
+            self.__send_stram.seek(0)
+        self.__is_stream = self.__data_len is None
+
+        # Parts are slices of the source, resends read them again instead of keeping copies
+        self.__mapping: mmap.mmap | None = None
+        self.__source: memoryview | None = self.__map_source()
+        self.__unmapped_parts: dict[int, bytes] = {} # Parts in flight of a stream that can not be mapped
+        self.__next_position = 0
+        self.__held = RangeSet() # Not sent yet but already at the receiver (resumed transfer), skipped
 
         self._get_parts_iter = self._get_parts()
         self._build_packet = NotImplemented
         self._send = NotImplemented
+        self._timers = NotImplemented
+        self._rtt = NotImplemented
+        self._congestion = NotImplemented
+        self._pacer = NotImplemented
+        self._features = Feature(0)
+        self._codec: Codec | None = None # Negotiated, parts carry a codec marker when set
+        self.__compressible: bool | None = None # Probed with the first part
+        self.__raw_streak = 0 # Parts left to send raw after one did not shrink
+        self.on_sent: Callable[[bool], None] | None = None # Called once with is_correct when the connection reports the end
         self._done = False
         self._got_fin = False
         self.__killed = False
+        self.__timed_out = False
+        self.__timeout_timer: Timer = None
+        self.__pacing_timer: Timer = None
+        self.__length_due = False
+        self.__length_timer: Timer = None
 
         LOG.info(f"Transfer ID: {self.__transfer_id}")
 
@@ -69,19 +115,27 @@ class SendTransfer:
     
     @property
     def done(self) -> bool:
-        if self.__last_recv_time + self.__timeout < time():
-            LOG.red("Transfer timed out")
-            self.kill()
         return self._got_fin or self.__killed
     
     @property
     def progress(self) -> float:
-        return self.__send_stram.tell() / (self.__data_len or 1) * 100
+        if self.__data_len is None:
+            return 0.0
+        return self.__next_position / (self.__data_len or 1) * 100
+    
+    @property
+    def length(self) -> int | None:
+        """Bytes to send, None for a stream that has not ended yet"""
+        return self.__data_len
     
     @property
     def window_fill(self) -> int:
         return len(self.__window)
     
+    @property
+    def receive_window(self) -> int | None:
+        return self.__receive_window
+    
     @property
     def data_type(self) -> Flags:
         return self.__data_type
@@ -96,94 +150,316 @@ class SendTransfer:
     
     def kill(self) -> None:
         self.__killed = True
+    
+    def __on_timeout_timer(self) -> None:
+        deadline = self.__last_recv_time + self.__timeout
+        if deadline > time():
+            self.__timeout_timer = self._timers.call_at(deadline, self.__on_timeout_timer)
+            return
+        LOG.red("Transfer timed out")
+        self.__timed_out = True
+        self.kill()
+    
+    def __on_retransmit_timer(self, position: int) -> None:
+        self.__retransmit_timers.pop(position, None)
+        self.__expired.append(position)
+        self._rtt.backoff()
+        self._congestion.on_loss()
+    
+    def __on_length_timer(self) -> None:
+        self.__length_timer = None
+        self.__length_due = True
+    
+    def __map_source(self) -> memoryview | None:
+        if isinstance(self.__send_stram, io.BytesIO):
+            return self.__send_stram.getbuffer()
+        if not self.__data_len:
+            return None
+        try:
+            self.__mapping = mmap.mmap(self.__send_stram.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError, AttributeError, io.UnsupportedOperation):
+            LOG.debug("Source can not be mapped, reading it part by part")
+            return None
+        return memoryview(self.__mapping)[:self.__data_len]
+    
+    def __release_source(self) -> None:
+        if self.__source is not None:
+            self.__source.release()
+            self.__source = None
+        if self.__mapping is not None:
+            self.__mapping.close()
+            self.__mapping = None
+        self.__unmapped_parts.clear()
+    
+    def __read_part(self, position: int, length: int) -> bytes | memoryview:
+        if self.__source is not None:
+            return self.__source[position:position + length]
+        return self.__unmapped_parts[position]
+    
+    def __acknowledge(self, position: int) -> bool:
+        if self.__window.pop(position, None) is None:
+            return False
+        self.__unmapped_parts.pop(position, None)
+        self._timers.cancel(self.__retransmit_timers.pop(position, None))
+        sent_at = self.__sent_at.pop(position, None)
+        if sent_at is not None and (self.__newest_acked_sent_at is None or sent_at > self.__newest_acked_sent_at):
+            self.__newest_acked_sent_at = sent_at
+        return True
+    
+    def __hold(self, start: int, end: int) -> None:
+        """The receiver has [start, end) from an interrupted transfer, parts in it are not sent"""
+        start = max(start, self.__next_position) # Sent parts are acknowledged as usual
+        if end <= start or self.__is_stream:
+            return
+        self.__held.add(start, end)
+        if self.__is_held(self.__next_position, self.__data_len):
+            self._done = True # All the rest is there, the receiver may finish before the next call
+    
+    def __is_held(self, start: int, end: int) -> bool:
+        held = self.__held.range_of(start)
+        return held is not None and held[1] >= end
+    
+    def __acknowledge_below(self, watermark: int) -> int:
+        end = bisect_left(self.__positions, watermark)
+        acked = sum(self.__acknowledge(position) for position in self.__positions[:end])
+        del self.__positions[:end]
+        return acked
+    
+    def __acknowledge_range(self, start: int, end: int) -> int:
+        """Parts of the window inside [start, end), found by bisection whatever their lengths"""
+        positions = self.__positions
+        low, high = bisect_left(positions, start), bisect_left(positions, end)
+        acked = 0
+        kept = []
+        for position in positions[low:high]:
+            length = self.__window.get(position)
+            if length is None:
+                continue # Acknowledged already
+            if position + length > end:
+                kept.append(position) # Only its start was received
+                continue
+            acked += self.__acknowledge(position)
+        positions[low:high] = kept
+        return acked
+    
+    def _cancel_timers(self) -> None:
+        self._congestion.on_release(len(self.__window)) # Not in flight for us anymore
+        self.__window.clear()
+        self.__positions.clear()
+        self.__release_source()
+        self._timers.cancel(self.__timeout_timer)
+        self._timers.cancel(self.__pacing_timer)
+        self._timers.cancel(self.__length_timer)
+        for timer in self.__retransmit_timers.values():
+            self._timers.cancel(timer)
+        self.__retransmit_timers.clear()
+        self.__expired.clear()
+        self.__sent_at.clear()
 
     def _recv(self, packet: SendPartPacket) -> None:
         self.__last_recv_time = time()
-        packet.decrypt()
         
         if packet.header.flags & Flags.ACK:
+            try:
+                packet.decrypt() # Only ACKs carry (encrypted) data
+            except CipherError:
+                LOG.warning("ACK can not be decrypted")
+                return
             LOG.yellow(f"Window size " + f"{len(self.__window)}")
 
-            for i, pos in enumerate((int.from_bytes(packet.data[i:i+8], 'big') for i in range(0, len(packet.data), 8))):
-                self.__window = {p: ins_p for p, ins_p in self.__window.items() if ins_p != pos}
+            self.__newest_acked_sent_at = None
+            if self._features & Feature.SACK:
+                watermark, ranges, window = packet.downcast(SackPacket).get_sack(bool(self._features & Feature.WINDOW))
+                if window is not None:
+                    self.__receive_window = window
+                acked = self.__acknowledge_below(watermark)
+                self.__hold(0, watermark)
+                for start, end in ranges:
+                    self.__hold(start, end)
+                    acked += self.__acknowledge_range(start, end)
+            else:
+                data = packet.data
+                acked = sum(self.__acknowledge(int.from_bytes(data[i:i+8], 'big')) for i in range(0, len(data), 8))
+                if len(self.__positions) > 2 * len(self.__window) + 64:
+                    self.__positions = [position for position in self.__positions if position in self.__window]
 
             ack_packet: Packet = self._build_packet(Flags.ACK, ack_number=packet.header.seq_number)
             ack_packet.header.transfer_id = self.__transfer_id
             self._send(ack_packet)
 
-            LOG.green(f"Got {i+1} ACKs ")
+            rtt_sample = None
+            if self.__newest_acked_sent_at is not None:
+                rtt_sample = self.__last_recv_time - self.__newest_acked_sent_at
+                self._rtt.sample(rtt_sample) # One sample per ACK
+            self._congestion.on_ack(acked, rtt_sample)
+            LOG.green(f"Got {acked} ACKs ")
         
         if packet.header.flags & Flags.FIN:
             self._got_fin = True
     
-    def _get_parts(self) -> Generator[tuple[bytes, int], None, None]:
-        self.__send_stram.seek(0)
+    def _get_parts(self) -> Generator[tuple[bytes | memoryview | None, int], None, None]:
+        if self.__source is not None:
+            for position in range(0, self.__data_len, self.__part_size):
+                if self.__is_held(position, min(position + self.__part_size, self.__data_len)):
+                    continue
+                yield self.__source[position:position + self.__part_size], position
+            return
+
+        if self.__send_stram.seekable():
+            self.__send_stram.seek(0)
+        position = 0
         while True:
-            position = self.__send_stram.tell()
+            if not self.__is_stream and self.__is_held(position, min(position + self.__part_size, self.__data_len)):
+                position = self.__send_stram.seek(min(position + self.__part_size, self.__data_len))
+                continue
             data = self.__send_stram.read(self.__part_size)
+            if data is None:
+                yield None, position # A fed stream has nothing yet
+                continue
 
             if len(data) == 0:
                 break
+            self.__unmapped_parts[position] = data
             yield data, position
+            position += len(data)
     
-    def _resend_packets_in_window(self) -> IterationStatus:
-        if not self.__window:
+    def __probe(self, data: bytes | memoryview) -> bool:
+        """Samples the start, the middle and the end of a mapped source, the first part of the others"""
+        if self.__source is None:
+            return is_compressible(data)
+        middle, end = self.__data_len // 2, self.__data_len
+        return is_compressible(self.__source[:PROBE_SIZE], self.__source[middle:middle + PROBE_SIZE], self.__source[max(0, end - PROBE_SIZE):end])
+    
+    def __encode(self, data: bytes | memoryview) -> tuple[bytes | memoryview, ...]:
+        """Codec marker and the part, compressed if that makes it smaller"""
+        if self._codec is None:
+            return data,
+        if self.__compressible is None:
+            self.__compressible = self.__probe(data)
+            LOG.info(f"Data is {'' if self.__compressible else 'not '}compressible")
+        if self.__compressible and not self.__raw_streak:
+            compressed = self._codec.compress(data)
+            if len(compressed) < len(data):
+                return bytes((self._codec.id,)), compressed
+            self.__raw_streak = RAW_STREAK
+        elif self.__raw_streak:
+            self.__raw_streak -= 1
+        return _RAW_MARKER, data
+    
+    def __send_part(self, position: int, data: bytes | memoryview) -> float:
+        """Build, encrypt and send a part, returns the time it was sent"""
+        packet_factory = WideSendPartPacket if self._features & Feature.WIDE_OFFSETS else SendPartPacket
+        packet: SendPartPacket = self._build_packet(Flags.SEND | Flags.PART, packet_factory=packet_factory)
+        packet.header.transfer_id = self.__transfer_id
+        packet.set_part(position, *self.__encode(data))
+        packet._public_key = self.__keychain.other_public_key
+        packet._cipher = self.__keychain.cipher
+        now = time()
+        packet.header.timeout = now + self.__packet_timeout
+        packet.encrypt()
+        self._send(packet)
+        return now
+    
+    def _announce_length(self) -> IterationStatus:
+        """A stream ends with its length, sent again every RTO until the receiver has it all (FIN)"""
+        if not self.__length_due:
             return IterationStatus.SLEEP
+        self.__length_due = False
+        
+        packet: WideSynSendMsgPacket = self._build_packet(Flags.SYN | Flags.SEND | Flags.MSG, packet_factory=WideSynSendMsgPacket)
+        packet.header.transfer_id = self.__transfer_id
+        packet._public_key = self.__keychain.other_public_key
+        packet._cipher = self.__keychain.cipher
+        packet.set_stream_end(self.__data_len)
+        self._send(packet.encrypt())
+        self.__length_timer = self._timers.call_at(time() + self._rtt.rto, self.__on_length_timer)
+
+        LOG.info(f"Stream ended after {self.__data_len} bytes")
+        return IterationStatus.BUSY
+    
+    def __wait_for_pacer(self) -> bool:
+        """True if the next part has to wait, a timer wakes the loop up when it may go"""
+        delay = self._pacer.delay(HEADER_SIZE + self.__part_size)
+        if delay <= 0:
+            return False
+        if self.__pacing_timer is None or self.__pacing_timer.cancelled:
+            self.__pacing_timer = self._timers.call_later(delay, lambda: None)
+        return True
+    
+    def _resend_packets_in_window(self) -> IterationStatus:
+        while self.__expired and self.__expired[0] not in self.__window:
+            self.__expired.popleft() # Acknowledged after its timer expired
         
-        oldes_packet, position = min(self.__window.items(), key=lambda x: x[0].header.timeout)
-        if oldes_packet.header.timeout > time():
+        if not self.__expired:
             return IterationStatus.SLEEP
         
-        new_packet: Packet = self._build_packet(oldes_packet.header.flags)
-        new_packet.data = oldes_packet.data
-        new_packet.header.transfer_id = self.__transfer_id
-        new_packet.header.timeout = time() + self.__packet_timeout
-        self._send(new_packet)
+        position = self.__expired.popleft()
+        now = self.__send_part(position, self.__read_part(position, self.__window[position]))
         
-        self.__window[new_packet] = position
-        del self.__window[oldes_packet]
+        self.__sent_at.pop(position, None) # Karn's rule
+        self.__retransmit_timers[position] = self._timers.call_at(now + self._rtt.rto, lambda: self.__on_retransmit_timer(position))
 
-        LOG.red(f"Resending packet [{new_packet.header.seq_number}]")
+        LOG.red(f"Resending part [{position}]")
         return IterationStatus.BUSY
     
     def _send_packet_part(self) -> IterationStatus:
-        if len(self.__window) >= self.__window_size:
+        if not self._congestion.can_send: # The window is shared by all transfers of the connection
+            return IterationStatus.SLEEP
+        
+        # Parts in flight may all be waiting in the receiver's memory. An empty window probes a full receiver
+        if self.__receive_window is not None and self.__window and (len(self.__window) + 1) * self.__part_size > self.__receive_window:
             return IterationStatus.SLEEP
 
         try:
             data, position = next(self._get_parts_iter)
         except StopIteration:
+            if self.__is_stream and not self._done:
+                self.__data_len = self.__next_position
+                self.__length_due = True
+                self._done = True
+                return IterationStatus.BUSY # Announce it right away
             self._done = True
             return IterationStatus.SLEEP
+        if data is None:
+            return IterationStatus.SLEEP # Feeding the stream wakes the socket up
         
-        packet: SendPartPacket = self._build_packet(Flags.SEND | Flags.PART, packet_factory=SendPartPacket)
-        packet.header.transfer_id = self.__transfer_id
-        packet.insertion_point = position
-        packet.data_part = data
-        packet._public_key = self.__keychain.other_public_key
-        packet.header.timeout = self.__packet_timeout + time()
-        packet.encrypt()
-        
-        self.__window[packet] = position
-        self._send(packet)
+        self.__window[position] = len(data)
+        self.__positions.append(position) # Parts are sent in order, it stays sorted
+        self.__next_position = position + len(data)
+        if not self.__is_stream:
+            self._done = self.__next_position >= self.__data_len # The receiver may finish before the next call
+        now = self.__send_part(position, data)
+        self.__sent_at[position] = now
+        self._congestion.on_sent()
+        self.__retransmit_timers[position] = self._timers.call_at(now + self._rtt.rto, lambda: self.__on_retransmit_timer(position))
         
         return IterationStatus.BUSY
 
     def _iterate(self) -> IterationStatus:
+        if self.__timeout_timer is None:
+            self.__timeout_timer = self._timers.call_at(self.__last_recv_time + self.__timeout, self.__on_timeout_timer)
+        
         if self.done:
             fin_send_packet: Packet = self._build_packet(Flags.SEND | Flags.FIN)
             fin_send_packet.header.transfer_id = self.__transfer_id
 
-            LOG.info(f"Sending FIN packet [{fin_send_packet.header.seq_number}] [{self._got_fin=} or {(self.__last_recv_time + self.__timeout < time())=} or {self.__killed=}]")
+            LOG.info(f"Sending FIN packet [{fin_send_packet.header.seq_number}] [{self._got_fin=} or {self.__timed_out=} or {self.__killed=}]")
             self._send(fin_send_packet)
 
-            if self.__timeout + self.__last_recv_time < time():
+            if self.__timed_out:
                 LOG.info("Transfer timed out")
+            self._cancel_timers()
             return IterationStatus.FINISHED
         
+        if self.__wait_for_pacer():
+            return IterationStatus.SLEEP
+        
         if self._resend_packets_in_window() == IterationStatus.BUSY:
             return IterationStatus.BUSY
         
+        if self._announce_length() == IterationStatus.BUSY:
+            return IterationStatus.BUSY
+        
         if self._send_packet_part() == IterationStatus.BUSY:
             return IterationStatus.BUSY
 
@@ -0,0 +1,317 @@
+import os
+import struct
+import logging
+
+from io import FileIO
+from time import time
+from typing import Any, Callable
+from ..types.range_set import RangeSet
+from ..types.manifest import Manifest, MANIFEST_LEN_SIZE
+
+
+LOG = logging.getLogger("FileSink")
+
+_JOURNAL_MAGIC = b'PMFJ'
+_JOURNAL_HEADER = struct.Struct('>4s16sQI') # magic, content id, length, number of ranges
+_JOURNAL_RANGE = struct.Struct('>QQ')
+
+class FileSink(FileIO):
+    """
+    Destination of a received file. Parts are written in place with `os.pwrite`, so nothing
+    is buffered and no seek is shared between writes.
+    Given a path, data goes to `<path>.part`, preallocated to the full length, and is renamed
+    to the path only when the transfer is complete (`commit`), an incomplete transfer removes
+    it (`abort`). Given a file descriptor, data is written straight into it and it is left
+    open for the caller.
+    With a `content_id` the written ranges are journaled to `<path>.part.journal` (at most
+    every `checkpoint_interval` seconds), an interrupted transfer keeps both files (`suspend`)
+    and the next sink with the same content id and length continues where it stopped. The
+    journal only lists data already handed to the OS, it survives a dead process or
+    connection but not a power loss.
+    """
+    PART_SUFFIX = ".part"
+    JOURNAL_SUFFIX = ".journal"
+
+    def __init__(self,
+                 destination: str | os.PathLike | int,
+                 length: int = 0,
+                 preallocate: bool = True,
+                 content_id: bytes | None = None,
+                 checkpoint_interval: float = 1.0) -> None:
+        self.__length = length
+        self.__content_id = content_id
+        self.__checkpoint_interval = checkpoint_interval
+        self.__last_checkpoint = time()
+        self.__received = RangeSet()
+        if isinstance(destination, int):
+            self.__path = None
+            self.__partial_path = None
+            self.__journal_path = None
+            self.__content_id = None # Nowhere to find it again
+            super().__init__(destination, 'r+b', closefd=False)
+        else:
+            self.__path = os.path.abspath(os.fspath(destination))
+            self.__partial_path = self.__path + self.PART_SUFFIX
+            self.__journal_path = self.__partial_path + self.JOURNAL_SUFFIX
+            resumed = self.__load_journal()
+            if resumed is None:
+                self.__remove_journal() # Left by another file
+            else:
+                self.__received = resumed
+                LOG.info(f"Resuming {self.__path} with {resumed.total} of {length} bytes")
+            super().__init__(self.__partial_path, 'r+b' if resumed is not None else 'w+b')
+
+        if preallocate and length:
+            self.__preallocate(length)
+
+    @property
+    def path(self) -> str | None:
+        """Final path, None for a file descriptor destination"""
+        return self.__path
+
+    @property
+    def resumable(self) -> bool:
+        return self.__content_id is not None
+
+    @property
+    def received(self) -> RangeSet:
+        """Byte ranges written, including those of the interrupted transfers it resumes"""
+        return self.__received
+
+    def __load_journal(self) -> RangeSet | None:
+        if self.__content_id is None or not os.path.exists(self.__partial_path):
+            return None
+        try:
+            with open(self.__journal_path, 'rb') as journal:
+                data = journal.read()
+            magic, content_id, length, count = _JOURNAL_HEADER.unpack_from(data)
+            if magic != _JOURNAL_MAGIC or content_id != self.__content_id or length != self.__length:
+                return None
+            received = RangeSet()
+            for i in range(count):
+                received.add(*_JOURNAL_RANGE.unpack_from(data, _JOURNAL_HEADER.size + i * _JOURNAL_RANGE.size))
+        except (OSError, struct.error):
+            return None
+        return received
+
+    def __remove_journal(self) -> None:
+        try:
+            os.unlink(self.__journal_path)
+        except FileNotFoundError:
+            pass
+
+    def checkpoint(self) -> None:
+        """Write the journal, replacing the old one at once"""
+        self.__last_checkpoint = time()
+        if self.__content_id is None or self.__partial_path is None:
+            return
+        ranges = list(self.__received)
+        data = bytearray(_JOURNAL_HEADER.pack(_JOURNAL_MAGIC, self.__content_id, self.__length, len(ranges)))
+        for start, end in ranges:
+            data += _JOURNAL_RANGE.pack(start, end)
+        temporary = self.__journal_path + ".tmp"
+        with open(temporary, 'wb') as journal:
+            journal.write(data)
+        os.replace(temporary, self.__journal_path)
+
+    def __preallocate(self, length: int) -> None:
+        try:
+            if hasattr(os, 'posix_fallocate'):
+                os.posix_fallocate(self.fileno(), 0, length)
+                return
+        except OSError as e: # Not supported by the file system
+            LOG.debug(f"posix_fallocate failed ({e}), truncating instead")
+        os.ftruncate(self.fileno(), length)
+
+    def write_at(self, offset: int, data: bytes | memoryview) -> None:
+        view = memoryview(data)
+        start = offset
+        while view: # pwrite may write less than asked
+            written = os.pwrite(self.fileno(), view, offset)
+            view = view[written:]
+            offset += written
+        self.__received.add(start, offset)
+        if self.__content_id is not None and time() - self.__last_checkpoint >= self.__checkpoint_interval:
+            self.checkpoint()
+
+    def commit(self) -> None:
+        """Make the file visible under its final path and close it, read it from `path`"""
+        if self.__partial_path is None:
+            return
+        self.flush()
+        os.replace(self.__partial_path, self.__path)
+        self.__remove_journal()
+        self.__partial_path = None
+        self.close()
+
+    def abort(self) -> None:
+        """Remove the incomplete file"""
+        if self.__partial_path is None:
+            return
+        self.close()
+        try:
+            os.unlink(self.__partial_path)
+        except FileNotFoundError:
+            pass
+        self.__remove_journal()
+        self.__partial_path = None
+
+    def suspend(self) -> None:
+        """Keep the incomplete file and its journal for a later transfer of the same content"""
+        if not self.resumable or self.__partial_path is None:
+            self.abort()
+            return
+        self.checkpoint()
+        self.close()
+        LOG.info(f"Suspended {self.__path} with {self.__received.total} of {self.__length} bytes")
+        self.__partial_path = None
+
+    def __repr__(self) -> str:
+        return f"FileSink(path={self.__path}, fd={self.fileno() if not self.closed else None})"
+
+
+class ChunkSink:
+    """
+    Destination of a streamed message. Data is handed to `deliver` in order as soon as it is
+    contiguous, parts received ahead of a gap wait in memory until the gap is filled.
+    """
+    def __init__(self, deliver: Callable[[bytes], None]) -> None:
+        self.__deliver = deliver
+        self.__delivered = 0
+        self.__pending: dict[int, bytes] = {} # offset -> part received out of order
+        self.__pending_bytes = 0
+
+    @property
+    def delivered(self) -> int:
+        return self.__delivered
+
+    @property
+    def pending(self) -> int:
+        """Bytes waiting for a gap before them"""
+        return self.__pending_bytes
+
+    def write_at(self, offset: int, data: bytes | memoryview) -> None:
+        if offset != self.__delivered:
+            self.__pending[offset] = bytes(data)
+            self.__pending_bytes += len(data)
+            return
+        self.__deliver(bytes(data))
+        self.__delivered += len(data)
+        while (data := self.__pending.pop(self.__delivered, None)) is not None:
+            self.__pending_bytes -= len(data)
+            self.__deliver(data)
+            self.__delivered += len(data)
+
+    def __repr__(self) -> str:
+        return f"ChunkSink(delivered={self.__delivered}, pending={self.__pending_bytes})"
+
+
+class BundleSink:
+    """
+    Destination of a bundle. The manifest is collected first (parts that come before it is
+    complete wait in memory), then every part is split at file boundaries. A file's sink comes
+    from `open_file(name, size)` when its first part arrives and goes to `on_file_done(name, sink,
+    is_correct)` as soon as the file is complete, so only files in flight are open.
+    """
+    def __init__(self,
+                 open_file: Callable[[str, int], Any],
+                 on_file_done: Callable[[str, Any, bool], None]) -> None:
+        self.__open_file = open_file
+        self.__on_file_done = on_file_done
+        self.__header = bytearray() # Contiguous bytes from the start, until the manifest is known
+        self.__early: dict[int, bytes] = {} # offset -> part received ahead of the manifest
+        self.__pending_bytes = 0
+        self.__manifest: Manifest | None = None
+        self.__starts: list[int] = []
+        self.__missing: list[int] = [] # Bytes still to come for every file
+        self.__sinks: dict[int, Any] = {} # Open files by index
+        self.__complete = 0
+
+    @property
+    def manifest(self) -> Manifest | None:
+        return self.__manifest
+
+    @property
+    def pending(self) -> int:
+        """Bytes waiting for the manifest"""
+        return self.__pending_bytes
+
+    @property
+    def complete(self) -> int:
+        """Number of files received"""
+        return self.__complete
+
+    def write_at(self, offset: int, data: bytes | memoryview) -> None:
+        if self.__manifest is not None:
+            self.__route(offset, data)
+            return
+        self.__early[offset] = bytes(data)
+        self.__pending_bytes += len(data)
+        while (part := self.__early.pop(len(self.__header), None)) is not None:
+            self.__pending_bytes -= len(part)
+            self.__header += part
+        self.__read_manifest()
+
+    def __read_manifest(self) -> None:
+        if len(self.__header) < MANIFEST_LEN_SIZE:
+            return
+        data_start = MANIFEST_LEN_SIZE + int.from_bytes(self.__header[:MANIFEST_LEN_SIZE], 'big')
+        if len(self.__header) < data_start:
+            return
+        self.__manifest = Manifest.load(memoryview(self.__header)[MANIFEST_LEN_SIZE:data_start])
+        self.__starts = self.__manifest.starts(data_start)
+        self.__missing = [size for _, size in self.__manifest.files]
+        LOG.info(f"Bundle of {len(self.__missing)} files, {self.__manifest.size} bytes")
+
+        for index, (name, size) in enumerate(self.__manifest.files):
+            if not size:
+                self.__finish(index, True) # Nothing to wait for
+        header, early = self.__header, self.__early
+        self.__header, self.__early, self.__pending_bytes = bytearray(), {}, 0
+        if len(header) > data_start:
+            self.__route(data_start, memoryview(header)[data_start:])
+        for offset, part in early.items():
+            self.__route(offset, part)
+
+    def __route(self, offset: int, data: bytes | memoryview) -> None:
+        view = memoryview(data)
+        index = Manifest.file_at(self.__starts, offset)
+        while view and index < len(self.__starts):
+            start, size = self.__starts[index], self.__manifest.files[index][1]
+            take = min(len(view), start + size - offset)
+            if take > 0:
+                sink = self.__sinks.get(index)
+                if sink is None:
+                    sink = self.__sinks[index] = self.__open_file(*self.__manifest.files[index])
+                if hasattr(sink, 'write_at'):
+                    sink.write_at(offset - start, view[:take])
+                else:
+                    sink.seek(offset - start)
+                    sink.write(view[:take])
+                self.__missing[index] -= take
+                if not self.__missing[index]:
+                    self.__finish(index, True)
+                view = view[take:]
+                offset += take
+            index += 1
+
+    def __finish(self, index: int, is_correct: bool) -> None:
+        name, size = self.__manifest.files[index]
+        sink = self.__sinks.pop(index, None)
+        if sink is None and is_correct:
+            sink = self.__open_file(name, size) # Empty file
+        self.__complete += is_correct
+        self.__on_file_done(name, sink, is_correct)
+
+    def close(self) -> None:
+        """End of the transfer, files not complete yet are reported as failed"""
+        if self.__manifest is None:
+            return
+        for index, missing in enumerate(self.__missing):
+            if missing:
+                self.__finish(index, False)
+                self.__missing[index] = 0
+
+    def __repr__(self) -> str:
+        files = len(self.__missing) if self.__manifest is not None else None
+        return f"BundleSink(files={files}, complete={self.complete}, open={len(self.__sinks)})"
@@ -0,0 +1,144 @@
+import os
+
+from io import SEEK_CUR, SEEK_END, SEEK_SET, FileIO, RawIOBase
+from typing import Callable, Iterable
+from ..types.manifest import Manifest, MANIFEST_LEN_SIZE
+
+
+class ChunkSource(RawIOBase):
+    """
+    Message of unknown length read from an iterable of byte chunks, e.g. a generator of a feed.
+    It is not seekable, the sender keeps only the parts in flight. The iterable is consumed
+    from the socket loop, so getting a chunk should not block.
+    Without an iterable the source is fed: chunks come with `feed` as they arrive (e.g. from a
+    coroutine) and `end` closes it. Reads then return what is there, None while nothing is.
+    """
+    def __init__(self, chunks: Iterable[bytes] | None = None) -> None:
+        super().__init__()
+        self.__chunks = iter(chunks) if chunks is not None else None
+        self.__buffer = bytearray()
+        self.__exhausted = False
+        self.on_drain: Callable[[], None] | None = None # Called after every read, feeders wait for room with it
+
+    @property
+    def exhausted(self) -> bool:
+        return self.__exhausted and not self.__buffer
+
+    @property
+    def buffered(self) -> int:
+        return len(self.__buffer)
+
+    def feed(self, chunk: bytes) -> None:
+        if self.__chunks is not None or self.__exhausted:
+            raise ValueError("Only a fed source that did not end can be fed")
+        self.__buffer += chunk
+
+    def end(self) -> None:
+        self.__exhausted = True
+
+    def readable(self) -> bool:
+        return True
+
+    def read(self, size: int = -1) -> bytes | None:
+        """Exactly `size` bytes unless the chunks ran out. A fed source returns what it has, None if nothing yet"""
+        while self.__chunks is not None and not self.__exhausted and (size < 0 or len(self.__buffer) < size):
+            try:
+                self.__buffer += next(self.__chunks)
+            except StopIteration:
+                self.__exhausted = True
+        if not self.__buffer and not self.__exhausted:
+            return None
+        if size < 0:
+            size = len(self.__buffer)
+        data = bytes(self.__buffer[:size])
+        del self.__buffer[:size]
+        if self.on_drain is not None:
+            self.on_drain()
+        return data
+
+    def __repr__(self) -> str:
+        return f"ChunkSource(buffered={len(self.__buffer)}, exhausted={self.__exhausted})"
+
+
+class BundleSource(RawIOBase):
+    """
+    Files sent as one transfer: the manifest length, the manifest and the files one after
+    another. Seekable, files are opened only while their data is read.
+    """
+    def __init__(self, paths: list[str | os.PathLike], names: list[str]) -> None:
+        super().__init__()
+        self.__paths = [os.fspath(path) for path in paths]
+        self.__manifest = Manifest(list(zip(names, (os.path.getsize(path) for path in self.__paths))))
+        manifest = self.__manifest.dump()
+        self.__header = len(manifest).to_bytes(MANIFEST_LEN_SIZE, 'big') + manifest
+        self.__starts = self.__manifest.starts(len(self.__header))
+        self.__length = len(self.__header) + self.__manifest.size
+        self.__position = 0
+        self.__file: FileIO | None = None
+        self.__file_index = -1
+
+    @property
+    def manifest(self) -> Manifest:
+        return self.__manifest
+
+    @property
+    def name(self) -> str:
+        return f"Bundle of {len(self.__paths)} files"
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self.__position
+
+    def seek(self, offset: int, whence: int = SEEK_SET) -> int:
+        if whence == SEEK_CUR:
+            offset += self.__position
+        elif whence == SEEK_END:
+            offset += self.__length
+        self.__position = max(0, offset)
+        return self.__position
+
+    def __open(self, index: int) -> FileIO:
+        if index != self.__file_index:
+            if self.__file is not None:
+                self.__file.close()
+            self.__file = FileIO(self.__paths[index], 'rb')
+            self.__file_index = index
+        return self.__file
+
+    def read(self, size: int = -1) -> bytes:
+        """Exactly `size` bytes unless the bundle ends, across file boundaries"""
+        if size < 0:
+            size = self.__length - self.__position
+        size = min(size, self.__length - self.__position)
+        parts = []
+        while size > 0:
+            position = self.__position
+            if position < len(self.__header):
+                data = self.__header[position:position + size]
+            else:
+                index = Manifest.file_at(self.__starts, position)
+                start = self.__starts[index]
+                file = self.__open(index)
+                file.seek(position - start)
+                data = file.read(min(size, start + self.__manifest.files[index][1] - position))
+                if not data:
+                    raise OSError(f"{self.__paths[index]} is shorter than when the bundle started")
+            parts.append(data)
+            self.__position += len(data)
+            size -= len(data)
+        return b''.join(parts)
+
+    def close(self) -> None:
+        if self.__file is not None:
+            self.__file.close()
+            self.__file = None
+            self.__file_index = -1
+        super().close()
+
+    def __repr__(self) -> str:
+        return f"BundleSource(files={len(self.__paths)}, length={self.__length})"
@@ -1,29 +1,45 @@
+import socket
 
 
 class ConnSide:
-    def __init__(self, ip: str, port: int) -> None:
-        self._ip = 0b0
-        self._port = port
+    __slots__ = ('_ip', '_port', '_ip_str')
 
-        for part in ip.split('.'):
-            self._ip += int(part)
-            self._ip <<= 8
+    def __init__(self, ip: str, port: int) -> None:
+        packed_ip = socket.inet_aton(ip)
+        object.__setattr__(self, '_ip', int.from_bytes(packed_ip, byteorder='big'))
+        object.__setattr__(self, '_port', port)
+        object.__setattr__(self, '_ip_str', socket.inet_ntoa(packed_ip))
+    
+    @staticmethod
+    def pack(ip: str, port: int) -> tuple[int, int]:
+        """Key of the side with the given address, without building a ConnSide"""
+        return int.from_bytes(socket.inet_aton(ip), byteorder='big'), port
+    
+    @property
+    def key(self) -> tuple[int, int]:
+        return self._ip, self._port
     
     @property
     def port(self) -> int:
         return self._port
     
     @property
-    def ip(self):
-        list_ip = []
-        for i in range(4):
-            list_ip.append(str(self._ip >> (8 * (4 - i)) & 0b11111111))
-        return '.'.join(list_ip)
+    def ip(self) -> str:
+        return self._ip_str
+    
+    def __setattr__(self, name: str, value: object) -> None:
+        raise AttributeError("ConnSide is immutable")
     
     def __eq__(self, other: object) -> bool:
         if not isinstance(other, ConnSide):
             return NotImplemented
-        return self.ip == other.ip and self.port == other.port
+        return self._ip == other._ip and self._port == other._port
+    
+    def __hash__(self) -> int:
+        return hash((self._ip, self._port))
 
     def __str__(self) -> str:
-        return f"{self.ip}:{self.port}"
\ No newline at end of file
+        return f"{self.ip}:{self.port}"
+    
+    def __repr__(self) -> str:
+        return f"ConnSide({self.ip!r}, {self.port})"
@@ -1,3 +1,5 @@
+import os
+
 from io import BytesIO
 from dataclasses import dataclass
 from typing import Callable
@@ -10,6 +12,11 @@ class Handlers:
     on_message_recv: Callable[[ConnSide, bytes, bool], None] = lambda side, msg, is_correct: None
     on_message_send: Callable[[ConnSide, bytes, bool], None] = lambda side, msg, is_correct: None
 
-    on_file_recv: Callable[[ConnSide, BytesIO, str, bool], None] = lambda side, file, is_correct: None
-    on_file_send: Callable[[ConnSide, BytesIO, str, bool], None] = lambda side, file, is_correct: None
+    # In order data of a streamed message (transfer id, chunk). Its on_message_recv / on_message_send get b''
+    on_message_chunk: Callable[[ConnSide, int, bytes], None] = lambda side, transfer_id, chunk: None
+
+    # Where to write an incoming file: a path, a file descriptor, a FileSink or None for a temporary file
+    on_file_destination: Callable[[ConnSide, str, int], str | os.PathLike | int | None] = lambda side, filename, length: None
+    on_file_recv: Callable[[ConnSide, BytesIO, str, bool], None] = lambda side, file, filename, is_correct: None
+    on_file_send: Callable[[ConnSide, BytesIO, str, bool], None] = lambda side, file, filename, is_correct: None
     on_disconnect: Callable[[ConnSide], None] = lambda side: None
\ No newline at end of file
@@ -1,93 +1,94 @@
-from ctypes import c_uint32, c_uint16, c_int64
+import struct
+
 from .flags import Flags
 
-HEADER_SIZE = 21 # bytes
+HEADER_STRUCT = struct.Struct('>IIBHHq') # seq_number, ack_number, flags, transfer_id, checksum, timeout
+HEADER_SIZE = HEADER_STRUCT.size # 21 bytes
+CHECKSUM_OFFSET = 11 # seq_number + ack_number + flags + transfer_id
+
+_FLAGS = tuple(Flags(value) for value in range(256)) # Flags(value) is slow, look them up instead
 
 class Header:
+    __slots__ = ('_seq_number', '_ack_number', '_flags', '_transfer_id', '_checksum', '_timeout')
+
     def __init__(self, seq_number: int = 0, ack_number: int = 0,
                 flags: Flags = None, transfer_id: int = 0, checksum: int = 0) -> None:
         if flags is None:
-            flags = Flags(0)
-        self.__seq_number = c_uint32(seq_number)
-        self.__ack_number = c_uint32(ack_number)
-        self.__flags = flags
-        self.__transfer_id = c_uint16(transfer_id)
-        self.__checksum = c_uint16(checksum)
-        self.__timeout = c_int64(0)
-        
+            flags = _FLAGS[0]
+        self._seq_number = seq_number & 0xFFFFFFFF
+        self._ack_number = ack_number & 0xFFFFFFFF
+        self._flags = flags
+        self._transfer_id = transfer_id & 0xFFFF
+        self._checksum = checksum & 0xFFFF
+        self._timeout = 0 # milliseconds
+
     @property
     def seq_number(self) -> int:
-        return self.__seq_number.value
-    
+        return self._seq_number
+
     @seq_number.setter
     def seq_number(self, seq_number: int) -> None:
-        self.__seq_number = c_uint32(seq_number)
-    
+        self._seq_number = seq_number & 0xFFFFFFFF
+
     @property
     def ack_number(self) -> int:
-        return self.__ack_number.value
+        return self._ack_number
 
     @property
     def flags(self) -> Flags:
-        return self.__flags
-    
+        return self._flags
+
     @flags.setter
     def flags(self, flags: Flags) -> None:
-        self.__flags = flags
+        self._flags = flags
 
     @property
     def transfer_id(self) -> int:
-        return self.__transfer_id.value
-    
+        return self._transfer_id
+
     @transfer_id.setter
     def transfer_id(self, transfer_id: int) -> None:
-        self.__transfer_id = c_uint16(transfer_id)
+        self._transfer_id = transfer_id & 0xFFFF
 
     @property
     def checksum(self) -> int:
-        return self.__checksum.value
+        return self._checksum
 
     @checksum.setter
     def checksum(self, checksum: int) -> None:
-        self.__checksum = c_uint16(checksum)
-    
+        self._checksum = checksum & 0xFFFF
+
     @property
     def timeout(self) -> int:
-        return self.__timeout.value / 1000
-    
+        return self._timeout / 1000
+
     @timeout.setter
     def timeout(self, timeout: int) -> None:
-        timeout = int(timeout * 1000)
-        self.__timeout = c_int64(timeout)
+        self._timeout = int(timeout * 1000)
 
     def dump(self) -> bytes:
-        return (
-            self.__seq_number.value.to_bytes(4, byteorder='big')
-            + self.__ack_number.value.to_bytes(4, byteorder='big')
-            + self.__flags.value.to_bytes(1, byteorder='big') 
-            + self.__transfer_id.value.to_bytes(2, byteorder='big')
-            + self.__checksum.value.to_bytes(2, byteorder='big')
-            + self.__timeout.value.to_bytes(8, byteorder='big')
-        )
-    
-    def load(self, data: bytes) -> None:
-        self.__seq_number = c_uint32(int.from_bytes(data[0:4], byteorder='big'))
-        self.__ack_number = c_uint32(int.from_bytes(data[4:8], byteorder='big'))
-        self.__flags = Flags(int.from_bytes(data[8:9], byteorder='big'))
-        self.__transfer_id = c_uint16(int.from_bytes(data[9:11], byteorder='big'))
-        self.__checksum = c_uint16(int.from_bytes(data[11:13], byteorder='big'))
-        self.__timeout = c_int64(int.from_bytes(data[13:21], byteorder='big'))
-    
+        return HEADER_STRUCT.pack(self._seq_number, self._ack_number, self._flags,
+                                  self._transfer_id, self._checksum, self._timeout)
+
+    def dump_into(self, buffer: bytearray | memoryview, offset: int = 0) -> None:
+        HEADER_STRUCT.pack_into(buffer, offset, self._seq_number, self._ack_number, self._flags,
+                                self._transfer_id, self._checksum, self._timeout)
+
+    def load(self, data: bytes | memoryview, offset: int = 0) -> None:
+        (self._seq_number, self._ack_number, flags,
+         self._transfer_id, self._checksum, self._timeout) = HEADER_STRUCT.unpack_from(data, offset)
+        self._flags = _FLAGS[flags]
+
     def __str__(self) -> str:
         return (
-            f"Header(seq_number={self.__seq_number.value}, "
-            f"ack_number={self.__ack_number.value}, "
-            f"flags={self.__flags.__repr__()}, "
-            f"__transfer_id={self.__transfer_id.value}, "
-            f"checksum={self.__checksum.value}, "
-            f"timeout={self.__timeout.value})"
-            
+            f"Header(seq_number={self._seq_number}, "
+            f"ack_number={self._ack_number}, "
+            f"flags={self._flags.__repr__()}, "
+            f"__transfer_id={self._transfer_id}, "
+            f"checksum={self._checksum}, "
+            f"timeout={self._timeout})"
+
         )
 
     def __repr__(self) -> str:
-        return self.__str__()
\ No newline at end of file
+        return self.__str__()
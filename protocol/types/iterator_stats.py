@@ -0,0 +1,17 @@
+from dataclasses import dataclass
+from typing import Hashable
+
+
+@dataclass
+class IteratorStats:
+    name: str
+    flow: Hashable = None
+    weight: float = 1.0
+    calls: int = 0
+    busy_calls: int = 0
+    slices: int = 0
+    time: float = 0.0 # seconds spent inside the iterator
+
+    @property
+    def avg_slice_time(self) -> float:
+        return self.time / (self.slices or 1)
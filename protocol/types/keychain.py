@@ -1,4 +1,5 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, field
+from ..cipher import Cipher, XOR_CIPHER
 from ..utils import PUBLIC_KEY_T, PRIVATE_KEY_T
 
 @dataclass
@@ -6,9 +7,11 @@ class Keychain:
     public_key: PUBLIC_KEY_T
     private_key: PRIVATE_KEY_T
     other_public_key: PUBLIC_KEY_T = None
+    cipher: Cipher = XOR_CIPHER # negotiated with the other side
+    ciphers: list[int] = field(default_factory=lambda: [XOR_CIPHER.id]) # what we offer, preferred first
 
     def __copy__(self) -> 'Keychain':
-        return Keychain(self.public_key, self.private_key, self.other_public_key)
+        return Keychain(self.public_key, self.private_key, self.other_public_key, self.cipher, list(self.ciphers))
     
     def copy(self) -> 'Keychain':
-        return self.__copy__()
\ No newline at end of file
+        return self.__copy__()
@@ -0,0 +1,50 @@
+from bisect import bisect_right
+from dataclasses import dataclass, field
+from ..utils import encode_varint, decode_varint
+
+MANIFEST_LEN_SIZE = 8 # The manifest length leads the bundle
+
+
+@dataclass
+class Manifest:
+    """
+    Files of a bundle, in the order their data follows the manifest. Encoded as varints:
+    the number of files, then for every file the length of its UTF-8 name, the name and its size.
+    """
+    files: list[tuple[str, int]] = field(default_factory=list) # (name, size)
+
+    def dump(self) -> bytes:
+        parts = [encode_varint(len(self.files))]
+        for name, size in self.files:
+            encoded = name.encode()
+            parts += (encode_varint(len(encoded)), encoded, encode_varint(size))
+        return b''.join(parts)
+
+    @classmethod
+    def load(cls, data: bytes | memoryview) -> 'Manifest':
+        count, offset = decode_varint(data)
+        files = []
+        for _ in range(count):
+            name_len, offset = decode_varint(data, offset)
+            name = bytes(data[offset:offset + name_len]).decode()
+            size, offset = decode_varint(data, offset + name_len)
+            files.append((name, size))
+        return cls(files)
+
+    def starts(self, data_start: int) -> list[int]:
+        """Offset of every file in the bundle, the data starts at `data_start`"""
+        starts = []
+        for _, size in self.files:
+            starts.append(data_start)
+            data_start += size
+        return starts
+
+    @staticmethod
+    def file_at(starts: list[int], offset: int) -> int:
+        """Index of the file `offset` falls in, empty files share the offset of the next one"""
+        return bisect_right(starts, offset) - 1
+
+    @property
+    def size(self) -> int:
+        """Bytes of all files"""
+        return sum(size for _, size in self.files)
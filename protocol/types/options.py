@@ -0,0 +1,109 @@
+from enum import IntEnum, IntFlag
+
+
+class OptionType(IntEnum):
+    CHECKSUM = 1
+    CIPHER = 2
+    FEATURES = 3
+    MAX_DATAGRAM = 4
+    CODECS = 5
+
+
+class Feature(IntFlag):
+    """Protocol extensions, both sides must support them"""
+    SACK = 0b00000001 # ACKs carry a watermark and ranges instead of every insertion point
+    WINDOW = 0b00000010 # SACKs also advertise the free receive buffer, needs SACK
+    WIDE_OFFSETS = 0b00000100 # 8-byte insertion points and lengths, for data over 4 GiB
+    STREAM = 0b00001000 # Messages of unknown length, announced when they end, needs WIDE_OFFSETS
+    RESUME = 0b00010000 # Files carry a content id, receivers announce the parts they kept, needs SACK and WIDE_OFFSETS
+    BUNDLE = 0b00100000 # Many files in one transfer behind a manifest, needs WIDE_OFFSETS
+    INLINE = 0b01000000 # Messages that fit in one datagram travel in their SYN, without a transfer
+
+
+LEGACY_DATAGRAM_SIZE = 1024 # What peers without the MAX_DATAGRAM option receive
+MAX_DATAGRAM_SIZE = 65507 # Largest UDP payload over IPv4
+JUMBO_DATAGRAM_SIZE = 8972 # 9000 bytes MTU - IPv4 and UDP headers
+
+
+class Options:
+    """
+    Type-length-value options. They follow the public key in SYN and SYN-ACK packets:
+    SYN offers what the side supports, SYN-ACK answers with what was chosen.
+    Peers that don't know an option skip it, peers that don't know options at all never read them.
+    """
+    def __init__(self, values: dict[int, bytes] | None = None) -> None:
+        self.__values: dict[int, bytes] = dict(values or {})
+
+    def __contains__(self, option: int) -> bool:
+        return option in self.__values
+
+    def __len__(self) -> int:
+        return len(self.__values)
+
+    def get(self, option: int, default: bytes | None = None) -> bytes | None:
+        return self.__values.get(option, default)
+
+    def set(self, option: int, value: bytes) -> None:
+        if len(value) > 255:
+            raise ValueError(f"Option {option} is too long ({len(value)} bytes)")
+        self.__values[option] = bytes(value)
+
+    @property
+    def checksums(self) -> list[int]:
+        return list(self.__values.get(OptionType.CHECKSUM, b''))
+
+    @checksums.setter
+    def checksums(self, ids: list[int]) -> None:
+        self.set(OptionType.CHECKSUM, bytes(ids))
+
+    @property
+    def ciphers(self) -> list[int]:
+        return list(self.__values.get(OptionType.CIPHER, b''))
+
+    @ciphers.setter
+    def ciphers(self, ids: list[int]) -> None:
+        self.set(OptionType.CIPHER, bytes(ids))
+
+    @property
+    def codecs(self) -> list[int]:
+        return list(self.__values.get(OptionType.CODECS, b''))
+
+    @codecs.setter
+    def codecs(self, ids: list[int]) -> None:
+        self.set(OptionType.CODECS, bytes(ids))
+
+    @property
+    def features(self) -> Feature:
+        return Feature(int.from_bytes(self.__values.get(OptionType.FEATURES, b''), byteorder='big'))
+
+    @features.setter
+    def features(self, features: Feature) -> None:
+        self.set(OptionType.FEATURES, int(features).to_bytes(4, byteorder='big'))
+
+    @property
+    def max_datagram(self) -> int:
+        """Largest datagram the side can receive, the legacy size if not sent"""
+        value = self.__values.get(OptionType.MAX_DATAGRAM)
+        if not value:
+            return LEGACY_DATAGRAM_SIZE
+        return max(LEGACY_DATAGRAM_SIZE, int.from_bytes(value, byteorder='big')) # Every peer receives the legacy size, a smaller offer would leave no room for data
+
+    @max_datagram.setter
+    def max_datagram(self, size: int) -> None:
+        self.set(OptionType.MAX_DATAGRAM, size.to_bytes(4, byteorder='big'))
+
+    def dump(self) -> bytes:
+        return b''.join(bytes([option, len(value)]) + value for option, value in self.__values.items())
+
+    @classmethod
+    def load(cls, data: bytes | memoryview) -> "Options":
+        values = {}
+        i = 0
+        while i + 2 <= len(data):
+            option, length = data[i], data[i + 1]
+            values[option] = bytes(data[i + 2:i + 2 + length])
+            i += 2 + length
+        return cls(values)
+
+    def __repr__(self) -> str:
+        return f"Options({self.__values})"
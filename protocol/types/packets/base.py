@@ -1,13 +1,15 @@
-import copy
-
 from typing import Type, TypeVar
 from ..header import Header, HEADER_SIZE
-from ...utils import PUBLIC_KEY_T, PRIVATE_KEY_T, encrypt, decrypt
+from ...checksum import Checksum, LEGACY_CHECKSUM
+from ...cipher import Cipher, XOR_CIPHER
+from ...utils import PUBLIC_KEY_T, PRIVATE_KEY_T
 
 
 _T = TypeVar("_T", bound="Packet")
 
 class Packet:
+    __slots__ = ('__header', '__data', '__public_key', '__private_key', '__cipher')
+
     def __init__(self, header: Header = None, 
                 public_key: PUBLIC_KEY_T = None, private_key: PRIVATE_KEY_T = None,
                 *args, **kwargs) -> None:
@@ -16,19 +18,17 @@ class Packet:
         else:
             self.__header = header
 
-        self.data = b'' ## XD вообще хз
+        self.__data = b''
+        self.__header.checksum = 0
 
         self.__public_key = public_key
         self.__private_key = private_key
+        self.__cipher = XOR_CIPHER
 
         self._post_init_(*args, **kwargs)
     
     def _post_init_(self, *args, **kwargs) -> None: NotImplemented
 
-    @property
-    def is_packet_valid(self) -> bool:
-        return self.__validate_checksum()
-
     @property
     def _public_key(self) -> PUBLIC_KEY_T:
         return self.__public_key
@@ -45,12 +45,22 @@ class Packet:
     def _private_key(self, private_key: PRIVATE_KEY_T) -> None:
         self.__private_key = private_key
     
+    @property
+    def _cipher(self) -> Cipher:
+        return self.__cipher
+    
+    @_cipher.setter
+    def _cipher(self, cipher: Cipher) -> None:
+        self.__cipher = cipher
+    
     @property
     def header(self) -> Header:
         return self.__header
     
     @property
     def data(self) -> bytes:
+        if isinstance(self.__data, list):
+            self.__data = b''.join(self.__data)
         return self.__data
     
     @data.setter
@@ -59,47 +69,84 @@ class Packet:
             data = b''
 
         self.__data = data
-        self.__header.checksum = self.__calculate_checksum()
-    
-    def __calculate_checksum(self) -> int:
-        checksum = 0
-        temp_data = copy.copy(self.__data)
-        if len(temp_data) % 2 == 1:
-            temp_data += b'\x00'
-        
-        for i in range(0, len(temp_data), 2):
-            checksum += int.from_bytes(temp_data[i:i+2], byteorder='big')
-        
-        return checksum & 0b1111111111111111
+    
+    def _set_pieces(self, pieces: list[bytes | memoryview]) -> None:
+        """Data in pieces, kept apart by encrypt and dump_vector. Joined only if `data` is read"""
+        self.__data = pieces
     
     def encrypt(self: _T) -> _T:
-        self.data = encrypt(self.data, self._public_key)
+        if isinstance(self.__data, list):
+            self.__data = self.__cipher.encrypt_vector(self.__data, self._public_key)
+        else:
+            self.data = self.__cipher.encrypt(self.data, self._public_key)
         return self
     
     def decrypt(self: _T) -> _T:
-        self.data = decrypt(self.data, self._private_key)
+        self.data = self.__cipher.decrypt(self.data, self._private_key)
         return self
+    
+    def peek(self, size: int) -> bytes | None:
+        """First `size` bytes of the decrypted data, leaves the packet encrypted"""
+        return self.__cipher.decrypt_prefix(self.data, self._private_key, size)
 
-    def __validate_checksum(self) -> bool:
-        return self.__header.checksum == self.__calculate_checksum()
+    def dump(self, checksum: Checksum = LEGACY_CHECKSUM) -> bytearray:
+        data = self.data
+        buffer = bytearray(HEADER_SIZE + len(data) + checksum.size)
+        self.__header.checksum = 0
+        self.__header.dump_into(buffer)
+        buffer[HEADER_SIZE:HEADER_SIZE + len(data)] = data
+        sealed = checksum.seal(buffer)
+        if not checksum.size:
+            self.__header.checksum = sealed # Stored in the header
+        return buffer
+    
+    def dump_vector(self, checksum: Checksum = LEGACY_CHECKSUM) -> list[bytes | bytearray | memoryview]:
+        """Same datagram as dump, as buffers for a scatter-gather send. The data (or its pieces) is not copied"""
+        header = bytearray(HEADER_SIZE)
+        self.__header.checksum = 0
+        self.__header.dump_into(header)
+        pieces = self.__data if isinstance(self.__data, list) else [self.__data]
+        sealed, trailer = checksum.seal_vector(header, pieces)
+        if not checksum.size:
+            self.__header.checksum = sealed # Stored in the header
+        return [header, *pieces, trailer] if trailer else [header, *pieces]
     
-    def dump(self) -> bytes:
-        return self.__header.dump() + self.__data
+    def load(self: _T, data: bytes | memoryview, checksum: Checksum = LEGACY_CHECKSUM) -> _T:
+        """Parse the packet without copying: data stays a view on the given buffer (see detach)"""
+        self.__header.load(data)
+        self.__data = memoryview(data)[HEADER_SIZE:len(data) - checksum.size]
+        return self
+    
+    @classmethod
+    def from_datagram(cls: Type[_T], data: bytes | memoryview, checksum: Checksum = LEGACY_CHECKSUM) -> _T:
+        """Same as cls().load(data), without building a default header first"""
+        header = Header.__new__(Header)
+        header.load(data)
+        packet = cls.__new__(cls)
+        packet.__header = header
+        packet.__data = memoryview(data)[HEADER_SIZE:len(data) - checksum.size]
+        packet.__public_key = None
+        packet.__private_key = None
+        packet.__cipher = XOR_CIPHER
+        return packet
     
-    def load(self: _T, data: bytes) -> _T:
-        self.__header.load(data[:HEADER_SIZE])
-        self.__data = data[HEADER_SIZE:]
+    def detach(self: _T) -> _T:
+        """Copy data out of the receive buffer, so the packet can outlive it"""
+        if isinstance(self.data, memoryview):
+            self.__data = self.__data.tobytes()
         return self
     
     def copy(self: _T) -> _T:
         return self.downcast(type(self))
 
     def downcast(self, packet_type: Type[_T]) -> _T:
-        packet = packet_type()
+        """View of the same packet as packet_type. Header and data are shared, nothing is copied or re-initialized"""
+        packet = packet_type.__new__(packet_type)
         packet.__header = self.__header
         packet.__data = self.__data
         packet.__public_key = self.__public_key
         packet.__private_key = self.__private_key
+        packet.__cipher = self.__cipher
         return packet
 
     def __str__(self) -> str:
@@ -0,0 +1,43 @@
+from .base import Packet
+from ..flags import Flags
+from ...utils import encode_varint, decode_varint
+
+class SackPacket(Packet):
+    """
+    Selective ACK: everything below the watermark is received, plus ranges above it.
+    Encoded as varints: watermark, then for every range the gap after the previous end and its length.
+    With the WINDOW feature the receive window (free bytes of the receiver) comes first.
+    """
+    __slots__ = ()
+
+    def _post_init_(self, *args, **kwargs) -> None:
+        self.header.flags = Flags.ACK
+
+    def set_sack(self, watermark: int, ranges: list[tuple[int, int]], window: int | None = None) -> None:
+        """ranges are sorted (start, end) pairs above the watermark"""
+        data = [encode_varint(window)] if window is not None else []
+        data.append(encode_varint(watermark))
+        previous_end = watermark
+        for start, end in ranges:
+            data.append(encode_varint(start - previous_end))
+            data.append(encode_varint(end - start))
+            previous_end = end
+        self.data = b''.join(data)
+
+    def get_sack(self, with_window: bool = False) -> tuple[int, list[tuple[int, int]], int | None]:
+        """watermark, ranges and the receive window (None without `with_window`)"""
+        data = self.data
+        window, offset = decode_varint(data) if with_window else (None, 0)
+        watermark, offset = decode_varint(data, offset)
+        ranges = []
+        previous_end = watermark
+        while offset < len(data):
+            gap, offset = decode_varint(data, offset)
+            length, offset = decode_varint(data, offset)
+            start = previous_end + gap
+            previous_end = start + length
+            ranges.append((start, previous_end))
+        return watermark, ranges, window
+    
+    def __repr__(self) -> str:
+        return super().__repr__() + f", sack={self.get_sack()})"
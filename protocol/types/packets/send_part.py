@@ -1,24 +1,48 @@
+import struct
+
 from .base import Packet
 from ..flags import Flags
 
+INSERTION_POINT = struct.Struct('>I')
+WIDE_INSERTION_POINT = struct.Struct('>Q')
+
 class SendPartPacket(Packet):
+    __slots__ = ()
+    INSERTION_POINT = INSERTION_POINT
+
     def _post_init_(self, *args, **kwargs) -> None:
-        self._auto_encrypt_decrypt = True
         self.header.flags = Flags.SEND | Flags.PART
-        self.data = 0 .to_bytes(4, 'big') + b''
+        self.data = bytes(self.INSERTION_POINT.size)
     
     @property
     def insertion_point(self) -> int:
-        return int.from_bytes(self.data[:4], 'big')
+        return self.INSERTION_POINT.unpack_from(self.data)[0]
     
     @insertion_point.setter
     def insertion_point(self, point: int) -> None:
-        self.data = point.to_bytes(4, 'big') + self.data[4:]
+        self.data = self.INSERTION_POINT.pack(point) + self.data[self.INSERTION_POINT.size:]
+    
+    def peek_insertion_point(self) -> int | None:
+        """Insertion point of an encrypted packet, None if the cipher can not tell it early"""
+        head = self.peek(self.INSERTION_POINT.size)
+        if head is None or len(head) < self.INSERTION_POINT.size:
+            return None
+        return self.INSERTION_POINT.unpack(head)[0]
     
     @property
-    def data_part(self) -> bytes:
-        return self.data[4:]
+    def data_part(self) -> memoryview:
+        return memoryview(self.data)[self.INSERTION_POINT.size:]
     
     @data_part.setter
     def data_part(self, data: bytes) -> None:
-        self.data = self.data[:4] + data
\ No newline at end of file
+        self.data = bytes(self.data[:self.INSERTION_POINT.size]) + data
+    
+    def set_part(self, insertion_point: int, *data: bytes | memoryview) -> None:
+        """Set insertion point and data (in pieces, e.g. a codec marker and the part) at once. Nothing is joined"""
+        self._set_pieces([self.INSERTION_POINT.pack(insertion_point), *data])
+
+
+class WideSendPartPacket(SendPartPacket):
+    """8-byte insertion point, for transfers over 4 GiB (WIDE_OFFSETS feature)"""
+    __slots__ = ()
+    INSERTION_POINT = WIDE_INSERTION_POINT
@@ -1,21 +1,34 @@
 from .base import Packet
 from ..flags import Flags
+from ..options import Options
 from ...utils import decode_pubkey, encode_pubkey, PUBLIC_KEY_T
 
+KEY_SIZE = 64 # bytes
+
 class SynPacket(Packet):
+    __slots__ = ()
+
     def _post_init_(self):
         if self.data == b'':
-            self.data = 0 .to_bytes(64, byteorder='big')
+            self.data = 0 .to_bytes(KEY_SIZE, byteorder='big')
         
         self.header.flags = Flags.SYN
 
     @property
     def public_key(self) -> PUBLIC_KEY_T:
-        return decode_pubkey(self.data[:64])
+        return decode_pubkey(self.data[:KEY_SIZE])
     
     @public_key.setter
     def public_key(self, public_key: PUBLIC_KEY_T) -> None:
-        self.data = encode_pubkey(public_key)
+        self.data = encode_pubkey(public_key).rjust(KEY_SIZE, b'\x00') + bytes(self.data[KEY_SIZE:])
+    
+    @property
+    def options(self) -> Options:
+        return Options.load(self.data[KEY_SIZE:])
+    
+    @options.setter
+    def options(self, options: Options) -> None:
+        self.data = bytes(self.data[:KEY_SIZE]).rjust(KEY_SIZE, b'\x00') + options.dump()
     
     def __repr__(self) -> str:
-        return super().__repr__() + f'[public_key={self.public_key}]'
\ No newline at end of file
+        return super().__repr__() + f'[public_key={self.public_key}, options={self.options}]'
@@ -0,0 +1,9 @@
+from .syn_send_msg import WideSynSendMsgPacket
+from ..flags import Flags
+
+class SynSendBundlePacket(WideSynSendMsgPacket):
+    """Start of a bundle: the manifest and the files follow as one transfer of `message_len` bytes (BUNDLE feature)"""
+    __slots__ = ()
+
+    def _post_init_(self, *args, **kwargs) -> None:
+        self.header.flags = Flags.SYN | Flags.SEND | Flags.FILE | Flags.MSG
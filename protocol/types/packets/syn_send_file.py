@@ -1,26 +1,65 @@
+import struct
+
 from .base import Packet
 from ..flags import Flags
 
 class SynSendFilePacket(Packet):
+    __slots__ = ()
+    DATA_LEN = struct.Struct('>I')
+
     def _post_init_(self, *args, **kwargs) -> None:
         self.header.flags = Flags.SYN | Flags.SEND | Flags.FILE
-        self.data = b'\x00\x00\x00\x00'
+        self.data = bytes(self.DATA_LEN.size)
 
     @property
     def data_len(self) -> int:
-        return int.from_bytes(self.data[:4], byteorder='big')
+        if len(self.data) < self.DATA_LEN.size:
+            return 0
+        return self.DATA_LEN.unpack_from(self.data)[0]
 
     @data_len.setter
     def data_len(self, data_len: int) -> None:
-        self.data = data_len.to_bytes(4, byteorder='big') + self.data[4:]
+        self.data = self.DATA_LEN.pack(data_len) + self.data[self.DATA_LEN.size:]
     
     @property
     def filename(self) -> str:
-        return self.data[4:].decode()
+        return bytes(self.data[self.DATA_LEN.size:]).decode()
     
     @filename.setter
     def filename(self, filename: str) -> None:
-        self.data = self.data_len.to_bytes(4, byteorder='big') + filename.encode()
+        self.data = self.DATA_LEN.pack(self.data_len) + filename.encode()
     
     def __repr__(self) -> str:
-        return super().__repr__() + f", data_len={self.data_len})"
\ No newline at end of file
+        return super().__repr__() + f", data_len={self.data_len})"
+
+
+class WideSynSendFilePacket(SynSendFilePacket):
+    """8-byte file length (WIDE_OFFSETS feature)"""
+    __slots__ = ()
+    DATA_LEN = struct.Struct('>Q')
+
+
+CONTENT_ID_SIZE = 16
+
+class ResumableSynSendFilePacket(WideSynSendFilePacket):
+    """Content id of the file between the length and the filename (RESUME feature)"""
+    __slots__ = ()
+
+    @property
+    def content_id(self) -> bytes:
+        start = self.DATA_LEN.size
+        return bytes(self.data[start:start + CONTENT_ID_SIZE]).ljust(CONTENT_ID_SIZE, b'\0')
+
+    @content_id.setter
+    def content_id(self, content_id: bytes) -> None:
+        if len(content_id) != CONTENT_ID_SIZE:
+            raise ValueError(f"Content id must be {CONTENT_ID_SIZE} bytes")
+        self.data = self.DATA_LEN.pack(self.data_len) + content_id + self.filename.encode()
+
+    @property
+    def filename(self) -> str:
+        return bytes(self.data[self.DATA_LEN.size + CONTENT_ID_SIZE:]).decode()
+
+    @filename.setter
+    def filename(self, filename: str) -> None:
+        self.data = self.DATA_LEN.pack(self.data_len) + self.content_id + filename.encode()
@@ -1,17 +1,63 @@
+import struct
+
 from .base import Packet
 from ..flags import Flags
 
+STREAM_MESSAGE_LEN = 2**64 - 1 # Length of a stream in its SYN, the real one is sent again when it ends
+STREAM_END = b'\x01' # Follows the length when a stream ends
+
 class SynSendMsgPacket(Packet):
+    __slots__ = ()
+    MESSAGE_LEN = struct.Struct('>I')
+
     def _post_init_(self, *args, **kwargs) -> None:
         self.header.flags = Flags.SYN | Flags.SEND | Flags.MSG
 
+    @property
+    def is_stream(self) -> bool:
+        return self.message_len == STREAM_MESSAGE_LEN
+    
+    @property
+    def is_stream_end(self) -> bool:
+        return self.data[self.MESSAGE_LEN.size:] == STREAM_END
+    
+    def set_stream_end(self, length: int) -> None:
+        self.data = self.MESSAGE_LEN.pack(length) + STREAM_END
+
     @property
     def message_len(self) -> int:
-        return int.from_bytes(self.data[0:4], byteorder='big')
+        if len(self.data) < self.MESSAGE_LEN.size:
+            return 0
+        return self.MESSAGE_LEN.unpack_from(self.data)[0]
 
     @message_len.setter
     def message_len(self, message_len: int) -> None:
-        self.data = message_len.to_bytes(4, byteorder='big')
+        self.data = self.MESSAGE_LEN.pack(message_len)
+    
+    def __repr__(self) -> str:
+        return super().__repr__() + f", message_len={self.message_len})"
+
+
+class WideSynSendMsgPacket(SynSendMsgPacket):
+    """8-byte message length (WIDE_OFFSETS feature)"""
+    __slots__ = ()
+    MESSAGE_LEN = struct.Struct('>Q')
+
+
+class InlineMsgPacket(Packet):
+    """A whole message in its SYN, completed by a single ACK (INLINE feature)"""
+    __slots__ = ()
+
+    def _post_init_(self, *args, **kwargs) -> None:
+        self.header.flags = Flags.SYN | Flags.SEND | Flags.MSG | Flags.FIN
+
+    @property
+    def message(self) -> bytes:
+        return self.data
+
+    @message.setter
+    def message(self, message: bytes) -> None:
+        self.data = message
     
     def __repr__(self) -> str:
-        return super().__repr__() + f", message_len={self.message_len})"
\ No newline at end of file
+        return super().__repr__() + f", message_len={len(self.data)})"
@@ -0,0 +1,90 @@
+from bisect import bisect_left, bisect_right
+
+
+class RangeSet:
+    """
+    Set of integers stored as sorted, non-overlapping, non-adjacent [start, end) ranges.
+    Parts arriving mostly in order collapse into a handful of ranges, whatever the part size.
+    """
+    __slots__ = ('_starts', '_ends', '_total')
+
+    def __init__(self) -> None:
+        self._starts: list[int] = []
+        self._ends: list[int] = []
+        self._total = 0
+
+    def add(self, start: int, end: int) -> int:
+        """Add [start, end). Returns how many integers were not in the set before"""
+        if end <= start:
+            return 0
+        starts, ends = self._starts, self._ends
+        first = bisect_left(ends, start) # First range ending at or after start, can merge
+        last = bisect_right(starts, end) # First range starting after end, can not merge
+
+        if first == last: # Nothing to merge with
+            starts.insert(first, start)
+            ends.insert(first, end)
+            self._total += end - start
+            return end - start
+
+        covered = sum(min(e, end) - max(s, start) for s, e in zip(starts[first:last], ends[first:last]) if e > start and s < end)
+        new_start = min(start, starts[first])
+        new_end = max(end, ends[last - 1])
+        starts[first:last] = [new_start]
+        ends[first:last] = [new_end]
+        added = end - start - covered
+        self._total += added
+        return added
+
+    def __contains__(self, value: int) -> bool:
+        i = bisect_right(self._starts, value) - 1
+        return i >= 0 and value < self._ends[i]
+
+    def range_of(self, value: int) -> tuple[int, int] | None:
+        """The range containing `value`"""
+        i = bisect_right(self._starts, value) - 1
+        if i >= 0 and value < self._ends[i]:
+            return self._starts[i], self._ends[i]
+        return None
+
+    def __len__(self) -> int:
+        """Number of ranges"""
+        return len(self._starts)
+
+    def __iter__(self):
+        return zip(self._starts, self._ends)
+
+    @property
+    def total(self) -> int:
+        """Number of integers in the set (received bytes)"""
+        return self._total
+
+    @property
+    def watermark(self) -> int:
+        """Everything below is in the set"""
+        return self._ends[0] if self._starts and self._starts[0] == 0 else 0
+
+    def ranges(self, start: int = 0) -> list[tuple[int, int]]:
+        """Ranges from `start` on, a range containing `start` is clipped to it"""
+        i = bisect_right(self._ends, start)
+        ranges = list(zip(self._starts[i:], self._ends[i:]))
+        if ranges and ranges[0][0] < start:
+            ranges[0] = (start, ranges[0][1])
+        return ranges
+
+    def gaps(self, length: int) -> list[tuple[int, int]]:
+        """Missing [start, end) ranges of [0, length)"""
+        gaps = []
+        previous_end = 0
+        for start, end in zip(self._starts, self._ends):
+            if start >= length:
+                break
+            if start > previous_end:
+                gaps.append((previous_end, start))
+            previous_end = end
+        if previous_end < length:
+            gaps.append((previous_end, length))
+        return gaps
+
+    def __repr__(self) -> str:
+        return f"RangeSet({list(self)})"
@@ -0,0 +1,16 @@
+from dataclasses import dataclass
+
+
+@dataclass
+class SocketStats:
+    recv_batch_size: int = 0
+    recv_wakeups: int = 0
+    recv_datagrams: int = 0
+    recv_bytes: int = 0
+    recv_max_batch: int = 0
+    send_datagrams: int = 0
+    send_bytes: int = 0
+
+    @property
+    def recv_avg_batch(self) -> float:
+        return self.recv_datagrams / (self.recv_wakeups or 1)
@@ -1,6 +1,9 @@
+import os
 import random
+import hashlib
 
-from typing import Type
+from typing import BinaryIO, Type
+from .cipher import XOR_CIPHER
 
 # XOR encryption
 PUBLIC_KEY_T = Type[int]
@@ -12,10 +15,10 @@ def genereate_keys() -> tuple[PUBLIC_KEY_T, PRIVATE_KEY_T]:
     return public_key, private_key
 
 def encrypt(data: bytes, public_key: int) -> bytes:
-    return bytes([data[i] ^ public_key for i in range(len(data))])
+    return XOR_CIPHER.encrypt(data, public_key)
 
 def decrypt(data: bytes, private_key: int) -> bytes:
-    return bytes([data[i] ^ (private_key * 2) for i in range(len(data))])
+    return XOR_CIPHER.decrypt(data, private_key)
 
 def decode_pubkey(pubkey: bytes) -> PUBLIC_KEY_T:
     return int.from_bytes(pubkey, byteorder='big')
@@ -24,13 +27,50 @@ def encode_pubkey(pubkey: PUBLIC_KEY_T) -> bytes:
     return pubkey.to_bytes(32, byteorder='big')
 
 
-# null encryption
-# def encrypt(data: bytes, public_key: int) -> bytes:
-#     return data
+# Other engines (null encryption, ...) are in cipher.py
 
-# def decrypt(data: bytes, private_key: int) -> bytes:
-#     return data
 
+def encode_varint(value: int) -> bytes:
+    """LEB128: 7 bits per byte, the high bit says that more bytes follow"""
+    result = bytearray()
+    while value >= 0x80:
+        result.append((value & 0x7F) | 0x80)
+        value >>= 7
+    result.append(value)
+    return bytes(result)
+
+def decode_varint(data: bytes | memoryview, offset: int = 0) -> tuple[int, int]:
+    """Returns the value and the offset right after it"""
+    value = 0
+    shift = 0
+    while True:
+        byte = data[offset]
+        offset += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value, offset
+        shift += 7
+
+
+def content_id(file: BinaryIO, sample_size: int = 64 * 1024) -> bytes:
+    """
+    16 bytes telling a file (version) apart without reading all of it: size, modification time,
+    the first and the last `sample_size` bytes. Used to resume interrupted transfers.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    position = file.tell()
+    size = file.seek(0, os.SEEK_END)
+    digest.update(size.to_bytes(8, 'big'))
+    try:
+        digest.update(os.fstat(file.fileno()).st_mtime_ns.to_bytes(8, 'big'))
+    except (OSError, AttributeError, ValueError):
+        pass # Not a file on disk, the content has to do
+    file.seek(0)
+    digest.update(file.read(sample_size))
+    file.seek(max(0, size - sample_size))
+    digest.update(file.read(sample_size))
+    file.seek(position)
+    return digest.digest()
 
 
 def seq_num_generator():
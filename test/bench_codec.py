@@ -0,0 +1,38 @@
+import os
+import timeit
+
+from protocol.types.flags import Flags
+from protocol.types.header import Header
+from protocol.types.packets.base import Packet
+from protocol.types.packets.send_part import SendPartPacket
+
+# Microbenchmark of the packet codec: python bench_codec.py [payload size]
+
+NUMBER = 20000
+
+def bench(name: str, stmt, number: int = NUMBER) -> None:
+    best = min(timeit.repeat(stmt, number=number, repeat=5))
+    print(f"{name:<32} {best / number * 1e9:>10.0f} ns/op")
+
+
+if __name__ == "__main__":
+    import sys
+    payload = os.urandom(int(sys.argv[1]) if len(sys.argv) > 1 else 960)
+
+    header = Header(seq_number=123, ack_number=456, flags=Flags.SEND | Flags.PART, transfer_id=789)
+    header.timeout = 1234567.89
+    header_bytes = header.dump()
+
+    part = SendPartPacket(header=Header(seq_number=1, flags=Flags.SEND | Flags.PART))
+    part.data = (4096).to_bytes(4, 'big') + payload
+    datagram = bytes(part.dump())
+
+    bench("Header.dump", header.dump)
+    bench("Header.load", lambda: Header().load(header_bytes))
+    bench("Packet.dump", part.dump)
+    bench("Packet.load", lambda: Packet().load(datagram))
+    bench("Packet.load + downcast", lambda: Packet().load(datagram).downcast(SendPartPacket))
+    if hasattr(Packet, "from_datagram"):
+        bench("Packet.from_datagram + downcast", lambda: Packet.from_datagram(datagram).downcast(SendPartPacket))
+    bench("SendPartPacket.insertion_point", lambda: part.insertion_point)
+    bench("SendPartPacket.data_part", lambda: part.data_part)
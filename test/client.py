@@ -101,10 +101,8 @@ def on_message_send(conn: Connection, message: bytes, is_correct: bool):
     print(f"\n({conn.other_side}, {is_correct=})>> {message.decode('utf-8')}")
 
 
-@sock.on_file_recv
-def on_file(conn: Connection, file: FileIO, filename: str, is_correct: bool):
-    file.seek(0)
-
+@sock.on_file_destination
+def on_file_destination(conn: Connection, filename: str, length: int):
     if '/' in filename:
         filename = filename.replace('/', '_')
     
@@ -114,13 +112,14 @@ def on_file(conn: Connection, file: FileIO, filename: str, is_correct: bool):
     file_path = f"./{RECVS_DIR}/{filename}"
     if os.path.exists(file_path):
         file_path = f"./{RECVS_DIR}/{time.time()}_{filename}"
-    file_path = os.path.abspath(file_path)
-
+    return os.path.abspath(file_path) # Written there directly, renamed from .part when complete
 
-    with open(file_path, "wb") as f:
-        f.write(file.read())
-    
-    print(f"\nFile {file_path} size: {os.path.getsize(file_path)} from {conn.other_side} is correct: {is_correct}")
+@sock.on_file_recv
+def on_file(conn: Connection, file: FileIO, filename: str, is_correct: bool):
+    if not is_correct:
+        print(f"\nFile {filename} from {conn.other_side} is not complete")
+        return
+    print(f"\nFile {file.path} size: {os.path.getsize(file.path)} from {conn.other_side} is correct: {is_correct}")
 
 @sock.on_file_send
 def on_file_send(conn: Connection, file: FileIO, filename: str, is_correct: bool):
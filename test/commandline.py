@@ -51,6 +51,16 @@ def command_startswith_validator(startswith: str) -> bool:
 #     print(f"Transfer done on {seconds}s. Send: {send_in_s/seconds}B/s Recv: {recv_in_s/seconds}B/s")
         
 
+def send_file(conn_: Connection, path: str, fragment_size: int | None) -> None:
+    """Runs on the socket's loop, the file is closed again if it can not be sent"""
+    file = open(path, "rb")
+    try:
+        conn_.send_file(file, fragment_size=fragment_size)
+    except Exception as e:
+        file.close()
+        print(e)
+
+
 def commandline(sock_: Socket):
     conn_ = None
     fragment_size = None
@@ -93,7 +103,7 @@ def commandline(sock_: Socket):
             
             ip, port = side.split(":")
             
-            new_conn = filter(lambda x: x.other_side == ConnSide(ip, int(port)), sock_._connections)
+            new_conn = filter(lambda x: x.other_side == ConnSide(ip, int(port)), sock_.connections)
             new_conn = list(new_conn)
             if len(new_conn) == 0:
                 print("No connection found")
@@ -102,7 +112,7 @@ def commandline(sock_: Socket):
             continue
         
         if command_startswith_validator("connections")(command) and command_count_validator(1)(command):
-            for conn_ in sock_._connections:
+            for conn_ in sock_.connections:
                 print(conn_.other_side)
             continue
         
@@ -110,15 +120,15 @@ def commandline(sock_: Socket):
             command, side = command.split(" ", 1)
             ip, port = side.split(":")
             side = ConnSide(ip, int(port))
-            conn_ = sock_.connect(side)
-            while not conn_.conversation_status.is_connected:
+            sock_.call_soon_threadsafe(sock_.connect, side)
+            while not (conn_ := sock_.get_connection_by_side(side)) or not conn_.conversation_status.is_connected:
                 sleep(0.1)
             print(f"Connected to {side}")
             continue
         
         if command_startswith_validator("disconnect")(command) and command_count_validator(1)(command):
             if conn_:
-                sock_.disconnect(conn_.other_side)
+                sock_.call_soon_threadsafe(sock_.disconnect, conn_.other_side)
                 conn_ = None
             else:
                 print("You need to connect first")
@@ -133,11 +143,7 @@ def commandline(sock_: Socket):
                 if not os.path.isfile(path):
                     print("Not a file")
                     continue
-                try:
-                    transfer = conn_.send_file(open(path, "rb"), fragment_size=fragment_size)
-                    # Thread(target=calculate_speed, args=(transfer, sock_)).start()
-                except ValueError as e:
-                    print(e)
+                sock_.call_soon_threadsafe(send_file, conn_, path, fragment_size)
             else:
                 print("You need to connect first")
             continue
@@ -145,7 +151,7 @@ def commandline(sock_: Socket):
         if command_startswith_validator("sendmsg")(command) and command_count_validator(2, 1)(command):
             command, message = command.split(" ", 1)
             if conn_:
-                conn_.send_message(message.encode("utf-8"), fragment_size=fragment_size)
+                sock_.call_soon_threadsafe(conn_.send_message, message.encode("utf-8"), fragment_size)
             else:
                 print("You need to connect first")
             continue
@@ -173,10 +179,10 @@ def commandline(sock_: Socket):
             continue
         
         if command == "exit":
-            sock_.disconnect_all()
-            while len(sock_._connections) > 0:
+            sock_.call_soon_threadsafe(sock_.disconnect_all)
+            while len(sock_.connections) > 0:
                 sleep(0.1)
-            sock_.unbind()
+            sock_.call_soon_threadsafe(sock_.unbind)
             break
         
         if command == "":